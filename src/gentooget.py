@@ -24,18 +24,172 @@ import os
 import os.path
 import sys
 import errno
-import traceback
-import getopt
-import shlex
-import subprocess
 import re
+import struct
+import fcntl
+import getopt
 import time
-from urlparse import urlparse
+import hashlib
+import json
+import socket
+import select
+import signal
+import threading
+import random
+import BaseHTTPServer
+import SocketServer
+from urlparse import urlparse, urljoin
+
+class LazyModule:
+   # Portage starts gentooget once per distfile so modules only some paths need (probing, the native engine,
+   # layouts, --delta, the daemon, switching, running aria2c) are imported on first use instead of by every
+   # invocation. The first attribute looked up replaces the stand-in in this module's globals with the module.
+   # Only use these as module.name: from ... import is not possible with a stand-in, so a module whose names are
+   # wanted that way has to be imported at the top or inside the function using it. The modules imported above are
+   # used by every run (json for the state files and the re it imports, urlparse) or by classes defined on import
+   # (socket and threading through BaseHTTPServer and SocketServer).
+   def __init__(self, name):
+      self.name = name
+
+   def __getattr__(self, attr):
+      module = __import__(self.name)
+      globals()[self.name] = module
+      return getattr(module, attr)
+
+traceback = LazyModule('traceback')
+subprocess = LazyModule('subprocess')
+shlex = LazyModule('shlex')
+httplib = LazyModule('httplib')
+ftplib = LazyModule('ftplib')
+ssl = LazyModule('ssl')
+urllib2 = LazyModule('urllib2')
+mmap = LazyModule('mmap')
+zlib = LazyModule('zlib')
+grp = LazyModule('grp')
+pwd = LazyModule('pwd')
+tempfile = LazyModule('tempfile')
 #from urllib.parse import urlparse # Python 3
+try:
+   import pyblake2 # Python 2 hashlib has no BLAKE2B
+except ImportError:
+   pyblake2 = None
 
 VERSION = "0.2"
 DEBUG = VERBOSE = False
 GENTOO_MIRRORS = INTERNATIONAL_MIRRORS = LOCAL_MIRRORS = INTERNAL_MIRRORS = []
+# Shared state (daemon socket, caches) lives here so that root and portage invocations see the same files. The
+# directory belongs to STATE_GROUP (setgid, so the files in it do too) and nobody else can write to it.
+STATE_DIR = os.environ.get('GENTOOGET_DIR', '/var/tmp/gentooget')
+STATE_GROUP = 'portage'
+DAEMON_SOCKET = os.path.join(STATE_DIR, 'gentooget.sock')
+RPC_PORT = 6800
+# The daemon's socket is only usable by its owner and DAEMON_GROUP, which may only set DAEMON_OPTIONS on a download
+DAEMON_GROUP = 'portage'
+DAEMON_OPTIONS = [ 'dir', 'out', 'continue', 'allow-overwrite', 'check-certificate', 'split',
+                   'max-connection-per-server', 'min-split-size', 'file-allocation' ]
+# Portage configuration files searched for the *_MIRRORS variables (see loadConfig)
+MAKE_CONF = [ '/etc/make.conf', '/etc/portage/make.conf' ]
+CONFIG = None
+# Regular expressions only some invocations use are compiled (and cached by re) when first used
+SHELL_NAME_RE = r'^[A-Za-z_][A-Za-z0-9_]*$'
+SHELL_EXPANSION_RE = r'\$(?:([A-Za-z_][A-Za-z0-9_]*)|\{([A-Za-z_][A-Za-z0-9_]*)(?::-([^}]*))?\})'
+SENDFILE = None
+# Mirror ranking: measurements lose half their weight every MIRROR_STATS_HALF_LIFE seconds and a mirror that
+# fails EVICT_FAILURES times in a row is not used for EVICT_TIME seconds
+MIRROR_STATS_HALF_LIFE = 7*24*3600
+EVICT_FAILURES = 3
+EVICT_TIME = 3600
+MIRROR_STATS = None # [stamps, stats] of the last read of mirrorstats.json (see mirrorStats)
+# Manifest digest names to hashlib names
+HASH_NAMES = { 'BLAKE2B': 'blake2b', 'SHA512': 'sha512', 'SHA256': 'sha256', 'SHA1': 'sha1', 'RMD160': 'ripemd160',
+               'MD5': 'md5' }
+HASH_BUFFER_SIZE = 4*1024*1024
+# Verified digests kept (in DIGEST_SHARDS files by inode so that verifying a file only reads and rewrites a small one)
+DIGEST_CACHE_SIZE = 20000
+DIGEST_SHARDS = 256
+# aria2 exit status for "checksum validation failed"
+DIGEST_MISMATCH = 32
+# aria2 exit status for "resource was not found". Uris that fail with it are not tried again for MISS_TTL seconds.
+NOT_FOUND = 3
+MISS_TTL = 12*3600
+# Download engine: 'aria2' (aria2c, through the daemon if one is running), 'native' (RangeDownloader) or 'auto'
+# (aria2 if the aria2c binary exists, otherwise native). NATIVE_PIECE is the unit of progress kept in the control
+# file and the smallest piece work stealing leaves.
+ENGINE = 'auto'
+NATIVE_PIECE = 1024*1024
+NATIVE_CHUNK = 256*1024
+NATIVE_TIMEOUT = 60
+# --delta: a file that is not there yet is started from the blocks it shares with the closest other version of it
+# in the directory (eg. foo-1.1.tar for foo-1.2.tar), found with rsync style rolling checksums against its block
+# index (<name>.zsync.json, see makeIndex) from an internal or local mirror, so that only the rest is downloaded.
+# Indexes have about DELTA_BLOCKS blocks of a power of 2 bytes from DELTA_MIN_BLOCK to NATIVE_PIECE. Matching gives
+# up if nothing in the first DELTA_PROBE bytes of the old file matches, and the file is downloaded as usual if
+# matching rolls through more than DELTA_SCAN bytes that match nothing (at about 1.5MB a second) or takes over
+# DELTA_SCAN_TIME seconds. Old files over DELTA_MAX_SIZE are not used.
+DELTA = False
+DELTA_SUFFIX = '.zsync.json'
+DELTA_BLOCKS = 8192
+DELTA_MIN_BLOCK = 4096
+DELTA_PROBE = 4*1024*1024
+DELTA_SCAN = 4*1024*1024
+DELTA_SCAN_TIME = 5
+DELTA_MAX_SIZE = 256*1024*1024
+DELTA_TIMEOUT = 10
+DISTFILE_NAME_RE = (r'^(.+?)-(\d[^-/]*?)((?:\.(?:tar|cpio))?(?:\.(?:gz|bz2|xz|lz|lzma|lz4|zst|Z))?|'
+                    r'\.(?:tgz|tbz2|tbz|txz|zip|7z|jar|gem|crate))$')
+# Mirror distfiles layouts (GLEP 75 layout.conf) are cached for LAYOUT_TTL seconds, or LAYOUT_RETRY seconds if
+# layout.conf could not be fetched in which case DEFAULT_LAYOUTS are all tried
+LAYOUT_TTL = 24*3600
+LAYOUT_RETRY = 600
+LAYOUT_TIMEOUT = 5
+DEFAULT_LAYOUTS = [ [ 'filename-hash', 'BLAKE2B', [ 8 ] ], [ 'flat' ] ]
+# --probe checks which internal/local mirrors have a file with concurrent HEAD/SIZE requests before downloading
+PROBE = False
+PROBE_TIMEOUT = 1.5
+PROBE_THREADS = 32
+# --hedge: an internal download that has delivered nothing after HEDGE seconds, or less than HEDGE_RATE bytes a
+# second over the last HEDGE seconds, has the local stage (the file's upstream uri if it is not on the mirrors)
+# started alongside it into <name>HEDGE_SUFFIX. The first to finish wins and the other is cancelled, a private
+# aria2c that has not stopped after HEDGE_STOP seconds being killed (a native download waiting on a hung ftp server
+# only stops when that times out) before the winner is moved into place. Only the internal stage is hedged: the stage
+# after local is international, which means switching the link away from the local downloads of this and other
+# processes and is billed, so a slow local download is left to finish (--probe finds slow not founds up front).
+HEDGE = 0
+HEDGE_RATE = 0
+HEDGE_SUFFIX = '.hedge'
+HEDGE_STOP = 10
+# Longest a process waits for other processes to finish with the connection before switching anyway
+LINK_WAIT = 1800
+# Longest to wait for the interface to come up after running a switch script
+LINK_TIMEOUT = 120
+# International link policy: at most BUDGET bytes (0 for no limit) per billing period starting on BILLING_DAY of
+# the month, with OVER_BUDGET 'warn' or 'refuse' for files that would exceed it. Outside the OFF_PEAK (start, end)
+# minutes of the day international fetches of DEFER_SIZE bytes or more are queued for --fetch-deferred.
+BUDGET = 0
+BILLING_DAY = 1
+OVER_BUDGET = 'warn'
+OFF_PEAK = None
+DEFER_SIZE = 0
+SIOCGIFADDR = 0x8915
+NETLINK_ROUTE = 0
+RTMGRP_LINK = 0x1
+RTMGRP_IPV4_IFADDR = 0x10
+# aria2c options which apply to the whole aria2c process (not passed per download to the daemon)
+GLOBAL_ARIA_OPTIONS = [ 'server-stat-if', 'server-stat-of', 'uri-selector', 'disk-cache' ]
+# Per download aria2c tuning (see tuneOptions). Files smaller than SMALL_FILE use a single connection, larger ones
+# are split into pieces of at least MIN_PIECE bytes over at most MAX_SPLIT connections and MAX_SERVER_CONNECTIONS
+# per mirror.
+TUNE = True
+SMALL_FILE = 1024*1024
+MIN_PIECE = 2*1024*1024
+MAX_SPLIT = 16
+MAX_SERVER_CONNECTIONS = 4
+FILESYSTEMS = {}
+# Each download invocation appends a record of its stages, connection switches and bytes per mirror to
+# $GENTOOGET_DIR/telemetry.jsonl (see --report) which is rotated to telemetry.jsonl.1 at TELEMETRY_MAX_SIZE
+TELEMETRY = None
+TELEMETRY_LOCK = threading.Lock()
+TELEMETRY_MAX_SIZE = 16*1024*1024
 
 def usage():
    global VERSION
@@ -53,9 +207,19 @@ local connection.
 
 gentooget [-h --help] [-v --version] [-V --verbose] [-D --debug] [-T --true] [-c --continue]  [-u --url=]
           [-d directory=] [-f --file=] [-a --aria=] [-l --local=] [-i --international=]
+          [-I --interface=] [--link-timeout=]
+          [--daemon [--rpc-port=] [--fake-rpc]] [--socket=] [--no-daemon]
+          [--mirror-stats] [--report] [--batch= [--jobs=]]
+          [--manifest=] [--digest=] [--size=]
+          [--serve= [--port=] [--connections=]] [--no-internal]
+          [--miss-ttl=] [--probe [--probe-timeout=]] [--no-tune] [--engine=] [--make-conf=]
+          [--budget= [--billing-day=] [--over-budget=]] [--off-peak= [--defer-size=]] [--fetch-deferred]
+          [--delta] [--make-index=] [--hedge= [--hedge-rate=]]
      -T --true           : Always return success even if a download fails.
      -h --help           : Display help.
      -c --continue       : Continue download (if not specified then existing file will be overwritten)
+                           A partial download with an aria2 control file (.aria2) is always continued from
+                           the pieces already done, whichever mirrors (or connection) are used to finish it.
                            Specify this in the RESUMECOMMAND variable in make.conf
      -w --downman        : Attempt to use Downman if the package is not found anywhere else.
      -u --url=           : The url of the file to be downloaded. This should be passed as ${URI}
@@ -70,6 +234,90 @@ gentooget [-h --help] [-v --version] [-V --verbose] [-D --debug] [-T --true] [-c
      -I --interface=     : The interface being switched by --local/--international (defaults to ppp0)
                            If it is not ppp0 then it must be specified otherwise gentooget cannot
                            check to see if the interface is up before continuing download.
+     --link-timeout=     : Seconds to wait for the interface to come up after switching connection
+                           (default 120). The download fails if it does not.
+     --daemon            : Run as a fetch daemon which owns a single aria2c --enable-rpc instance and
+                           accepts downloads from other gentooget invocations over a Unix socket.
+                           This avoids starting a new aria2c (and new mirror connections) per file.
+                           Only the daemon's user (eg. root) and the portage group can use its socket.
+     --rpc-port=         : The local port the daemon's aria2c listens on for JSON-RPC (default 6800).
+     --fake-rpc          : The daemon uses an in-process stand-in for the aria2 RPC server which
+                           fetches files using urllib2 (for testing without aria2c).
+     --socket=           : The Unix socket used to talk to the daemon (default $GENTOOGET_DIR/gentooget.sock).
+                           If a daemon is listening on the socket downloads are submitted to it,
+                           otherwise aria2c is run directly.
+     --no-daemon         : Always run aria2c directly even if a daemon is running.
+     --mirror-stats      : Display the measured mirror speeds and failures used to order mirrors.
+     --report            : Display throughput and bytes downloaded by tier (internal, local, international,
+                           downman), by mirror and by day, with connection switch counts and times, from
+                           the downloads recorded in $GENTOOGET_DIR/telemetry.jsonl.
+     --batch=            : Download all the files listed in the given file ('-' for stdin) instead of a
+                           single -u/-f file. Each line is either "URI [URI...] filename" or the output of
+                           emerge -pf (eg. emerge -pf @world | gentooget --batch=-). Each stage (internal,
+                           local, international, downman) fetches every file still missing with a single
+                           aria2c so the connection is switched at most once for the whole batch.
+     --jobs=             : Number of files downloaded at the same time in --batch mode (default 5).
+     --manifest=         : Manifest to take the size and digests of the file from (may be repeated). If not
+                           given the Manifest of the ebuild being fetched is used when Portage exports
+                           EBUILD, O or CATEGORY/PN. Downloaded files are verified against it and a file
+                           with a bad digest is fetched again from one mirror at a time until a good copy
+                           is found. An already complete and verified file is not downloaded again.
+     --digest=           : Expected digest as ALGORITHM:HEX eg. SHA512:9a8b... (may be repeated).
+     --size=             : Expected size in bytes.
+     --serve=            : Serve the given distfiles directory over HTTP for use as an INTERNAL_MIRRORS
+                           entry (eg. INTERNAL_MIRRORS="http://buildhost:8080"). Supports ranges and
+                           keep-alive and sends files with sendfile. A file that is not in the directory
+                           is downloaded once through the normal mirror chain (using the other options
+                           given, eg. -l/-i) and served to every later client from the directory.
+                           If the directory has a layout.conf (eg. "[structure]" and "0=filename-hash BLAKE2B 8")
+                           fetched files are stored in hashed subdirectories and clients are told the layout.
+     --port=             : Port for --serve (default 8080).
+     --connections=      : Maximum number of connections --serve handles at the same time (default 64).
+     --no-internal       : Do not try INTERNAL_MIRRORS.
+     --miss-ttl=         : Seconds to remember that a mirror does not have a file (default 43200, 0 disables).
+     --probe             : Before downloading from the internal and local mirrors check which of them
+                           have the file with HEAD (http) or SIZE (ftp) requests sent to all of them at
+                           once, and only download from those that do. Mirrors that do not have the file
+                           are remembered as for --miss-ttl.
+     --probe-timeout=    : Seconds allowed for --probe (default 1.5). Mirrors that have not answered by
+                           then are used only if no mirror is known to have the file.
+     --no-tune           : Use aria2c's own split, connection and file allocation settings instead of choosing
+                           them from the file size, the number of (fast) mirrors and the filesystem.
+     --engine=           : Download engine: aria2 (aria2c, or the daemon if one is running), native (in
+                           process parallel range requests across the mirrors, resuming aria2's partial
+                           downloads and vice versa) or auto (default: aria2 if aria2c is installed).
+     --make-conf=        : Portage configuration file or directory to read the mirror variables from instead
+                           of /etc/make.conf and /etc/portage/make.conf (may be repeated).
+     --budget=           : International bytes allowed per billing period (eg. 20G). Files that would go over
+                           it are fetched with a warning or refused (see --over-budget). Smaller files are
+                           fetched first so that the budget covers as many files as possible.
+     --billing-day=      : Day of the month the billing period for --budget starts (default 1).
+     --over-budget=      : warn (default) or refuse international downloads that would exceed --budget.
+     --off-peak=         : Off-peak window for the international connection eg. 23:00-06:00. Outside it,
+                           international downloads of at least --defer-size bytes are not made but queued
+                           for --fetch-deferred.
+     --defer-size=       : Smallest file (by its Manifest or --size) deferred to the off-peak window (default 0,
+                           every file).
+     --fetch-deferred    : Download all the files queued for the directory (-d) with a single switch to
+                           international (eg. from cron during the off-peak window).
+     --delta             : Before downloading a file that is not there yet look for an earlier version of it
+                           in the directory (eg. linux-6.1.tar for linux-6.2.tar) and, if an internal or local
+                           mirror publishes a block index of the new file (<file>.zsync.json), copy the blocks
+                           the two share and only download the rest. --serve publishes indexes of the files it
+                           has. Compressed tarballs rarely share blocks unless compressed with --rsyncable.
+                           Earlier versions over 256MB are not used, and the search gives up after a few
+                           seconds if little of the earlier version matches.
+     --make-index=       : Write the block index <file>.zsync.json of the given file (for mirrors publishing
+                           indexes for --delta) and exit.
+     --hedge=            : Seconds an internal mirror download may go without delivering anything (or
+                           --hedge-rate) before the local stage (the file's own uri if it is not on the
+                           mirrors) is started alongside it, so a hung internal mirror or a slow not found
+                           does not hold up every download. Whichever finishes first is kept and the other
+                           is stopped. If both fail the one that got further is continued by later stages.
+                           The local stage is not hedged as the stage after it, international, would switch
+                           the link away from local downloads and is billed.
+     --hedge-rate=       : Bytes a second (eg. 200K) the internal download must keep up over each --hedge
+                           seconds (default 0, anything). aria2c reports progress in whole pieces (1MB).
 
 Enviroment Variables
 ====================
@@ -89,6 +337,11 @@ Example: INTERNAL_MIRRORS="ftp://192.168.0.1/portage"
 Internal mirrors are currently assumed to be on a different interface eg eth1 as opposed to ppp0
 therefore no connection switching is applied before internal fetches. 
 
+GENTOOGET_DIR         : Directory for state shared between gentooget invocations such as the daemon
+                        socket (defaults to /var/tmp/gentooget). It is created writable only by its
+                        owner and the portage group, so that root and portage share it, and is not
+                        used if anyone else could write to it.
+
 Files
 =====
 ~/GENTOO_MIRRORS
@@ -99,11 +352,60 @@ GENTOO_MIRRORS="http://ftp.heanet.ie/pub/gentoo/ ftp://ftp.is.co.za//mirror/ftp.
 LOCAL_MIRRORS="ftp://ftp.is.co.za//mirror/ftp.gentoo.org ftp://ftp.up.ac.za/mirrors/gentoo.org/gentoo"
 INTERNATIONAL_MIRRORS="http://ftp.heanet.ie/pub/gentoo/ ftp://mirrors.rit.edu/gentoo/"
 
-/etc/make.conf
+$GENTOOGET_DIR/mirrorstats.json
+Download speed and failures per mirror recorded from aria2's server statistics after every download.
+Mirrors are ordered fastest first using these (older measurements count for less) and aria2 is told the
+speeds so that it takes more segments from faster mirrors. A mirror that fails 3 times in a row is
+skipped for an hour.
+
+$GENTOOGET_DIR/link.json
+Which connection (local or international) is up and which gentooget processes are using it. Concurrent
+gentooget processes (eg. parallel-fetch or several emerges) share the international connection: the first
+download that needs it switches to international, later ones use it as is and the connection is only
+switched back to local when the last international download finishes. Local downloads wait until then
+(and new local downloads wait while a download is waiting for international). The local script is not
+run if the connection is already local and the interface is up.
+
+$GENTOOGET_DIR/digests/
+Digests of verified files keyed by device, inode, size and modification time so that an unchanged file
+is never hashed twice, spread by inode over 256 files so that each check only reads a small one. BLAKE2B
+digests are only checked if the pyblake2 module is installed (SHA512 is always available).
+
+$GENTOOGET_DIR/misses.json
+Urls which recently failed with not found and files known not to be on any local mirror. These urls are
+left out (and the local connection is not used for such files) until the entry is --miss-ttl seconds old,
+so a re-emerge or resume goes straight to where the file is.
+
+$GENTOOGET_DIR/telemetry.jsonl
+One JSON record per download run: the time taken and bytes downloaded in each stage (internal, local,
+international, downman), bytes per mirror (shared between mirrors by the speeds aria2 reports), aria2 exit
+statuses, connection switch and wait times and work saved by the caches. Summarised by --report. When it
+reaches 16MB it is moved to telemetry.jsonl.1 (replacing the previous one).
+
+$GENTOOGET_DIR/budget.json, $GENTOOGET_DIR/deferred.json
+Bytes downloaded over the international connection in the current billing period (see --budget) and the
+files waiting for --fetch-deferred.
+
+$GENTOOGET_DIR/layouts.json
+The distfiles layout of each mirror from its distfiles/layout.conf (eg. filename-hash BLAKE2B 8, where
+foo.tar.gz is at distfiles/<first 2 hex digits of its BLAKE2B>/foo.tar.gz) kept for a day. Hashed layouts
+using BLAKE2B need the pyblake2 module, without it the mirror's flat layout is used. Mirrors whose
+layout.conf cannot be fetched are tried in both layouts (flat only without BLAKE2B) and asked again after
+10 minutes.
+
+$GENTOOGET_DIR/gentooget.<uid>.<id>.pyc
+gentooget.py compiled by gentoogetfast.py (see make.conf below), compiled again when gentooget.py changes.
+
+/etc/make.conf, /etc/portage/make.conf
 This is the Portage make.conf file. It should include the GENTOO_MIRRORS variable and optionally
 the LOCAL_MIRRORS and INTERNATIONAL_MIRRORS variables if local/international access is used and these
-are not specified as environment variables or in ~/GENTOO_MIRRORS.
+are not specified as environment variables or in ~/GENTOO_MIRRORS. Either may be a directory of files.
+They are read like bash would (quoting, multi-line values, ${VAR} and source) and the result is kept in
+$GENTOOGET_DIR/config.<uid>.json so that they are only read again after one of them changes.
 Additionally the FETCHCOMMAND and RESUMECOMMAND variables must be changed to use gentooget.
+Portage runs the command once per file, so the gentoogetfast.py launcher installed alongside gentooget.py
+can be used in its place (with the same options). It runs gentooget.py without compiling it every time
+and is typically about 50ms quicker to start aria2c.
 
 Example make.conf (only showing entries pertinent to gentooget)
 FETCHCOMMAND="/usr/bin/gentooget.py -V -D -d '${DISTDIR}' -f '${FILE}' -u '${URI}'"
@@ -141,7 +443,9 @@ def printErr(message):
 #   print(red() + message, file=sys.stderr)
 
 def main(argv=None):
-   global  VERSION, VERBOSE, DEBUG, GENTOO_MIRRORS, INTERNATIONAL_MIRRORS, LOCAL_MIRRORS, INTERNAL_MIRRORS
+   global  VERSION, VERBOSE, DEBUG, GENTOO_MIRRORS, INTERNATIONAL_MIRRORS, LOCAL_MIRRORS, INTERNAL_MIRRORS, \
+           DAEMON_SOCKET, RPC_PORT, LINK_TIMEOUT, MISS_TTL, PROBE, PROBE_TIMEOUT, MAKE_CONF, BUDGET, BILLING_DAY, \
+           OVER_BUDGET, OFF_PEAK, DEFER_SIZE, TUNE, ENGINE, DELTA, HEDGE, HEDGE_RATE
    if argv is None:
       argv = sys.argv
    try:
@@ -150,7 +454,12 @@ def main(argv=None):
       try:
          opts, args = getopt.getopt(argv[1:],  "hvVDTwcu:d:f:a:l:i:I:",
             ['help', 'version', 'verbose', 'debug', 'true', 'downman', "continue","url=", "directory=", "file=",
-            "aria=", 'local=', 'international=', 'interface=' ])
+            "aria=", 'local=', 'international=', 'interface=', 'daemon', 'rpc-port=', 'fake-rpc', 'socket=',
+            'no-daemon', 'mirror-stats', 'batch=', 'jobs=', 'link-timeout=', 'manifest=', 'digest=', 'size=',
+            'serve=', 'port=', 'connections=', 'no-internal', 'miss-ttl=', 'probe',
+            'probe-timeout=', 'make-conf=', 'report', 'budget=', 'billing-day=', 'over-budget=', 'off-peak=',
+            'defer-size=', 'fetch-deferred', 'no-tune', 'engine=', 'delta',
+            'make-index=', 'hedge=', 'hedge-rate=' ])
       except getopt.error, e:
 #         except getopt.error as e: #Python 3
          printErr("%s"%str(e))
@@ -166,6 +475,18 @@ def main(argv=None):
       alwaysSucceed = False
       useDownman = False
       mustSwitch = False
+      runAsDaemon = False
+      batch = None
+      concurrency = 5
+      manifests = []
+      digests = {}
+      serve = None
+      makeConf = []
+      fetchDeferred = False
+      port = 8080
+      connections = 64
+      useInternal = True
+      fakeRpc = False
       dir = '/usr/portage/distfiles'
       for opt, arg in opts:
          if opt in ("-h", "--help"):
@@ -218,19 +539,196 @@ def main(argv=None):
                sys.exit(1)
          elif opt in ("-I", "--interface"):
                interface = arg
-      
+         elif opt == "--daemon":
+            runAsDaemon = True
+         elif opt == "--rpc-port":
+            try:
+               RPC_PORT = int(arg)
+            except ValueError:
+               printErr('ERROR: Invalid RPC port ' + arg)
+               sys.exit(1)
+         elif opt == "--fake-rpc":
+            fakeRpc = True
+         elif opt == "--socket":
+            DAEMON_SOCKET = arg
+         elif opt == "--no-daemon":
+            DAEMON_SOCKET = None
+         elif opt == "--mirror-stats":
+            printMirrorStats()
+            sys.exit(0)
+         elif opt == "--report":
+            printReport()
+            sys.exit(0)
+         elif opt == "--link-timeout":
+            try:
+               LINK_TIMEOUT = int(arg)
+            except ValueError:
+               printErr('ERROR: Invalid link timeout ' + arg)
+               sys.exit(1)
+         elif opt == "--manifest":
+            manifests.append(arg)
+         elif opt == "--digest":
+            p = arg.find(':')
+            if p <= 0:
+               printErr('ERROR: Digest should be ALGORITHM:HEX eg. SHA512:9a8b... not ' + arg)
+               sys.exit(1)
+            digests[arg[:p].upper()] = arg[p+1:].lower()
+         elif opt == "--size":
+            try:
+               digests['size'] = int(arg)
+            except ValueError:
+               printErr('ERROR: Invalid size ' + arg)
+               sys.exit(1)
+         elif opt == "--serve":
+            serve = arg
+         elif opt in ("--port", "--connections"):
+            try:
+               value = int(arg)
+            except ValueError:
+               value = 0
+            if value < 1:
+               printErr('ERROR: Invalid %s %s' % (opt, arg))
+               sys.exit(1)
+            if opt == "--port":
+               port = value
+            else:
+               connections = value
+         elif opt == "--no-internal":
+            useInternal = False
+         elif opt == "--miss-ttl":
+            try:
+               MISS_TTL = int(arg)
+            except ValueError:
+               printErr('ERROR: Invalid miss TTL ' + arg)
+               sys.exit(1)
+         elif opt == "--probe":
+            PROBE = True
+         elif opt == "--probe-timeout":
+            try:
+               PROBE_TIMEOUT = float(arg)
+            except ValueError:
+               printErr('ERROR: Invalid probe timeout ' + arg)
+               sys.exit(1)
+         elif opt == "--make-conf":
+            makeConf.append(arg)
+         elif opt == "--no-tune":
+            TUNE = False
+         elif opt == "--engine":
+            if not arg in ('auto', 'aria2', 'native'):
+               printErr('ERROR: Invalid engine ' + arg + ' (auto, aria2 or native)')
+               sys.exit(1)
+            ENGINE = arg
+         elif opt == "--delta":
+            DELTA = True
+         elif opt == "--hedge":
+            try:
+               HEDGE = float(arg)
+            except ValueError:
+               HEDGE = -1
+            if HEDGE <= 0:
+               printErr('ERROR: Invalid hedge deadline ' + arg + ' (seconds)')
+               sys.exit(1)
+         elif opt == "--hedge-rate":
+            try:
+               HEDGE_RATE = parseSize(arg)
+            except ValueError:
+               printErr('ERROR: Invalid hedge rate %s (bytes a second eg. 50000, 200K)' % (arg,))
+               sys.exit(1)
+         elif opt == "--make-index":
+            try:
+               fd = open(arg + DELTA_SUFFIX + '.tmp', 'w')
+               try:
+                  json.dump(makeIndex(arg), fd)
+               finally:
+                  fd.close()
+               os.rename(arg + DELTA_SUFFIX + '.tmp', arg + DELTA_SUFFIX)
+            except (IOError, OSError), e:
+               printErr('ERROR: Could not index %s (%s)' % (arg, str(e)))
+               sys.exit(1)
+            sys.exit(0)
+         elif opt in ("--budget", "--defer-size"):
+            try:
+               value = parseSize(arg)
+            except ValueError:
+               printErr('ERROR: Invalid %s %s (eg. 500000, 200K, 1.5G)' % (opt, arg))
+               sys.exit(1)
+            if opt == "--budget":
+               BUDGET = value
+            else:
+               DEFER_SIZE = value
+         elif opt == "--billing-day":
+            try:
+               BILLING_DAY = int(arg)
+            except ValueError:
+               BILLING_DAY = 0
+            if not 1 <= BILLING_DAY <= 31:
+               printErr('ERROR: Invalid billing day ' + arg)
+               sys.exit(1)
+         elif opt == "--over-budget":
+            if not arg in ('warn', 'refuse'):
+               printErr('ERROR: --over-budget should be warn or refuse not ' + arg)
+               sys.exit(1)
+            OVER_BUDGET = arg
+         elif opt == "--off-peak":
+            try:
+               OFF_PEAK = parseWindow(arg)
+            except ValueError:
+               printErr('ERROR: Invalid off-peak window %s (eg. 23:00-06:00)' % (arg,))
+               sys.exit(1)
+         elif opt == "--fetch-deferred":
+            fetchDeferred = True
+         elif opt == "--batch":
+            batch = arg
+         elif opt == "--jobs":
+            try:
+               concurrency = int(arg)
+            except ValueError:
+               concurrency = 0
+            if concurrency < 1:
+               printErr('ERROR: Invalid number of jobs ' + arg)
+               sys.exit(1)
+
+      if len(makeConf) > 0:
+         MAKE_CONF = makeConf
+      if runAsDaemon:
+         if DAEMON_SOCKET is None:
+            printErr('ERROR: --daemon and --no-daemon are mutually exclusive')
+            sys.exit(1)
+         sys.exit(runDaemon(options[0], DAEMON_SOCKET, RPC_PORT, dir, fakeRpc))
+      if not serve is None:
+         # Misses are fetched by running gentooget with the same options (except those for the server and
+         # the file), without internal mirrors as this server is probably one of them.
+         fetchArgs = fetchUrl = None
+         mirrors = readMirrors() + readMirrors('LOCAL_MIRRORS')
+         if len(mirrors) > 0:
+            fetchUrl = mirrors[0].rstrip('/') + '/distfiles/'
+            fetchArgs = [sys.executable, os.path.abspath(argv[0]), '--no-internal']
+            for opt, arg in opts:
+               if not opt in ('--serve', '--port', '--connections', '-d', '--directory', '-f', '--file', '-u',
+                              '--url', '-h', '--help'):
+                  fetchArgs.append(opt)
+                  if arg != '':
+                     fetchArgs.append(arg)
+         sys.exit(serveDistfiles(serve, port, connections, fetchArgs, fetchUrl))
       if not '-d' in options:
          options.append("-d")
          options.append(dir)
-      if url is None:
+      if not batch is None and (not url is None or not name is None):
+         printErr('ERROR: --batch downloads the files listed in the batch file so -u and -f are not used')
+         sys.exit(1)
+      if fetchDeferred and (not batch is None or not url is None or not name is None):
+         printErr('ERROR: --fetch-deferred downloads the queued files so --batch, -u and -f are not used')
+         sys.exit(1)
+      if url is None and batch is None and not fetchDeferred:
          printErr('ERROR: No url specified')
          sys.exit(1)
-      if not '-o' in options:
+      if not '-o' in options and batch is None and not fetchDeferred:
          printErr('ERROR: No output filename specified')
          sys.exit(1)
       if not '-c' in options:
          options.append('--allow-overwrite=true')
-      fullPath = os.path.join(dir, name)
+      if not name is None:
+         fullPath = os.path.join(dir, name)
       mustSwitch = not local is None and not international is None
       if local is None and not international is None:
          printErr("If a international script (%s) is specified then a local script must also be specified"
@@ -244,17 +742,19 @@ def main(argv=None):
          print(concatOpts(argv))
       # @type mirrors list      
       GENTOO_MIRRORS = readMirrors()
-      INTERNAL_MIRRORS = readMirrors('INTERNAL_MIRRORS')
+      INTERNAL_MIRRORS = []
+      if useInternal:
+         INTERNAL_MIRRORS = readMirrors('INTERNAL_MIRRORS')
       if mustSwitch:
          LOCAL_MIRRORS = readMirrors('LOCAL_MIRRORS')
          if LOCAL_MIRRORS is None or len(LOCAL_MIRRORS) == 0:
             printErr("ERROR: No local mirrors found (checked env variable LOCAL_MIRRORS, file " \
-            + os.path.expanduser('~') + os.path.sep + 'GENTOO_MIRRORS' + ' and file /etc/make.conf)')
+            + os.path.expanduser('~') + os.path.sep + 'GENTOO_MIRRORS' + ' and make.conf)')
             sys.exit(1)
          INTERNATIONAL_MIRRORS = readMirrors('INTERNATIONAL_MIRRORS')
          if INTERNATIONAL_MIRRORS is None or len(INTERNATIONAL_MIRRORS) == 0:
             printErr("ERROR: No international mirrors found (checked env variable INTERNATIONAL_MIRRORS, file " \
-            + os.path.expanduser('~') + os.path.sep + 'GENTOO_MIRRORS' + ' and file /etc/make.conf)')
+            + os.path.expanduser('~') + os.path.sep + 'GENTOO_MIRRORS' + ' and make.conf)')
             sys.exit(1)
          mirrors = LOCAL_MIRRORS
          if VERBOSE:
@@ -266,140 +766,1605 @@ def main(argv=None):
          if (mirrors is None or len(mirrors) == 0) and \
             (INTERNAL_MIRRORS is None or len(INTERNAL_MIRRORS) == 0):
             printErr("WARNING: No mirrors found (checked env variable GENTOO_MIRRORS, file " \
-            + os.path.expanduser('~') + os.path.sep + 'GENTOO_MIRRORS' + ' and file /etc/make.conf)')
+            + os.path.expanduser('~') + os.path.sep + 'GENTOO_MIRRORS' + ' and make.conf)')
+
+      if fetchDeferred:
+         OFF_PEAK = None # Whatever the time
+         queue = deferredJobs(dir)
+         if len(queue) == 0:
+            print('No deferred downloads for ' + dir)
+            sys.exit(0)
+         startTelemetry('batch', len(queue), engineName(options))
+         # All the queued files are fetched in one batch so the connection is switched once
+         jobs = [ [ name, entry['urls'] ] for name, entry in queue ]
+         expected = dict([ (name, entry['expected']) for name, entry in queue ])
+         failed = fetchBatch(options, jobs, dir, concurrency, mirrors, mustSwitch, local, international, interface,
+                             useDownman, expected)
+         done = [ name for name, entry in queue if os.path.exists(os.path.join(dir, name)) and
+                  not os.path.exists(os.path.join(dir, name) + '.aria2') ]
+         def update(queue):
+            for name in done:
+               if name in queue:
+                  del queue[name]
+         updateState('deferred.json', update, 0640)
+         finishTelemetry(min(failed, 1), failed)
+         if alwaysSucceed or failed == 0:
+            sys.exit(0)
+         sys.exit(1)
+
+      if not batch is None:
+         try:
+            jobs = readBatch(batch)
+         except IOError, e:
+            printErr('ERROR: Could not read batch file %s (%s)' % (batch, str(e)))
+            sys.exit(1)
+         expected = {}
+         for job in jobs:
+            expected[job[0]] = expectedDigests(job[0], manifests, {})
+         startTelemetry('batch', len(jobs), engineName(options))
+         failed = fetchBatch(options, jobs, dir, concurrency, mirrors, mustSwitch, local, international,
+                             interface, useDownman, expected)
+         finishTelemetry(min(failed, 1), failed)
+         if alwaysSucceed or failed == 0:
+            sys.exit(0)
+         sys.exit(1)
+
+      startTelemetry('single', 1, engineName(options))
+      expected = expectedDigests(name, manifests, digests)
+      # A file with a control file is a partial download, possibly already allocated at full size
+      if len(expected) > 0 and os.path.exists(fullPath) and not os.path.exists(fullPath + '.aria2') and \
+         verifyFile(fullPath, expected):
+         countCache('complete')
+         if VERBOSE:
+            print(green() + '%s is already complete' % (fullPath,))
+         sys.exit(0)
+      if DELTA:
+         deltaSeed(name, dir, expected, INTERNAL_MIRRORS + mirrors)
 
       urlStart = len(options)
       uo = urlparse(url)      
       address = uo.netloc
       status = 1
+      misses = knownMisses(name)
+      internal = None # The internal download if it stalled and is carrying on alongside the local stage (--hedge)
       # Try internal first if there are any
       if not INTERNAL_MIRRORS is None and len(INTERNAL_MIRRORS) > 0:
-         for mirror in INTERNAL_MIRRORS:
-            newUrl = mirror + '/distfiles/' + name
-            options.append(newUrl)
-         if DEBUG:
-            print(green() + 'Using internal mirror:')
-            print(concatOpts(options))
-         status = download(options, fullPath)
-      if status != 0: # Next try local or default if not using local/international switching
-         if mustSwitch:
-         # If using using local/international switching start in local
-            ip = switchConnection(local, interface)
-            if ip is None:
-               printErr('Error: Could not switch to local connection using %s (checking interface %s)' %
-               (local, interface))
-               sys.exit(1)
+         options.extend(probeTiers({ name: mirrorUris(INTERNAL_MIRRORS, name, misses) })[name])
+         if len(options) > urlStart:
+            if DEBUG:
+               print(green() + 'Using internal mirror:')
+               print(concatOpts(options))
+            stage = beginStage('internal', 1)
+            if HEDGE > 0:
+               internal = Transfer(list(options), fullPath, expected, stage)
+               if internal.stalled(HEDGE, HEDGE_RATE):
+                  status = None # Decided once the local stage (if any) has raced it
+                  if VERBOSE:
+                     print(yellow() + 'Internal mirrors are too slow, trying the next tier alongside')
+               else:
+                  status = internal.status
+                  internal = None
             else:
-               if VERBOSE:
-                  print("Switched to local connection using IP " + ip)
-         isMirror = appendMirrors(url, address, name, options, mirrors)
-         if DEBUG:
-            print(green() + concatOpts(options))
-         if mustSwitch:
-            if isMirror: #External url is probably not local
-               if DEBUG:
-                  print(green() + 'Using local mirror')
-               status = download(options, fullPath)
+               status = download(options, fullPath, expected)
+            if internal is None:
+               endStage(stage, int(status == 0))
+               recordMisses(name, options[urlStart:], status)
          else:
-            status = download(options, fullPath)
+            countCache('skipped')
+            if DEBUG:
+               print(yellow() + 'Internal mirrors are known not to have ' + name)
+      if status != 0 and mustSwitch and '@local' in misses:
+         countCache('skipped')
+         if VERBOSE:
+            print(yellow() + '%s is known not to be on the local mirrors' % (name,))
+      elif status != 0: # Next try local or default if not using local/international switching
+         options = options[0:urlStart]
+         # With switching this is only whether there is anything to try: the uris are built and probed once switched
+         # to local, where the local mirrors' layout.conf can be fetched and the local mirrors reached
+         isMirror = appendMirrors(url, address, name, options, mirrors, misses, not mustSwitch)
+         if isMirror and not mustSwitch:
+            options[urlStart:] = probeTiers({ name: options[urlStart:] })[name]
+         # Only switch to local if there is something left to try there
+         if len(options) > urlStart and (isMirror or not mustSwitch):
+            if mustSwitch:
+            # If using using local/international switching start in local
+               ip = acquireLink('local', local, interface)
+               if ip is None:
+                  printErr('Error: Could not switch to local connection using %s (checking interface %s)' %
+                  (local, interface))
+                  if not internal is None:
+                     internal.cancel()
+                     internal.join()
+                  sys.exit(1)
+               else:
+                  if VERBOSE:
+                     print("Switched to local connection using IP " + ip)
+               options = options[0:urlStart]
+               appendMirrors(url, address, name, options, mirrors, misses)
+               options[urlStart:] = probeTiers({ name: options[urlStart:] }, 'local')[name]
+            if DEBUG:
+               print(green() + concatOpts(options))
+            try:
+               if len(options) == urlStart: # The probe found that none of the local mirrors have it
+                  countCache('skipped')
+               else:
+                  stage = beginStage('local', 1)
+                  if mustSwitch and DEBUG:
+                     print(green() + 'Using local mirror')
+                  if internal is None:
+                     status = download(options, fullPath, expected)
+                     cancelled = False
+                  else:
+                     transfer = hedge(internal, options, fullPath, expected, stage)
+                     status = transfer.status
+                     if internal.status == 0:
+                        status = 0
+                     cancelled = transfer.cancelled # The internal download won so the local stage served nothing
+                  if cancelled:
+                     endStage(stage, 0)
+                  elif mustSwitch:
+                     recordMisses(name, options[urlStart:], status, 'local')
+                  else:
+                     recordMisses(name, options[urlStart:], status)
+                  if not cancelled:
+                     endStage(stage, int(status == 0))
+            finally:
+               if mustSwitch:
+                  releaseLink('local', local, interface)
+         elif isMirror:
+            countCache('skipped')
+            if DEBUG:
+               print(yellow() + 'All mirrors are known not to have ' + name)
+      if not internal is None: # The stalled internal download has finished (or been cancelled by the local stage)
+         internal.join()
+         if status is None: # No local stage to race it
+            status = internal.status
+         endStage(internal.stage, int(internal.status == 0))
+         if not internal.cancelled:
+            recordMisses(name, internal.options[urlStart:], internal.status)
+      options = options[0:urlStart]
+      deferred = False
       if status != 0 and mustSwitch:
+         # Only whether there is anything to try: the uris are built once switched to international, where the
+         # international mirrors' layout.conf can be fetched
+         appendMirrors(url, address, name, options, INTERNATIONAL_MIRRORS, misses, False)
+         if len(options) > urlStart:
+            size = expected.get('size')
+            if not size is None and not controlProgress(fullPath, size) is None:
+               size -= controlProgress(fullPath, size) # Only the rest goes over international
+            fetchNow, later, refused = scheduleInternational({ name: size })
+            if len(later) > 0:
+               deferFetch(name, [url], dir, expected)
+               deferred = True
+            if len(fetchNow) == 0:
+               options = options[0:urlStart]
+      if status != 0 and mustSwitch and len(options) > urlStart:
          # If using using local/international switching try international next
          if VERBOSE:
             print(yellow() + "Downloading %s/%s failed on local connection. Attempting international" % (address, name))
-         options = options[0:urlStart]
-         appendMirrors(url, address, name, options, INTERNATIONAL_MIRRORS)
-         ip = switchConnection(international, interface) # Switch to international
+         ip = acquireLink('international', international, interface) # Switch to (or share) international
          if not ip is None:
             try:
                if VERBOSE:
                   print(green() + "Switched to international (%s) " % (ip,))
+               options = options[0:urlStart]
+               appendMirrors(url, address, name, options, INTERNATIONAL_MIRRORS, misses)
                if DEBUG:
                   print(green() + 'Using international mirror:')
                   print(green() + concatOpts(options))
-               status = download(options, fullPath)
+               stage = beginStage('international', 1)
+               status = download(options, fullPath, expected)
+               endStage(stage, int(status == 0))
+               if not stage is None:
+                  chargeBudget(stage['bytes'])
+               recordMisses(name, options[urlStart:], status)
             finally:
-               ip = switchConnection(local, interface) # Switch back to local
+               ip = releaseLink('international', local, interface) # Switch back to local if last out
                if ip is None:
                   print(red() + "Failed to switch back to local")
                   sys.exit(1)
-               if VERBOSE:
+               if VERBOSE and ip != '':
                   print(green() + "Switched to local (%s) " % (ip,))
-      if status != 0 and useDownman:
+      if status != 0 and useDownman and not deferred:
          if VERBOSE:
             print(yellow() + "Downloading %s/%s failed. Attempting Portage downman" % (address, name))
          options = options[0:urlStart]
-#         options.append("-s")
-#         options.append('1').
          options.append('http://www.voidspace.org.uk/cgi-bin/voidspace/downman.py?file=' + name)
          if DEBUG:
             print(green() + 'Using downman:')
             print(green() + concatOpts(options))
-         status = download(options, fullPath)
+         stage = beginStage('downman', 1)
+         status = download(options, fullPath, expected)
+         endStage(stage, int(status == 0))
+      finishTelemetry(status)
       if alwaysSucceed:
          sys.exit(0)
       sys.exit(status)
+   except SystemExit, e: # Record downloads cut short by an error exit
+      finishTelemetry(e.code or 0)
+      raise
    except getopt.error, err:
 #   except getopt.error as err:
       printErr(err)
       sys.exit(1)
 
-def download(options, fullPath):
-   if os.path.exists(fullPath + '.aria2'):
-      os.remove(fullPath + '.aria2') # If not deleted aria retries using the last failed url regardless of the specified urls
-   status = subprocess.call(options)
+def download(options, fullPath, expected=None, transfer=None):
+   size = None
+   if not expected is None:
+      size = expected.get('size')
+   status = fetch(options, fullPath, size, transfer)
+   if status == 0 and not verifyFile(fullPath, expected):
+      # aria2 mixes segments from all the mirrors so fetch from one mirror at a time to find a good copy
+      os.remove(fullPath)
+      uris = ariaRpcOptions(options)[0]
+      base = [ opt for opt in options if not opt in uris ]
+      for uri in uris:
+         if not transfer is None and transfer.cancelled:
+            break
+         if VERBOSE:
+            print(yellow() + 'Retrying %s from %s' % (os.path.basename(fullPath), uri))
+         status = fetch(base + [uri], fullPath, size, transfer)
+         if status == 0:
+            if verifyFile(fullPath, expected):
+               return 0
+            recordMirrorStats([uri], {}, DIGEST_MISMATCH)
+         if os.path.exists(fullPath):
+            os.remove(fullPath)
+      return DIGEST_MISMATCH
+   return status
+
+def fetch(options, fullPath, size=None, transfer=None):
+   # A partial download (eg. from an interrupted emerge or a failed local stage) is continued from its aria2
+   # control file with whatever uris are given now, as the control file only records which pieces are done.
+   # It is only deleted if it does not match the file.
+   if os.path.exists(fullPath + '.aria2') and controlProgress(fullPath, size) is None:
+      os.remove(fullPath + '.aria2')
+   resumed = 0
+   if os.path.exists(fullPath + '.aria2') or '-c' in options:
+      resumed = fileProgress(fullPath)
+      if VERBOSE and resumed > 0:
+         print(green() + 'Resuming %s from %d bytes' % (os.path.basename(fullPath), resumed))
+   uris = ariaRpcOptions(options)[0]
+   tuned = tuneOptions(size, uris, os.path.dirname(fullPath))
+   if DEBUG and len(tuned) > 0:
+      print(green() + 'Tuned: ' + concatOpts(tuned))
+   options = options + tuned
+   servers = {}
+   start = time.time()
+   status = None
+   if engineName(options) == 'aria2':
+      status = daemonDownload(options, servers, transfer)
+   if status is None: # No daemon running so use a private aria2c (or the native engine)
+      status, servers = runEngine(options, transfer)
+   stage = None
+   if not transfer is None:
+      stage = transfer.stage
+   if transfer is None or not transfer.cancelled: # Mirrors cut off by a cancel have neither failed nor finished
+      recordMirrorStats(uris, servers, status)
+   countTransfer(uris, servers, max(0, fileProgress(fullPath) - resumed), status, time.time() - start, stage)
    if not os.path.exists(fullPath):
+      if status != 0:
+         return status # Keep aria2's reason (eg. NOT_FOUND)
       return 1
    if os.path.getsize(fullPath) == 0:
       return 2
    return status
 
-def readMirrors(var = 'GENTOO_MIRRORS'):
-   mirrors = []
-   s = os.environ.get(var)
-   if not s is None and len(s.strip()) > 0:
-      mirrors = s.split(' ')
-   if mirrors is None or len(mirrors) == 0:
-      filename = os.path.expanduser('~') + os.path.sep + 'GENTOO_MIRRORS'
-      if os.path.isfile(filename):
-         mirrors = getFileVar(filename, var)
-      if mirrors is None or len(mirrors) == 0:
-         if os.path.isfile('/etc/make.conf'):
-            mirrors = getFileVar('/etc/make.conf', var)
-         else:
-            printErr('/etc/make.conf not found !')
-   return mirrors
+class Transfer:
+   # A download (see download()) run in a thread so that it can be raced against the next stage's with --hedge
+   # and cancelled. Each engine attaches how to stop it (the private aria2c, the daemon connection or the native
+   # downloader, all of which keep the partial download when stopped) and how many bytes it has, by default from
+   # the control file which they all save every second, and how to kill it if it will not stop (a private aria2c).
+   def __init__(self, options, fullPath, expected, stage):
+      self.options = options
+      self.fullPath = fullPath
+      self.expected = expected
+      self.stage = stage
+      self.lock = threading.Lock()
+      self.cancelled = False
+      self.stopper = None
+      self.measure = None
+      self.killer = None
+      self.status = None
+      self.thread = threading.Thread(target=self.run)
+      self.thread.setDaemon(True)
+      self.thread.start()
+
+   def run(self):
+      try:
+         self.status = download(self.options, self.fullPath, self.expected, self)
+      finally:
+         if self.status is None:
+            self.status = 1
+
+   def attach(self, stop, progress=None, kill=None):
+      self.lock.acquire()
+      try:
+         self.stopper = stop
+         self.measure = progress
+         self.killer = kill
+         cancelled = self.cancelled
+      finally:
+         self.lock.release()
+      if cancelled:
+         stop()
+
+   def cancel(self):
+      self.lock.acquire()
+      try:
+         self.cancelled = True
+         stop = self.stopper
+      finally:
+         self.lock.release()
+      if not stop is None:
+         stop()
+
+   def running(self):
+      return self.thread.isAlive()
+
+   def join(self):
+      # Waits for the download to end, killing it if it is still running HEDGE_STOP seconds after being cancelled,
+      # so that once this returns nothing writes to fullPath or its control file
+      start = time.time()
+      killed = False
+      while self.running():
+         if self.cancelled and not killed and time.time() - start >= HEDGE_STOP:
+            killed = True
+            self.lock.acquire()
+            try:
+               kill = self.killer
+            finally:
+               self.lock.release()
+            if not kill is None:
+               kill()
+         self.thread.join(0.5) # A timeout so that ^C is not held up
 
-def getFileVar(filename, var ='GENTOO_MIRRORS'):
+   def progress(self):
+      # Bytes downloaded so far (including any resumed from before) or None if not known yet
+      if not self.running():
+         return None
+      if self.measure is None:
+         return controlProgress(self.fullPath)
+      return self.measure()
+
+   def stalled(self, timeout, rate):
+      # Waits for the download to finish (returning False) unless it has delivered nothing by timeout seconds or
+      # less than rate bytes a second over the last timeout seconds, returning True while it carries on.
+      samples = []
+      start = time.time()
+      finished = False
+      try:
+         while self.running():
+            self.thread.join(0.5)
+            now = time.time()
+            progress = self.progress()
+            if not progress is None:
+               samples.append((now, progress))
+            if now - start < timeout or not self.running():
+               continue
+            moved = 0
+            if len(samples) > 0:
+               since = [ sample for sample in samples if sample[0] <= now - timeout ]
+               if len(since) == 0: # Progress only became known (eg. the control file appeared) within timeout
+                  since = samples[:1]
+               moved = samples[-1][1] - since[-1][1]
+            if moved <= 0 or moved < rate * timeout:
+               finished = True
+               return True
+         finished = True
+         return False
+      finally:
+         if not finished: # Interrupted
+            self.cancel()
+            self.join()
+
+def race(transfers):
+   # Waits for the first of transfers to succeed, cancelling the others. Returns it, or None if they all failed.
+   winner = None
+   try:
+      while True:
+         done = [ transfer for transfer in transfers if not transfer.running() and transfer.status == 0 ]
+         if len(done) > 0:
+            winner = done[0]
+            break
+         running = [ transfer for transfer in transfers if transfer.running() ]
+         if len(running) == 0:
+            break
+         running[0].thread.join(0.25)
+   finally:
+      for transfer in transfers:
+         if not transfer is winner:
+            transfer.cancel()
+      for transfer in transfers:
+         transfer.join()
+   return winner
+
+def hedge(first, options, fullPath, expected, stage):
+   # Runs the local stage (options) alongside the stalled internal download first, into fullPath + HEDGE_SUFFIX so
+   # that they do not write over each other. The winner ends up as fullPath. If both fail the one which got
+   # further is kept as the partial download that later stages continue. Returns the local stage's Transfer.
+   hedgePath = fullPath + HEDGE_SUFFIX
+   options = list(options)
+   options[options.index('-o') + 1] += HEDGE_SUFFIX
+   second = Transfer(options, hedgePath, expected, stage)
+   winner = race([ first, second ])
+   if VERBOSE and not winner is None:
+      print(green() + '%s won' % ({ True: 'Internal', False: 'Local' }[winner is first],))
+   keep = winner is second or (winner is None and fileProgress(hedgePath) > fileProgress(fullPath))
+   if keep:
+      for path in (fullPath, fullPath + '.aria2'):
+         if os.path.exists(path):
+            os.remove(path)
+      if os.path.exists(hedgePath):
+         os.rename(hedgePath, fullPath)
+      if os.path.exists(hedgePath + '.aria2'):
+         os.rename(hedgePath + '.aria2', fullPath + '.aria2')
+   else:
+      for path in (hedgePath, hedgePath + '.aria2'):
+         if os.path.exists(path):
+            os.remove(path)
+   return second
+
+def readControlFile(path):
+   # Parses the header of an aria2 control file: version (0 in host byte order, 1 in network byte order),
+   # extension, info hash length and info hash, piece length, total length, upload length, bitfield length
+   # and bitfield. Returns (total length, piece length, bitfield) or None if path is not the control file of
+   # a complete, non BitTorrent, header.
    fd = None
    try:
-      # @type fd file
-      fd = open(filename, "r")
-      s = fd.readline()
-      while s != '':
-         # @type s str
-         s = s.strip()
-         if s.startswith(var):
-            l = s.split('=')
-            if len(l) > 1: s = l[1] 
-            elif len(l) > 0: s = l[0]
-            else: s= ''
-            s = s.strip()
-            s = s.strip('"')
-            s = s.strip()
-            return s.split(' ')
-         s = fd.readline()
-      return []
-   except:
-      printErr('Error reading ' + filename)
+      try:
+         fd = open(path, 'rb')
+         data = fd.read()
+      except IOError:
+         return None
+   finally:
+      if not fd is None:
+         fd.close()
+   if len(data) < 10:
+      return None
+   order = '>'
+   if struct.unpack('>H', data[:2])[0] == 0:
+      order = '='
+   elif struct.unpack('>H', data[:2])[0] != 1:
+      return None
+   try:
+      extension, hashLength = struct.unpack(order + 'II', data[2:10])
+      if hashLength != 0:
+         return None
+      pieceLength, totalLength, uploadLength, bitfieldLength = struct.unpack(order + 'IQQI', data[10:34])
+   except struct.error:
+      return None
+   bitfield = data[34:34 + bitfieldLength]
+   if pieceLength == 0 or len(bitfield) != bitfieldLength or \
+      bitfieldLength != ((totalLength + pieceLength - 1) // pieceLength + 7) // 8:
+      return None
+   return totalLength, pieceLength, bitfield
+
+def writeControlFile(path, totalLength, pieceLength, bitfield):
+   # Version 1 control file in the format read by readControlFile (and aria2) with no pieces in flight
+   tmp = '%s.%d' % (path, os.getpid())
+   fd = open(tmp, 'wb')
+   try:
+      fd.write(struct.pack('>HII', 1, 0, 0) + struct.pack('>IQQI', pieceLength, totalLength, 0, len(bitfield)) +
+               bitfield + struct.pack('>I', 0))
+   finally:
+      fd.close()
+   os.rename(tmp, path)
+
+def controlProgress(fullPath, size=None):
+   # Bytes of fullPath already downloaded according to its aria2 control file, or None if it has no control
+   # file usable for resuming (of the expected size if known)
+   header = readControlFile(fullPath + '.aria2')
+   if header is None or not os.path.exists(fullPath):
+      return None
+   totalLength, pieceLength, bitfield = header
+   if not size is None and totalLength != size:
+      return None
+   pieces = sum([ bin(ord(c)).count('1') for c in bitfield ])
+   return min(totalLength, pieces * pieceLength)
+
+def fileProgress(fullPath):
+   # Bytes of fullPath downloaded so far. A file with a control file may already be allocated at full size.
+   progress = controlProgress(fullPath)
+   if progress is None:
+      if os.path.exists(fullPath):
+         return os.path.getsize(fullPath)
+      return 0
+   return progress
+
+def splitDistfile(name):
+   # (package, version, extension) of a distfile name eg. ('firefox', '115.0esr.source', '.tar.xz'), or None
+   match = re.match(DISTFILE_NAME_RE, name)
+   if match is None:
+      return None
+   return match.groups()
+
+def deltaBase(name, dir):
+   # The complete file in dir that is most likely an earlier version of name: same package and extension, the
+   # same version scheme if possible, then the newest version older than name's
+   parsed = splitDistfile(name)
+   if parsed is None:
+      return None
+   package, version, extension = parsed
+   numbers = lambda version: [ int(n) for n in re.findall(r'\d+', version) ]
+   scheme = lambda version: re.sub(r'\d+', '0', version)
+   best = None
+   try:
+      others = os.listdir(dir)
+   except OSError:
+      return None
+   for other in others:
+      path = os.path.join(dir, other)
+      candidate = splitDistfile(other)
+      if other == name or candidate is None or candidate[0] != package or candidate[2] != extension or \
+         os.path.exists(path + '.aria2') or not os.path.isfile(path) or os.path.getsize(path) > DELTA_MAX_SIZE:
+         continue
+      key = (scheme(candidate[1]) == scheme(version), numbers(candidate[1]) < numbers(version), numbers(candidate[1]))
+      if best is None or key > best[0]:
+         best = (key, path)
+   if best is None:
       return None
+   return best[1]
+
+def makeIndex(path):
+   # Block index of path for --delta: the size, block size and for each block its Adler-32 (the rolling
+   # checksum) and the first 64 bits of its MD5
+   size = os.path.getsize(path)
+   blockSize = DELTA_MIN_BLOCK
+   while size > blockSize * DELTA_BLOCKS and blockSize < NATIVE_PIECE:
+      blockSize *= 2
+   weak = []
+   strong = []
+   fd = open(path, 'rb')
+   try:
+      while True:
+         block = fd.read(blockSize)
+         if not block:
+            break
+         weak.append(zlib.adler32(block) & 0xffffffff)
+         strong.append(hashlib.md5(block).hexdigest()[:16])
+   finally:
+      fd.close()
+   return { 'version': 1, 'size': size, 'blocksize': blockSize, 'weak': weak, 'strong': strong }
+
+def fetchIndex(name, mirrors):
+   # The block index of name from the first of mirrors publishing one, or None
+   for uri in mirrorUris(mirrors, name):
+      try:
+         response = urllib2.urlopen(uri + DELTA_SUFFIX, timeout=DELTA_TIMEOUT)
+         try:
+            index = json.loads(response.read())
+         finally:
+            response.close()
+         blockSize = index['blocksize']
+         blocks = (index['size'] + blockSize - 1) // blockSize
+         if index.get('version') == 1 and NATIVE_PIECE % blockSize == 0 and \
+            len(index['weak']) == blocks and len(index['strong']) == blocks:
+            return index
+      except (urllib2.URLError, IOError, socket.error, httplib.HTTPException, ValueError, KeyError, TypeError,
+              ZeroDivisionError):
+         pass
+   return None
+
+def matchBlocks(index, data, scan=DELTA_SCAN, seconds=DELTA_SCAN_TIME):
+   # Offsets in data (a string or mmap) of the whole blocks of index found in it, by block number, or None if
+   # that takes rolling through more than scan bytes or over seconds. A rolling Adler-32 is moved through data a
+   # byte at a time, jumping a block on each match.
+   blockSize = index['blocksize']
+   blocks = {}
+   for i in range(index['size'] // blockSize):
+      blocks.setdefault(index['weak'][i], []).append(i)
+   matches = {}
+   if len(blocks) == 0 or len(data) < blockSize:
+      return matches
+   end = len(data) - blockSize
+   limit = min(end, DELTA_PROBE) # Until something matches
+   deadline = time.time() + seconds
+   position = 0
+   checksum = zlib.adler32(buffer(data, 0, blockSize)) & 0xffffffff
+   a, b = checksum & 0xffff, checksum >> 16
+   lookup = blocks.get
+   while True:
+      candidates = lookup((b << 16) | a)
+      if not candidates is None:
+         digest = hashlib.md5(buffer(data, position, blockSize)).hexdigest()[:16]
+         found = False
+         for i in candidates:
+            if index['strong'][i] == digest:
+               found = True
+               if not i in matches:
+                  matches[i] = position
+         if found:
+            limit = end
+            position += blockSize
+            if position > end:
+               break
+            if time.time() > deadline:
+               return None
+            checksum = zlib.adler32(buffer(data, position, blockSize)) & 0xffffffff
+            a, b = checksum & 0xffff, checksum >> 16
+            continue
+      if position >= limit:
+         break
+      scan -= 1
+      if scan & 0xffff == 0 and (scan <= 0 or time.time() > deadline):
+         return None
+      out = ord(data[position])
+      a = (a - out + ord(data[position + blockSize])) % 65521
+      b = (b - blockSize * out + a - 1) % 65521
+      position += 1
+   return matches
+
+def deltaSeed(name, dir, expected, mirrors):
+   # --delta: starts name in dir as a partial download (with an aria2 control file, so any stage and either
+   # engine only fetches the rest) made of the whole pieces its previous version has all the blocks of.
+   # Returns the bytes reused.
+   fullPath = os.path.join(dir, name)
+   if os.path.exists(fullPath) or os.path.exists(fullPath + '.aria2'):
+      return 0
+   base = deltaBase(name, dir)
+   if base is None:
+      return 0
+   index = fetchIndex(name, mirrors)
+   if index is None or (not expected is None and expected.get('size', index['size']) != index['size']):
+      return 0
+   start = time.time()
+   baseFd = open(base, 'rb')
+   try:
+      if os.fstat(baseFd.fileno()).st_size == 0:
+         return 0
+      data = mmap.mmap(baseFd.fileno(), 0, access=mmap.ACCESS_READ)
+   finally:
+      baseFd.close()
+   fd = None
+   try:
+      matches = matchBlocks(index, data)
+      if matches is None:
+         if VERBOSE:
+            print(yellow() + 'Gave up looking for blocks of %s in %s' % (name, os.path.basename(base)))
+         return 0
+      size = index['size']
+      blockSize = index['blocksize']
+      perPiece = NATIVE_PIECE // blockSize
+      pieces = (size + NATIVE_PIECE - 1) // NATIVE_PIECE
+      bitfield = [ 0 ] * ((pieces + 7) // 8)
+      reused = 0
+      for piece in range(pieces):
+         blocks = range(piece * perPiece, min((piece + 1) * perPiece, (size + blockSize - 1) // blockSize))
+         if len([ i for i in blocks if not i in matches ]) > 0:
+            continue
+         if fd is None:
+            fd = open(fullPath, 'wb')
+            fd.truncate(size)
+         for i in blocks:
+            fd.seek(i * blockSize)
+            fd.write(buffer(data, matches[i], blockSize))
+         bitfield[piece // 8] |= 0x80 >> (piece % 8)
+         reused += min(NATIVE_PIECE, size - piece * NATIVE_PIECE)
    finally:
       if not fd is None:
+         fd.close()
+      data.close()
+   if reused == 0:
+      return 0
+   writeControlFile(fullPath + '.aria2', size, NATIVE_PIECE, ''.join([ chr(bits) for bits in bitfield ]))
+   countCache('reused', reused)
+   if VERBOSE:
+      print(green() + 'Reusing %d of %d bytes of %s from %s (%.1fs)' % (reused, size, name, os.path.basename(base),
+                                                                     time.time() - start))
+   return reused
+
+def engineName(options):
+   if ENGINE == 'auto':
+      if os.access(options[0], os.X_OK):
+         return 'aria2'
+      return 'native'
+   return ENGINE
+
+def runEngine(options, transfer=None):
+   # Runs the download described by an aria2c command line (as built by main()) with the selected engine.
+   # Returns the exit status (aria2's codes) and the per mirror speeds.
+   if engineName(options) == 'native':
+      return nativeDownload(options, transfer)
+   return runAria(options, transfer)
+
+def nativeDownload(options, transfer=None):
+   uris, rpcOptions = ariaRpcOptions(options)
+   if len(uris) == 0:
+      return 1, {}
+   name = rpcOptions.get('out', os.path.basename(urlparse(uris[0]).path))
+   fullPath = os.path.join(rpcOptions.get('dir', '.'), name)
+   try:
+      split = int(rpcOptions.get('split', 5))
+      perServer = int(rpcOptions.get('max-connection-per-server', 1))
+      minSplit = parseSize(rpcOptions.get('min-split-size', '20M'))
+   except ValueError:
+      split, perServer, minSplit = 5, 1, 20*1024*1024
+   downloader = RangeDownloader(uris, fullPath, split, perServer, minSplit, rpcOptions.get('continue') == 'true')
+   if not transfer is None:
+      transfer.attach(downloader.stop, downloader.received)
+   return downloader.run()
+
+class RangeDownloader:
+   # The native download engine (--engine=native, or when aria2c is not installed). The file is preallocated and
+   # mapped into memory and split into segments which are fetched concurrently with Range requests over
+   # keep-alive connections to several mirrors, each piece being written straight into place. A connection that
+   # runs out of work takes over the back half of the largest segment still being downloaded, so slow mirrors
+   # end up with little of the file. Progress is kept in an aria2 format control file so each engine can resume
+   # the other's downloads. Mirrors that do not do ranges (and ftp or file uris) are only used for a single
+   # stream download when no mirror does ranges.
+   def __init__(self, uris, fullPath, split, perServer, minSplit, resume):
+      self.uris = uris
+      self.fullPath = fullPath
+      self.split = max(1, split)
+      self.perServer = max(1, perServer)
+      self.minSplit = max(NATIVE_PIECE, minSplit)
+      self.resume = resume
+      self.lock = threading.Lock()
+      self.mirrors = {}
+      for uri in uris:
+         self.mirrors[uri] = { 'location': uri, 'active': 0, 'bytes': 0, 'seconds': 0.0, 'failed': None,
+                               'ranges': urlparse(uri).scheme in ('http', 'https') }
+      self.segments = [] # [ position, end, worker, end of the read in progress ]
+      self.total = None
+      self.piece = NATIVE_PIECE
+      self.done = []
+      self.fd = None
+      self.out = None
+      self.stopped = False
+      self.cancelled = False
+      self.sockets = []
+
+   def run(self):
+      self.total = self.length()
+      if self.cancelled:
+         status = self.failure()
+      elif self.total is None or self.total == 0 or \
+         len([ mirror for mirror in self.mirrors.values() if mirror['ranges'] and mirror['failed'] is None ]) == 0:
+         status = self.sequential()
+      else:
+         status = self.segmented()
+      servers = {}
+      for uri, mirror in self.mirrors.items():
+         if mirror['bytes'] > 0 or not mirror['failed'] is None:
+            speed = 0
+            if mirror['seconds'] > 0:
+               speed = int(mirror['bytes'] / mirror['seconds'])
+            servers[mirrorKey(uri)] = { 'speed': speed, 'ok': mirror['failed'] is None }
+      return status, servers
+
+   def open(self, uri, connection, start, end):
+      # GET of bytes start to end (None for the rest) following redirects. Returns the response, the connection
+      # (to keep for the next request once the response has been read) and the final uri.
+      for i in range(5):
+         uo = urlparse(uri)
+         path = uo.path
+         if uo.query:
+            path += '?' + uo.query
+         headers = { 'User-Agent': 'gentooget/' + VERSION, 'Range': 'bytes=%d-' % (start,) }
+         if not end is None:
+            headers['Range'] += str(end)
+         if connection is None:
+            connection = self.connect(uo)
+            connection.request('GET', path, headers=headers)
+            response = connection.getresponse()
+         else:
+            try:
+               connection.request('GET', path, headers=headers)
+               response = connection.getresponse()
+            except (httplib.HTTPException, socket.error): # The server closed the idle connection
+               connection.close()
+               connection = self.connect(uo)
+               connection.request('GET', path, headers=headers)
+               response = connection.getresponse()
+         location = response.getheader('location')
+         if not response.status in (301, 302, 303, 307, 308) or location is None:
+            return response, connection, uri
+         response.read()
+         uri = urljoin(uri, location)
+         if urlparse(uri)[:2] != uo[:2]:
+            connection.close()
+            connection = None
+      connection.close()
+      raise httplib.HTTPException('Too many redirects')
+
+   def connect(self, uo):
+      # A new connection, kept so that stop() can cut it off
+      connection = httpConnection(uo, NATIVE_TIMEOUT)
+      connection.connect()
+      try:
+         self.track(connection.sock)
+      except socket.error:
+         connection.close()
+         raise
+      return connection
+
+   def track(self, sock):
+      # Keeps sock so that stop() can cut it off, failing if already stopped
+      self.lock.acquire()
+      try:
+         self.sockets = [ s for s in self.sockets if not isinstance(s._sock, socket._closedsocket) ] + [ sock ]
+         cancelled = self.cancelled
+      finally:
+         self.lock.release()
+      if cancelled:
+         raise socket.error('Stopped')
+
+   def create(self, mode):
+      # Opens the file, unless cancelled as it may then have been replaced by another stage's download (--hedge)
+      self.lock.acquire()
+      try:
+         if self.cancelled:
+            return None
+         return open(self.fullPath, mode)
+      finally:
+         self.lock.release()
+
+   def length(self):
+      # Size of the file from the first mirror answering a one byte range request (marking those that ignore the
+      # range), or None if no mirror tells
+      for uri, mirror in [ (uri, self.mirrors[uri]) for uri in self.uris if self.mirrors[uri]['ranges'] ]:
+         try:
+            response, connection, location = self.open(uri, None, 0, 0)
+            try:
+               if response.status == 206:
+                  mirror['location'] = location
+                  return int(response.getheader('content-range', '').split('/')[-1])
+               mirror['ranges'] = False
+               if response.status == 200 and not response.getheader('content-length') is None:
+                  return int(response.getheader('content-length'))
+               if response.status in (404, 410):
+                  mirror['failed'] = NOT_FOUND
+               elif response.status != 200:
+                  mirror['failed'] = 22 # aria2's "unexpected HTTP response"
+            finally:
+               connection.close()
+         except (httplib.HTTPException, socket.error, ValueError):
+            mirror['ranges'] = False
+            mirror['failed'] = 6 # aria2's "network problem"
+      return None
+
+   def sequential(self):
+      # Single stream download from the first uri that works, continuing from the downloaded bytes the file starts
+      # with (ftp REST, http Range). It only succeeds with as many bytes as the server said the file has, and a
+      # download cut short keeps a control file so the next mirror or stage continues it.
+      for uri in self.uris:
+         if self.cancelled:
+            break
+         mirror = self.mirrors[uri]
+         start = time.time()
+         progress = [ 0, None ] # Bytes the file starts with and its length as given by the server
+         complete = False
+         try:
+            complete = self.stream(uri, mirror, progress)
+            if not complete:
+               mirror['failed'] = 6 # aria2's "network problem"
+         except urllib2.HTTPError, e:
+            mirror['failed'] = 22
+            if e.code in (404, 410):
+               mirror['failed'] = NOT_FOUND
+         except ftplib.error_perm, e:
+            mirror['failed'] = 6
+            if str(e)[:3] == '550': # No such file
+               mirror['failed'] = NOT_FOUND
+         except (urllib2.URLError, IOError, socket.error, httplib.HTTPException, ftplib.all_errors, ValueError):
+            mirror['failed'] = 6
+         mirror['seconds'] += time.time() - start
+         if complete:
+            if os.path.exists(self.fullPath + '.aria2'):
+               os.remove(self.fullPath + '.aria2')
+            mirror['failed'] = None
+            return 0
+         if not self.cancelled and not progress[1] is None and 0 < progress[0] < progress[1]:
+            self.keep(progress[0], progress[1])
+      return self.failure()
+
+   def stream(self, uri, mirror, progress):
+      # Downloads the rest of uri into the file. Returns True once the file is complete, with progress updated as
+      # it goes.
+      offset = self.prefix()
+      scheme = urlparse(uri).scheme
+      if scheme == 'ftp':
+         read, close, offset, length = self.ftpStream(uri, offset)
+      elif scheme in ('http', 'https'):
+         read, close, offset, length = self.httpStream(uri, offset)
+      else:
+         response = urllib2.urlopen(urllib2.Request(uri, headers={ 'User-Agent': 'gentooget/' + VERSION }),
+                                    timeout=NATIVE_TIMEOUT)
+         read, close, offset, length = response.read, response.close, 0, None
+         if not response.info().getheader('Content-Length') is None:
+            length = int(response.info().getheader('Content-Length'))
+      if length is None and self.total: # From a mirror that did not do ranges
+         length = self.total
+      progress[0], progress[1] = offset, length
+      try:
+         # An earlier stage's (or --delta's) pieces past the start are kept, as is -c's existing file
+         if offset > 0 or (os.path.exists(self.fullPath) and os.path.exists(self.fullPath + '.aria2')):
+            fd = self.create('r+b')
+         else:
+            fd = self.create('wb')
+         if fd is None:
+            return False
          try:
+            fd.seek(offset)
+            while not self.cancelled:
+               data = read(NATIVE_CHUNK)
+               if not data:
+                  break
+               fd.write(data)
+               progress[0] += len(data)
+               mirror['bytes'] += len(data)
+            if self.cancelled or (not length is None and progress[0] != length):
+               return False
+            fd.truncate(progress[0])
+            return True
+         finally:
             fd.close()
-         except:
+      finally:
+         close()
+
+   def httpStream(self, uri, offset):
+      # (read, close, offset, length) of a GET of uri from offset, which is 0 if the server ignored the range
+      response, connection, location = self.open(uri, None, offset, None)
+      def close():
+         response.close()
+         connection.close()
+      contentRange = re.match(r'bytes (\d+)-\d+/(\d+)', response.getheader('content-range', ''))
+      if response.status == 206 and not contentRange is None and int(contentRange.group(1)) == offset:
+         return response.read, close, offset, int(contentRange.group(2))
+      if response.status == 200:
+         length = response.getheader('content-length')
+         if not length is None:
+            length = int(length)
+         return response.read, close, 0, length
+      close()
+      if response.status == 416 and offset > 0: # The start of the file is longer than the file, eg. with -c
+         if response.getheader('content-range', '') == 'bytes */%d' % (offset,):
+            return (lambda size: ''), (lambda: None), offset, offset # Already complete
+         return self.httpStream(uri, 0)
+      raise urllib2.HTTPError(uri, response.status, response.reason, response.msg, None)
+
+   def ftpStream(self, uri, offset):
+      # (read, close, offset, length) of a RETR of uri from offset, which is 0 if the server does not do REST
+      uo = urlparse(uri)
+      connection = ftplib.FTP(timeout=NATIVE_TIMEOUT)
+      connection.connect(uo.hostname, uo.port or 21)
+      try:
+         self.track(connection.sock)
+         connection.login(uo.username or 'anonymous', uo.password or 'anonymous@')
+         connection.voidcmd('TYPE I')
+         try:
+            length = connection.size(uo.path)
+         except ftplib.error_perm:
+            length = None # No SIZE (a missing file fails the RETR)
+         if offset == length:
+            connection.close()
+            return (lambda size: ''), (lambda: None), offset, length # Already complete
+         if not length is None and offset > length:
+            offset = 0
+         try:
+            data = connection.transfercmd('RETR ' + uo.path, offset or None)
+         except ftplib.error_perm, e:
+            if offset == 0 or str(e)[:3] == '550':
+               raise
+            offset = 0 # No REST
+            data = connection.transfercmd('RETR ' + uo.path)
+         self.track(data)
+      except:
+         connection.close()
+         raise
+      fd = data.makefile('rb')
+      def close():
+         fd.close()
+         data.close()
+         connection.close()
+      return fd.read, close, offset, length
+
+   def prefix(self):
+      # Downloaded bytes the file starts with: the leading pieces of its control file or, with -c and no control
+      # file, the whole file as aria2 does
+      if not os.path.exists(self.fullPath):
+         return 0
+      header = readControlFile(self.fullPath + '.aria2')
+      if header is None:
+         if self.resume:
+            return os.path.getsize(self.fullPath)
+         return 0
+      totalLength, pieceLength, bitfield = header
+      pieces = 0
+      while pieces * pieceLength < totalLength and ord(bitfield[pieces // 8]) & (0x80 >> (pieces % 8)):
+         pieces += 1
+      return min(totalLength, pieces * pieceLength)
+
+   def keep(self, received, total):
+      # Marks the pieces within the first received bytes as done in the control file, along with those already
+      # marked if it is for the same length, and allocates the file at full length as aria2 expects
+      header = readControlFile(self.fullPath + '.aria2')
+      if not header is None and header[0] == total:
+         piece, bitfield = header[1], [ ord(c) for c in header[2] ]
+      else:
+         piece = NATIVE_PIECE
+         bitfield = [ 0 ] * (((total + piece - 1) // piece + 7) // 8)
+      for i in range(received // piece):
+         bitfield[i // 8] |= 0x80 >> (i % 8)
+      self.lock.acquire() # As in saveControl()
+      try:
+         if self.cancelled:
+            return
+         fd = open(self.fullPath, 'r+b')
+         try:
+            fd.truncate(total)
+         finally:
+            fd.close()
+         writeControlFile(self.fullPath + '.aria2', total, piece, ''.join([ chr(b) for b in bitfield ]))
+      finally:
+         self.lock.release()
+
+   def failure(self):
+      codes = [ mirror['failed'] for mirror in self.mirrors.values() ]
+      if len(codes) > 0 and codes.count(NOT_FOUND) == len(codes):
+         return NOT_FOUND
+      for code in codes:
+         if not code is None:
+            return code
+      return 1
+
+   def segmented(self):
+      pieces = (self.total + self.piece - 1) // self.piece
+      header = readControlFile(self.fullPath + '.aria2')
+      resumed = False
+      if not header is None and header[0] == self.total and os.path.exists(self.fullPath):
+         self.piece = header[1] # Continue with the piece size it was started with (eg. by aria2)
+         pieces = (self.total + self.piece - 1) // self.piece
+         self.done = [ 0 ] * pieces
+         for i in range(pieces):
+            if ord(header[2][i // 8]) & (0x80 >> (i % 8)):
+               self.done[i] = self.pieceSize(i)
+         resumed = True
+      else:
+         self.done = [ 0 ] * pieces
+         if self.resume and os.path.exists(self.fullPath): # aria2 -c: the existing bytes are the start of the file
+            existing = min(os.path.getsize(self.fullPath), self.total)
+            for i in range(existing // self.piece):
+               self.done[i] = self.pieceSize(i)
+            resumed = existing >= self.piece
+      if resumed:
+         self.fd = self.create('r+b')
+      else:
+         self.fd = self.create('w+b')
+      if self.fd is None:
+         return self.failure()
+      workers = []
+      try:
+         self.fd.truncate(self.total)
+         try:
+            self.out = mmap.mmap(self.fd.fileno(), self.total)
+         except (EnvironmentError, OverflowError, ValueError):
+            self.out = None # eg. larger than the address space, so fall back to seek and write
+         self.plan()
+         self.saveControl()
+         for i in range(min(self.split, len(self.uris) * self.perServer)):
+            t = threading.Thread(target=self.worker, args=(i,))
+            t.setDaemon(True)
+            t.start()
+            workers.append(t)
+         while len(workers) > 0 and not self.stopped:
+            workers[0].join(1) # Save progress every second
+            workers = [ t for t in workers if t.isAlive() ]
+            self.saveControl()
+            if VERBOSE:
+               sys.stdout.write('\r%s %d/%d bytes' % (os.path.basename(self.fullPath), sum(self.done), self.total))
+               sys.stdout.flush()
+         if VERBOSE:
+            sys.stdout.write('\n')
+      finally:
+         # Workers (still running if interrupted) stop after their current read so the control file has
+         # everything written
+         self.stopped = True
+         for t in workers:
+            t.join(1)
+         complete = sum(self.done) == self.total
+         if not complete:
+            self.saveControl()
+         if not self.out is None:
+            self.out.flush()
+         # A worker still waiting on a read (after stop()) may yet write, in which case the file is closed when
+         # the last of them is done with it
+         if len([ t for t in workers if t.isAlive() ]) == 0:
+            if not self.out is None:
+               self.out.close()
+            self.fd.close()
+      if not complete:
+         if sum(self.done) == 0 and not self.cancelled: # Like aria2 leave nothing behind if nothing was downloaded
+            os.remove(self.fullPath)
+            os.remove(self.fullPath + '.aria2')
+         return self.failure()
+      os.remove(self.fullPath + '.aria2')
+      return 0
+
+   def stop(self):
+      # Ends the download within a second, keeping what has been downloaded, by cutting off its connections
+      self.lock.acquire()
+      try:
+         self.stopped = self.cancelled = True
+         sockets = list(self.sockets)
+      finally:
+         self.lock.release()
+      for sock in sockets:
+         try:
+            sock.shutdown(socket.SHUT_RDWR)
+         except socket.error: # Closed in the meantime
             pass
 
-def appendMirrors(url, address, name, options, mirrors):
+   def received(self):
+      return sum([ mirror['bytes'] for mirror in self.mirrors.values() ])
+
+   def pieceSize(self, i):
+      return min(self.piece, self.total - i * self.piece)
+
+   def plan(self):
+      # Segments covering the missing pieces, the largest halved until there are about split of at least minSplit
+      segments = []
+      start = None
+      for i in range(len(self.done) + 1):
+         missing = i < len(self.done) and self.done[i] < self.pieceSize(i)
+         if missing and start is None:
+            start = i * self.piece
+         elif not missing and not start is None:
+            segments.append([ start, min(i * self.piece, self.total), None, start ])
+            start = None
+      while len(segments) < self.split:
+         segments.sort(key=lambda segment: segment[0] - segment[1])
+         largest = segments[0]
+         middle = (largest[0] + (largest[1] - largest[0]) // 2) // self.piece * self.piece
+         if largest[1] - largest[0] < 2 * self.minSplit or middle <= largest[0]:
+            break
+         segments.append([ middle, largest[1], None, middle ])
+         largest[1] = middle
+      segments.sort()
+      self.segments = segments
+
+   def take(self, worker):
+      # Next segment for worker (lock held): an unassigned one, otherwise the back half of the largest segment left
+      if self.stopped:
+         return None
+      self.segments = [ segment for segment in self.segments if segment[0] < segment[1] or not segment[2] is None ]
+      for segment in self.segments:
+         if segment[2] is None and segment[0] < segment[1]:
+            segment[2] = worker
+            return segment
+      largest = None
+      for segment in self.segments:
+         left = segment[1] - max(segment[0], segment[3])
+         if left > self.piece and (largest is None or left > largest[1] - max(largest[0], largest[3])):
+            largest = segment
+      if largest is None:
+         return None
+      start = max(largest[0], largest[3])
+      middle = (start + (largest[1] - start) // 2) // self.piece * self.piece
+      if middle <= start:
+         middle += self.piece
+      if middle >= largest[1]:
+         return None
+      segment = [ middle, largest[1], worker, middle ]
+      largest[1] = middle
+      self.segments.append(segment)
+      return segment
+
+   def choose(self, uri):
+      # The mirror for a worker's next segment (lock held): its current one unless that failed, otherwise the
+      # fastest mirror so far with a free connection (untried mirrors first)
+      if not uri is None and self.mirrors[uri]['failed'] is None:
+         return uri
+      if not uri is None:
+         self.mirrors[uri]['active'] -= 1
+      best = None
+      for candidate in self.uris:
+         mirror = self.mirrors[candidate]
+         if not mirror['ranges'] or not mirror['failed'] is None or mirror['active'] >= self.perServer:
+            continue
+         speed = float('inf')
+         if mirror['seconds'] > 0:
+            speed = mirror['bytes'] / mirror['seconds']
+         if best is None or speed > best[0]:
+            best = (speed, candidate)
+      if best is None:
+         return None
+      self.mirrors[best[1]]['active'] += 1
+      return best[1]
+
+   def write(self, position, data):
+      if not self.out is None:
+         self.out[position:position + len(data)] = data
+      else:
+         self.lock.acquire()
+         try:
+            self.fd.seek(position)
+            self.fd.write(data)
+         finally:
+            self.lock.release()
+
+   def worker(self, index):
+      uri = None
+      connection = None
+      try:
+         while True:
+            self.lock.acquire()
+            try:
+               segment = self.take(index)
+               if not segment is None:
+                  uri = self.choose(uri)
+                  if uri is None:
+                     segment[2] = None
+                     segment[3] = segment[0]
+               if segment is None or uri is None:
+                  return
+               mirror = self.mirrors[uri]
+               position = segment[0]
+               requested = segment[1]
+            finally:
+               self.lock.release()
+            start = time.time()
+            try:
+               try:
+                  response, connection, location = self.open(mirror['location'], connection, position, requested - 1)
+                  if response.status != 206 or \
+                     not response.getheader('content-range', '').startswith('bytes %d-' % (position,)):
+                     mirror['failed'] = 22
+                     if response.status in (404, 410):
+                        mirror['failed'] = NOT_FOUND
+                     raise httplib.HTTPException('HTTP %d for %s' % (response.status, location))
+                  mirror['location'] = location
+                  while True:
+                     self.lock.acquire()
+                     try:
+                        want = min(NATIVE_CHUNK, segment[1] - position)
+                        if self.stopped:
+                           want = 0
+                        segment[3] = position + want
+                     finally:
+                        self.lock.release()
+                     if want <= 0:
+                        break
+                     data = response.read(want)
+                     if not data:
+                        raise httplib.HTTPException('Connection closed at %d by %s' % (position, location))
+                     self.write(position, data)
+                     self.lock.acquire()
+                     try:
+                        self.count(position, len(data))
+                        position += len(data)
+                        segment[0] = segment[3] = position
+                        mirror['bytes'] += len(data)
+                     finally:
+                        self.lock.release()
+                  if position != requested: # Part of the segment was taken over so the rest of the response is unread
+                     connection.close()
+                     connection = None
+               except (httplib.HTTPException, socket.error, EnvironmentError), e:
+                  if DEBUG:
+                     printErr('Native download: ' + str(e))
+                  if not connection is None:
+                     connection.close()
+                     connection = None
+                  self.lock.acquire()
+                  try:
+                     if mirror['failed'] is None:
+                        mirror['failed'] = 6
+                     segment[2] = None # For another mirror
+                     segment[3] = segment[0]
+                  finally:
+                     self.lock.release()
+            finally:
+               mirror['seconds'] += time.time() - start
+            self.lock.acquire()
+            try:
+               segment[2] = None
+            finally:
+               self.lock.release()
+      finally:
+         if not connection is None:
+            connection.close()
+
+   def count(self, position, length):
+      # Adds written bytes to the pieces they belong to (lock held)
+      while length > 0:
+         i = position // self.piece
+         n = min(length, (i + 1) * self.piece - position)
+         self.done[i] += n
+         position += n
+         length -= n
+
+   def saveControl(self):
+      # Does nothing once stop() has been called, as the file may then have been replaced by another stage's
+      # download (--hedge)
+      if not self.out is None:
+         self.out.flush() # Pieces are only marked done once they are on disk
+      self.lock.acquire()
+      try:
+         if self.cancelled:
+            return
+         bitfield = [ 0 ] * ((len(self.done) + 7) // 8)
+         for i in range(len(self.done)):
+            if self.done[i] >= self.pieceSize(i):
+               bitfield[i // 8] |= 0x80 >> (i % 8)
+         writeControlFile(self.fullPath + '.aria2', self.total, self.piece, ''.join([ chr(b) for b in bitfield ]))
+      finally:
+         self.lock.release()
+
+def runAria(options, transfer=None):
+   # Runs aria2c seeded with (and collecting) the per mirror speeds. Returns the exit status and speeds.
+   servers = {}
+   statPath = None
+   start = int(time.time())
+   try:
+      fd, statPath = tempfile.mkstemp(prefix='gentooget.', suffix='.serverstat')
+      writeServerStat(fd)
+      options = options + ['--uri-selector=feedback', '--server-stat-if=' + statPath,
+                           '--server-stat-of=' + statPath]
+   except (IOError, OSError):
+      if not statPath is None and os.path.exists(statPath):
+         os.remove(statPath)
+      statPath = None
+   if not transfer is None:
+      options = options + ['--auto-save-interval=1'] # Progress for Transfer.stalled
+   try:
+      process = subprocess.Popen(options)
+      if not transfer is None:
+         def stop():
+            if process.poll() is None:
+               process.send_signal(signal.SIGTERM) # aria2c saves its control file and exits
+         def kill():
+            if process.poll() is None:
+               process.kill()
+         transfer.attach(stop, None, kill)
+      status = process.wait()
+      if not statPath is None:
+         servers = readServerStat(statPath, start)
+   finally:
+      if not statPath is None and os.path.exists(statPath):
+         os.remove(statPath)
+   return status, servers
+
+def filesystemType(path):
+   # Type of the filesystem holding path (the longest matching mount point in /proc/mounts) or None
+   path = os.path.realpath(path)
+   if not path in FILESYSTEMS:
+      best = None
+      fstype = None
+      try:
+         fd = open('/proc/mounts', 'r')
+         try:
+            for line in fd:
+               fields = line.split()
+               if len(fields) < 3:
+                  continue
+               mount = fields[1].replace('\\040', ' ')
+               if (path == mount or path.startswith(mount.rstrip('/') + '/')) and \
+                  (best is None or len(mount) > len(best)):
+                  best = mount
+                  fstype = fields[2]
+         finally:
+            fd.close()
+      except IOError:
+         pass
+      FILESYSTEMS[path] = fstype
+   return FILESYSTEMS[path]
+
+def tuneOptions(size, uris, dir):
+   # aria2c options for downloading a file of size bytes (None if unknown) from uris into dir. Small files use a
+   # single connection as setting up more costs more than it saves. Larger files are split over the mirrors that
+   # have historically been at least a quarter as fast as the best of them, with extra connections per mirror
+   # when there are too few such mirrors to fill the split.
+   if not TUNE:
+      return []
+   stats = mirrorStats()
+   now = time.time()
+   keys = []
+   for uri in uris:
+      if not mirrorKey(uri) in keys:
+         keys.append(mirrorKey(uri))
+   speeds = [ stat['speed'] for stat in stats.values() if 'speed' in stat ]
+   default = 1.0
+   if len(speeds) > 0:
+      default = max(speeds)
+   scores = [ mirrorScore(stats.get(key, {}), now, default) for key in keys ]
+   mirrors = 1
+   if len(scores) > 0:
+      mirrors = len([ score for score in scores if score * 4 >= max(scores) ])
+   options = []
+   fstype = filesystemType(dir)
+   if not size is None and size < SMALL_FILE:
+      options.extend([ '--split=1', '--max-connection-per-server=1', '--file-allocation=none' ])
+      return options
+   if size is None:
+      split = min(MAX_SPLIT, max(1, len(keys)))
+      perServer = 1
+   else:
+      split = min(MAX_SPLIT, max(1, size // MIN_PIECE))
+      perServer = min(MAX_SERVER_CONNECTIONS, max(1, (split + mirrors - 1) // mirrors))
+      split = min(split, mirrors * perServer)
+      # Pieces a quarter of each connection's share (within aria2's 1M to its default 20M) so that connections to
+      # fast mirrors can take over the remaining work of slow ones
+      minSplit = max(1, min(20, size // (split * 4) // (1024*1024)))
+      options.append('--min-split-size=%dM' % (minSplit,))
+      options.append('--disk-cache=%dM' % (min(64, max(16, size // (32*1024*1024))),))
+   options.extend([ '--split=%d' % (split,), '--max-connection-per-server=%d' % (perServer,) ])
+   if fstype in ('ext4', 'xfs', 'ocfs2'):
+      options.append('--file-allocation=falloc') # Allocated in one call without writing zeros
+   elif fstype in ('btrfs', 'zfs', 'nfs', 'nfs4', 'cifs', 'tmpfs', 'fuse'):
+      options.append('--file-allocation=none') # Copy on write, network or memory: preallocating only costs time
+   elif not fstype is None:
+      options.append('--file-allocation=trunc')
+   return options
+
+def readMirrors(var = 'GENTOO_MIRRORS'):
+   # Mirror urls from the environment or else the configuration files (see loadConfig)
+   s = os.environ.get(var)
+   if s is None or len(s.strip()) == 0:
+      s = loadConfig().get(var, '')
+   return [ mirror.rstrip('/') for mirror in s.split() ]
+
+def configSources():
+   # Configuration files in the order they are read, later assignments overriding earlier ones
+   sources = []
+   for path in MAKE_CONF:
+      if os.path.isdir(path): # make.conf may be a directory of files read in order
+         for name in sorted(os.listdir(path)):
+            if not name.startswith('.') and not name.endswith('~'):
+               sources.append(os.path.join(path, name))
+      else:
+         sources.append(path)
+   sources.append(os.path.expanduser('~') + os.path.sep + 'GENTOO_MIRRORS')
+   return sources
+
+def sourceStamps(paths):
+   stamps = {}
+   for path in paths:
+      try:
+         st = os.stat(path)
+         stamps[path] = '%r:%d' % (st.st_mtime, st.st_size)
+      except OSError:
+         stamps[path] = None
+   return stamps
+
+def loadConfig():
+   # Variables set in make.conf (/etc/make.conf then /etc/portage/make.conf, either of which may be a
+   # directory) and ~/GENTOO_MIRRORS, parsed once into a snapshot in $GENTOOGET_DIR which is reused for as
+   # long as none of the files (or directories, or files they source) has changed.
+   global CONFIG
+   if not CONFIG is None:
+      return CONFIG
+   name = 'config.%d.json' % os.getuid() # ~ differs between root and portage
+   directories = [ path for path in MAKE_CONF if os.path.isdir(path) ]
+   snapshot = loadState(name, {})
+   if snapshot.get('make.conf') == MAKE_CONF and \
+      snapshot.get('stamps') == sourceStamps(snapshot.get('stamps', {}).keys()):
+      CONFIG = {}
+      for key, value in snapshot['variables'].items(): # json gives unicode, the values end up as aria2c arguments
+         CONFIG[key.encode('utf-8')] = value.encode('utf-8')
+      return CONFIG
+   variables = {}
+   read = []
+   sources = configSources()
+   for path in sources:
+      if os.path.isfile(path):
+         parseShellVars(path, variables, read)
+      else:
+         read.append(path) # So that the snapshot is invalidated if it is created
+   if len([ path for path in sources[:-1] if os.path.isfile(path) ]) == 0:
+      printErr('make.conf not found (checked %s) !' % ', '.join(MAKE_CONF))
+   try:
+      saveState(name, { 'make.conf': MAKE_CONF, 'stamps': sourceStamps(read + directories), 'variables': variables })
+   except (IOError, OSError), e:
+      stateError(name, e)
+   CONFIG = variables
+   return CONFIG
+
+def parseShellVars(path, variables, read, depth=0):
+   # Reads the variable assignments of a make.conf style file into variables the way bash would: single and
+   # double quotes (either of which may span lines), backslash escapes and line continuations, $VAR and
+   # ${VAR} expansion, export and source/. of other files. Anything else (commands) is ignored.
+   read.append(path)
+   try:
+      fd = open(path, 'r')
+      try:
+         text = fd.read()
+      finally:
+         fd.close()
+   except IOError:
+      printErr('Error reading ' + path)
+      return
+   for words in shellStatements(text, variables):
+      if len(words) > 0 and words[0] == 'export':
+         words = words[1:]
+      if len(words) == 0:
+         continue
+      if words[0] in ('source', '.') and len(words) > 1:
+         if depth < 10:
+            parseShellVars(os.path.join(os.path.dirname(path), words[1]), variables, read, depth + 1)
+         continue
+      assignments = []
+      for word in words:
+         p = word.find('=')
+         if p > 0 and re.match(SHELL_NAME_RE, word[:p]):
+            assignments.append((word[:p], word[p+1:]))
+         else:
+            assignments = [] # A command, whose environment alone gets any assignments before it (FOO=bar cmd)
+            break
+      for key, value in assignments:
+         variables[key] = value
+
+def shellStatements(text, variables):
+   # Splits text into statements (lists of words) with quoting and expansion done. Expansion uses the
+   # variables assigned so far so statements are yielded (and must be applied) one at a time.
+   words = []
+   word = None
+   i = 0
+   n = len(text)
+   while i < n:
+      c = text[i]
+      if c == '\\' and i + 1 < n:
+         if text[i+1] != '\n': # Backslash newline is a continuation
+            word = (word or '') + text[i+1]
+         i += 2
+      elif c == "'":
+         end = text.find("'", i + 1)
+         if end < 0:
+            end = n
+         word = (word or '') + text[i+1:end]
+         i = end + 1
+      elif c == '"':
+         i += 1
+         value = ''
+         while i < n and text[i] != '"':
+            if text[i] == '\\' and i + 1 < n and text[i+1] in '"\\$`\n':
+               if text[i+1] != '\n':
+                  value += text[i+1]
+               i += 2
+            elif text[i] == '$':
+               expanded, i = shellExpand(text, i, variables)
+               value += expanded
+            else:
+               value += text[i]
+               i += 1
+         word = (word or '') + value
+         i += 1
+      elif c == '$':
+         expanded, i = shellExpand(text, i, variables)
+         word = (word or '') + expanded
+      elif c == '#' and word is None:
+         while i < n and text[i] != '\n':
+            i += 1
+      elif c in ' \t;\n':
+         if not word is None:
+            words.append(word)
+            word = None
+         if c in ';\n':
+            if len(words) > 0:
+               yield words
+            words = []
+         i += 1
+      else:
+         word = (word or '') + c
+         i += 1
+   if not word is None:
+      words.append(word)
+   if len(words) > 0:
+      yield words
+
+def shellExpand(text, i, variables):
+   # Expands $NAME, ${NAME} or ${NAME:-default} at text[i] returning the value and the index after it
+   m = re.compile(SHELL_EXPANSION_RE).match(text, i)
+   if m is None:
+      return '$', i + 1
+   name = m.group(1) or m.group(2)
+   value = variables.get(name, os.environ.get(name, ''))
+   if value == '' and not m.group(3) is None:
+      value = m.group(3)
+   return value, m.end()
+
+def appendMirrors(url, address, name, options, mirrors, misses={}, fetchLayouts=True):
    global GENTOO_MIRRORS, INTERNATIONAL_MIRRORS, LOCAL_MIRRORS, INTERNAL_MIRRORS
    isMirror = False
    allMirrors = []
@@ -416,46 +2381,205 @@ def appendMirrors(url, address, name, options, mirrors):
          isMirror = True
          break   
    if not isMirror: #A hardcoded download location eg http://releases.mozilla.org/
-      options.append(url)
+      if not url in misses:
+         options.append(url)
    else:
-#      options.append("-s")
-#      options.append(str(len(mirrors)))
-      for mirror in mirrors:
-         newUrl = mirror + '/distfiles/' + name
-         options.append(newUrl)
+      options.extend(mirrorUris(mirrors, name, misses, fetchLayouts))
    return isMirror
 
-INTERFACE_RE = re.compile(r".*inet addr:(\b\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}\b) .*")
+def mirrorUris(mirrors, name, misses={}, fetchLayouts=True):
+   # Uris for name on mirrors (best first, in each mirror's layout) leaving out those known not to have it. With
+   # fetchLayouts False only the layouts already known are used (eg. before switching to the mirrors' link).
+   uris = []
+   layouts = mirrorLayouts(mirrors, fetchLayouts)
+   for mirror in rankMirrors(mirrors):
+      for path in layoutPaths(layouts.get(mirror), name):
+         uri = mirror + '/distfiles/' + path
+         if not uri in misses:
+            uris.append(uri)
+   return uris
 
-def interfaceIp(interface):
-   global INTERFACE_RE
-   process = None
-   try:
-      process = subprocess.Popen(['/sbin/ifconfig', interface], stdout=subprocess.PIPE,
-      stderr=subprocess.STDOUT, bufsize=4096)
-   except:
-      printErr("Exception executing ifconfig " + interface)
-      if not process is None:
+def parseLayoutConf(text):
+   # Layouts in order of preference from the [structure] section of a layout.conf eg.
+   # [structure]
+   # 0=filename-hash BLAKE2B 8
+   # 1=flat
+   # as [ 'flat' ] or [ 'filename-hash', algorithm, [ cutoff bits ] ] (other layouts as [ name ])
+   layouts = []
+   section = None
+   for line in text.splitlines():
+      line = line.strip()
+      if line.startswith('[') and line.endswith(']'):
+         section = line[1:-1].strip()
+      elif section == 'structure' and line.find('=') > 0 and not line.startswith('#'):
+         key, value = line.split('=', 1)
+         fields = value.split()
+         if len(fields) == 0:
+            continue
          try:
-            process.kill()
-         except:
-            pass
-      traceback.print_exc()
-   if process is None:
+            if fields[0] == 'filename-hash' and len(fields) == 3:
+               fields = [ fields[0], fields[1].upper(), [ int(bits) for bits in fields[2].split(':') ] ]
+            layouts.append((int(key.strip()), fields))
+         except ValueError:
+            continue
+   layouts.sort()
+   if len(layouts) == 0:
+      return [ [ 'flat' ] ]
+   return [ layout for key, layout in layouts ]
+
+def layoutPath(layout, name):
+   # Path of name relative to the distfiles directory in layout, or None if the layout is not supported (eg.
+   # BLAKE2B without pyblake2)
+   if layout[0] == 'flat':
+      return name
+   if layout[0] != 'filename-hash' or len(layout) != 3:
       return None
-   status = process.wait()
-   if status != 0:
+   h = newHash(layout[1])
+   if h is None:
       return None
-   output = process.communicate()[0]
-   # @type output str
-   lines = output.splitlines()
-   ip = None
-   for line in lines:
-      m = INTERFACE_RE.match(line)
-      if not m is None:
-         ip = m.group(1)
-         break
-   return ip
+   if isinstance(name, unicode):
+      name = name.encode('utf-8')
+   h.update(name)
+   digest = h.hexdigest()
+   parts = []
+   offset = 0
+   for bits in layout[2]:
+      if bits <= 0 or bits % 4 != 0:
+         return None
+      parts.append(digest[offset:offset + bits // 4])
+      offset += bits // 4
+   return '/'.join(parts + [ name ])
+
+def layoutPaths(layouts, name):
+   # The path of name in the first supported layout, or if the layouts are not known its path in each of
+   # DEFAULT_LAYOUTS
+   if layouts is None:
+      paths = []
+      for layout in DEFAULT_LAYOUTS:
+         path = layoutPath(layout, name)
+         if not path is None and not path in paths:
+            paths.append(path)
+      return paths
+   for layout in layouts:
+      path = layoutPath(layout, name)
+      if not path is None:
+         return [ path ]
+   return [ name ]
+
+def fetchLayout(mirror):
+   # Layouts of mirror from its distfiles/layout.conf, flat if it has none or None if it could not be asked
+   url = mirror + '/distfiles/layout.conf'
+   try:
+      if url.startswith('ftp:'):
+         return parseLayoutConf(ftpRead(url, 65536, LAYOUT_TIMEOUT))
+      if url.startswith('https:') and hasattr(ssl, '_create_unverified_context'):
+         response = urllib2.urlopen(url, timeout=LAYOUT_TIMEOUT, context=ssl._create_unverified_context())
+      else:
+         response = urllib2.urlopen(url, timeout=LAYOUT_TIMEOUT)
+      try:
+         return parseLayoutConf(response.read(65536))
+      finally:
+         response.close()
+   except urllib2.HTTPError, e:
+      if e.code == 404:
+         return [ [ 'flat' ] ]
+      return None
+   except ftplib.error_perm, e:
+      if str(e)[:3] == '550': # No such file
+         return [ [ 'flat' ] ]
+      return None
+   except (urllib2.URLError, IOError, socket.error, httplib.HTTPException, ftplib.all_errors):
+      return None
+
+def ftpRead(url, limit, timeout):
+   # Up to limit bytes of the file at an ftp url
+   uo = urlparse(url)
+   connection = ftplib.FTP(timeout=timeout)
+   try:
+      connection.connect(uo.hostname, uo.port or 21)
+      connection.login(uo.username or 'anonymous', uo.password or 'anonymous@')
+      data = []
+      connection.retrbinary('RETR ' + uo.path, data.append)
+      return ''.join(data)[:limit]
+   finally:
+      connection.close()
+
+def mirrorLayouts(mirrors, fetch=True):
+   # Layouts of mirrors (mirror -> layouts or None if unknown) from $GENTOOGET_DIR/layouts.json, fetching the
+   # layout.conf of mirrors not known or expired all at once (unless fetch is False)
+   cache = loadState('layouts.json', {})
+   now = time.time()
+   stale = []
+   if fetch:
+      stale = [ mirror for mirror in mirrors if cache.get(mirror, {}).get('expires', 0) <= now ]
+   if len(stale) > 0:
+      fetched = {}
+      def worker(mirror):
+         fetched[mirror] = fetchLayout(mirror)
+      threads = [ threading.Thread(target=worker, args=(mirror,)) for mirror in stale ]
+      for t in threads:
+         t.setDaemon(True)
+         t.start()
+      for t in threads:
+         t.join(LAYOUT_TIMEOUT + 1)
+      for mirror in stale:
+         layouts = fetched.get(mirror)
+         if DEBUG:
+            print(green() + 'Layout of %s: %s' % (mirror, str(layouts)))
+         if layouts is None:
+            cache[mirror] = { 'layouts': None, 'expires': now + LAYOUT_RETRY }
+         else:
+            cache[mirror] = { 'layouts': layouts, 'expires': now + LAYOUT_TTL }
+      def update(saved):
+         for mirror in stale:
+            saved[mirror] = cache[mirror]
+      updateState('layouts.json', update)
+   return dict([ (mirror, cache.get(mirror, {}).get('layouts')) for mirror in mirrors ])
+
+def interfaceIp(interface):
+   # IPv4 address of interface (SIOCGIFADDR ioctl) or None if it is down or has no address yet
+   s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+   try:
+      try:
+         ifreq = fcntl.ioctl(s.fileno(), SIOCGIFADDR, struct.pack('256s', interface[:15]))
+         return socket.inet_ntoa(ifreq[20:24])
+      except IOError:
+         return None
+   finally:
+      s.close()
+
+def waitForInterface(interface, timeout):
+   # Waits up to timeout seconds for interface to get an address. Sleeps on a netlink socket subscribed to
+   # link and address changes so it wakes as soon as the address is assigned, or if netlink is not
+   # available polls with a short exponential backoff.
+   deadline = time.time() + timeout
+   monitor = None
+   try:
+      try:
+         monitor = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE)
+         monitor.bind((0, RTMGRP_LINK | RTMGRP_IPV4_IFADDR))
+      except (AttributeError, socket.error):
+         monitor = None
+      delay = 0.05
+      waiting = False
+      while True:
+         ip = interfaceIp(interface) # Checked after subscribing so that no change can be missed
+         if not ip is None:
+            return ip
+         remaining = deadline - time.time()
+         if remaining <= 0:
+            return None
+         if not waiting:
+            print(yellow() + "Waiting for interface " + interface)
+            waiting = True
+         if monitor is None:
+            time.sleep(min(delay, remaining))
+            delay = min(delay * 2, 1.0)
+         elif len(select.select([monitor], [], [], min(remaining, 5))[0]) > 0:
+            monitor.recv(65536)
+   finally:
+      if not monitor is None:
+         monitor.close()
 
 def switchConnection(script, interface):
    status = 1
@@ -475,15 +2599,2123 @@ def switchConnection(script, interface):
          printErr("Exception executing %s (%s)" % (script, str(shlex.split(script))))
          traceback.print_exc()
          return None
-   ip = interfaceIp(interface)
+   ip = waitForInterface(interface, LINK_TIMEOUT)
    if ip is None:
-      print(yellow() + "Waiting for interface " + interface)
-   while ip is None:
-      time.sleep(3)
-      ip = interfaceIp(interface)      
+      printErr("ERROR: Interface %s did not come up within %d seconds of running %s" %
+               (interface, LINK_TIMEOUT, script))
+      return None
    print(green() + "script %s interface %s ip %s connected" % (script, interface, ip))
    return ip
 
+def ariaRpcOptions(options):
+   # Converts an aria2c command line as built by main() into the uri list and option dictionary used by
+   # aria2.addUri
+   uris = []
+   rpcOptions = {}
+   shortOptions = { '-d': 'dir', '-o': 'out', '-s': 'split' }
+   i = 1
+   while i < len(options):
+      opt = options[i]
+      if opt == '-c':
+         rpcOptions['continue'] = 'true'
+      elif opt in shortOptions:
+         i += 1
+         rpcOptions[shortOptions[opt]] = options[i]
+      elif opt.startswith('--'):
+         p = opt.find('=')
+         if p > 0:
+            rpcOptions[opt[2:p]] = opt[p+1:]
+         else:
+            rpcOptions[opt[2:]] = 'true'
+      else:
+         uris.append(opt)
+      i += 1
+   for name in GLOBAL_ARIA_OPTIONS:
+      if name in rpcOptions:
+         del rpcOptions[name]
+   return uris, rpcOptions
+
+class Aria2RpcError(Exception):
+   def __init__(self, code, reason):
+      Exception.__init__(self, '%s (%s)' % (reason, str(code)))
+      self.code = code
+      self.reason = reason
+
+class Aria2Rpc:
+   # Minimal aria2 JSON-RPC client. One keep-alive HTTP connection is shared by all callers.
+   def __init__(self, port, secret=None, host='127.0.0.1'):
+      self.host = host
+      self.port = port
+      self.secret = secret
+      self.connection = None
+      self.lock = threading.Lock()
+      self.id = 0
+
+   def call(self, method, *params):
+      params = list(params)
+      if not self.secret is None:
+         params.insert(0, 'token:' + self.secret)
+      self.lock.acquire()
+      try:
+         self.id += 1
+         body = json.dumps({ 'jsonrpc': '2.0', 'id': str(self.id), 'method': method, 'params': params })
+         attempt = 0
+         while True:
+            try:
+               if self.connection is None:
+                  self.connection = httplib.HTTPConnection(self.host, self.port, timeout=30)
+               self.connection.request('POST', '/jsonrpc', body, { 'Content-Type': 'application/json' })
+               reply = json.loads(self.connection.getresponse().read())
+               break
+            except (httplib.HTTPException, socket.error):
+               self.close()
+               attempt += 1
+               if attempt > 1: # A second failure on a fresh connection is real
+                  raise
+      finally:
+         self.lock.release()
+      if 'error' in reply:
+         raise Aria2RpcError(reply['error'].get('code'), reply['error'].get('message'))
+      return reply.get('result')
+
+   def close(self):
+      if not self.connection is None:
+         try:
+            self.connection.close()
+         except:
+            pass
+         self.connection = None
+
+class FakeAria2RpcHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+   protocol_version = 'HTTP/1.1'
+
+   def do_POST(self):
+      length = int(self.headers.getheader('content-length', 0))
+      reply = { 'jsonrpc': '2.0', 'id': None }
+      code = 200
+      try:
+         request = json.loads(self.rfile.read(length))
+         reply['id'] = request.get('id')
+         reply['result'] = self.server.dispatch(request.get('method', ''), request.get('params', []))
+      except ValueError:
+         reply['error'] = { 'code': -32700, 'message': 'Parse error' }
+         code = 400
+      except Aria2RpcError, e:
+         reply['error'] = { 'code': e.code, 'message': e.reason }
+         code = 400
+      body = json.dumps(reply)
+      self.send_response(code)
+      self.send_header('Content-Type', 'application/json-rpc')
+      self.send_header('Content-Length', str(len(body)))
+      self.end_headers()
+      self.wfile.write(body)
+
+   def log_message(self, format, *args):
+      if DEBUG:
+         BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+class FakeAria2Rpc(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+   # Stand-in for aria2c --enable-rpc implementing the calls gentooget makes. Files are fetched with urllib2 so
+   # file://, http:// and ftp:// uris work which allows testing the daemon without aria2c or network access.
+   daemon_threads = True
+   allow_reuse_address = True
+
+   def __init__(self, port, host='127.0.0.1'):
+      BaseHTTPServer.HTTPServer.__init__(self, (host, port), FakeAria2RpcHandler)
+      self.jobs = {}
+      self.lock = threading.Lock()
+      self.lastGid = 0
+
+   def dispatch(self, method, params):
+      if len(params) > 0 and isinstance(params[0], basestring) and params[0].startswith('token:'):
+         params = params[1:]
+      name = method.split('.', 1)[-1]
+      if name == 'getVersion':
+         return { 'version': 'fake-' + VERSION, 'enabledFeatures': [] }
+      if name == 'addUri':
+         if len(params) == 0 or len(params[0]) == 0:
+            raise Aria2RpcError(1, 'No URI to download')
+         options = {}
+         if len(params) > 1:
+            options = params[1]
+         self.lock.acquire()
+         try:
+            self.lastGid += 1
+            gid = '%016x' % self.lastGid
+            job = { 'gid': gid, 'status': 'active', 'uris': list(params[0]), 'options': options,
+                    'completedLength': '0', 'totalLength': '0', 'errorCode': '0', 'cancel': False }
+            self.jobs[gid] = job
+         finally:
+            self.lock.release()
+         t = threading.Thread(target=self.fetch, args=(job,))
+         t.setDaemon(True)
+         t.start()
+         return gid
+      if name in ('shutdown', 'forceShutdown'):
+         t = threading.Thread(target=self.shutdown)
+         t.setDaemon(True)
+         t.start()
+         return 'OK'
+      job = None
+      if len(params) > 0:
+         job = self.jobs.get(params[0])
+      if job is None:
+         raise Aria2RpcError(1, 'GID not found')
+      if name == 'tellStatus':
+         status = {}
+         for key in ('gid', 'status', 'completedLength', 'totalLength', 'errorCode'):
+            status[key] = job[key]
+         return status
+      if name == 'getServers':
+         if job['status'] != 'active':
+            raise Aria2RpcError(1, 'Download is not active')
+         return [ { 'index': '1', 'servers': [ { 'uri': job.get('uri', ''), 'currentUri': job.get('uri', ''),
+                  'downloadSpeed': str(job.get('speed', 0)) } ] } ]
+      if name in ('remove', 'forceRemove'):
+         job['cancel'] = True
+         return job['gid']
+      if name == 'changeUri':
+         if job['status'] != 'active':
+            raise Aria2RpcError(1, 'Download is not active')
+         for uri in params[2]:
+            if uri in job['uris']:
+               job['uris'].remove(uri)
+         added = [ uri for uri in params[3] if not uri in job['uris'] ]
+         job['uris'].extend(added) # Picked up by fetch() if the current uri fails
+         return [ len(params[2]), len(added) ]
+      if name == 'removeDownloadResult':
+         if job['status'] == 'active':
+            raise Aria2RpcError(1, 'Download is active')
+         self.lock.acquire()
+         try:
+            del self.jobs[job['gid']]
+         finally:
+            self.lock.release()
+         return 'OK'
+      raise Aria2RpcError(1, 'Method ' + method + ' not supported')
+
+   def fetch(self, job):
+      options = job['options']
+      dir = options.get('dir', '.')
+      for uri in job['uris']:
+         name = options.get('out', os.path.basename(urlparse(uri).path))
+         fullPath = os.path.join(dir, name)
+         fd = None
+         try:
+            request = urllib2.Request(uri)
+            offset = 0
+            header = readControlFile(fullPath + '.aria2')
+            if not header is None and os.path.exists(fullPath):
+               # Like aria2 continue from the control file whatever the uri (only pieces done in order count here)
+               totalLength, pieceLength, bitfield = header
+               bits = ''.join([ bin(ord(c))[2:].zfill(8) for c in bitfield ])
+               offset = min(totalLength, os.path.getsize(fullPath), (bits + '0').index('0') * pieceLength)
+            elif options.get('continue') == 'true' and os.path.exists(fullPath):
+               offset = os.path.getsize(fullPath)
+            if offset > 0:
+               request.add_header('Range', 'bytes=%d-' % offset)
+            response = urllib2.urlopen(request, timeout=60)
+            if offset > 0 and response.getcode() != 206:
+               offset = 0
+            length = response.info().getheader('Content-Length')
+            total = None
+            if not length is None:
+               total = offset + int(length)
+               job['totalLength'] = str(total)
+            if offset > 0:
+               fd = open(fullPath, 'r+b')
+               fd.seek(offset)
+               fd.truncate()
+            else:
+               fd = open(fullPath, 'wb')
+            completed = offset
+            job['uri'] = uri
+            start = time.time()
+            def saveControl(): # Pieces of a megabyte done so far
+               if not total is None and total > 0:
+                  pieces = (total + 1048575) // 1048576
+                  done = min(pieces, completed // 1048576)
+                  bits = '1' * done + '0' * ((pieces + 7) // 8 * 8 - done)
+                  fd.flush()
+                  writeControlFile(fullPath + '.aria2', total, 1048576,
+                                   ''.join([ chr(int(bits[i:i+8], 2)) for i in range(0, len(bits), 8) ]))
+            saveControl()
+            while not job['cancel']:
+               data = response.read(65536)
+               if not data:
+                  break
+               fd.write(data)
+               completed += len(data)
+               job['completedLength'] = str(completed)
+               job['speed'] = int((completed - offset) / max(time.time() - start, 0.001))
+               if completed % 1048576 < len(data):
+                  saveControl()
+            if job['cancel'] or (not total is None and completed < total):
+               saveControl()
+               if job['cancel']:
+                  job['status'] = 'removed'
+                  return
+               raise IOError('Connection closed after %d of %d bytes' % (completed, total))
+            if os.path.exists(fullPath + '.aria2'):
+               os.remove(fullPath + '.aria2')
+            job['totalLength'] = job['completedLength'] = str(completed)
+            job['errorCode'] = '0'
+            job['status'] = 'complete'
+            return
+         except urllib2.HTTPError, e:
+            if e.code == 404:
+               job['errorCode'] = '3' # aria2 "resource not found"
+            else:
+               job['errorCode'] = '22' # aria2 "unexpected HTTP response"
+         except (urllib2.URLError, IOError, socket.error, httplib.HTTPException):
+            job['errorCode'] = '1'
+         finally:
+            if not fd is None:
+               fd.close()
+      job['status'] = 'error'
+
+class FetchDaemonHandler(SocketServer.StreamRequestHandler):
+   def handle(self):
+      try:
+         request = json.loads(self.rfile.readline())
+      except ValueError:
+         return
+      for reply in self.server.fetch(request, self.connection):
+         self.wfile.write(json.dumps(reply) + '\n')
+         self.wfile.flush()
+
+class FetchDaemon(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+   # Accepts download requests from gentooget clients over a Unix socket and runs them in a single
+   # aria2c instance. Each request is one JSON line, replies are progress lines followed by a final
+   # line containing the status (aria2c exit code).
+   daemon_threads = True
+
+   def __init__(self, path, rpc, dir):
+      SocketServer.UnixStreamServer.__init__(self, path, FetchDaemonHandler)
+      os.chmod(path, 0660)
+      try:
+         os.chown(path, -1, grp.getgrnam(DAEMON_GROUP).gr_gid) # Portage fetches as user portage
+      except (KeyError, OSError):
+         print(yellow() + 'Could not give the daemon socket to group %s so only its owner can use it' % (DAEMON_GROUP,))
+      self.rpc = rpc
+      self.dir = os.path.realpath(dir)
+      self.lock = threading.Lock()
+      self.active = {} # path -> gid of the download writing it
+      self.clients = {} # gid -> number of clients following it
+
+   def attach(self, path, uris, options):
+      # A second request for a file that is already downloading (eg. two emerges, or --serve and an emerge,
+      # fetching the same distfile) adds its uris to the running download with changeUri instead of starting
+      # another download of the same file. Returns the gid to follow.
+      self.lock.acquire()
+      try:
+         gid = self.active.get(path)
+         if not gid is None:
+            try:
+               self.rpc.call('aria2.changeUri', gid, 1, [], uris)
+               self.clients[gid] += 1
+               return gid
+            except Aria2RpcError:
+               pass # Finished in the meantime
+         gid = self.rpc.call('aria2.addUri', uris, options)
+         self.active[path] = gid
+         self.clients[gid] = 1
+         return gid
+      finally:
+         self.lock.release()
+
+   def detach(self, gid):
+      # Returns True if the last client following gid has gone
+      self.lock.acquire()
+      try:
+         self.clients[gid] -= 1
+         if self.clients[gid] > 0:
+            return False
+         del self.clients[gid]
+         for path, active in self.active.items():
+            if active == gid:
+               del self.active[path]
+         return True
+      finally:
+         self.lock.release()
+
+   def fetch(self, request, client):
+      uris = request.get('uris', [])
+      options = request.get('options', {})
+      # The daemon may be running as root so only take the options gentooget sets per download (not eg. an
+      # on-download-complete command), only fetch from the network (not eg. file:///etc/shadow) and only write
+      # files into its own distfiles directory
+      if not isinstance(options, dict) or not isinstance(uris, list):
+         yield { 'status': 1, 'message': 'Malformed request' }
+         return
+      if len([ uri for uri in uris if not isinstance(uri, basestring) or
+               not urlparse(uri).scheme in ('http', 'https', 'ftp') ]) > 0:
+         yield { 'status': 1, 'message': 'Daemon only downloads http, https and ftp uris' }
+         return
+      refused = [ key for key in options if not key in DAEMON_OPTIONS ]
+      if len(refused) > 0:
+         yield { 'status': 1, 'message': 'Daemon does not take option ' + ', '.join(sorted(refused)) }
+         return
+      target = os.path.realpath(options.get('dir', self.dir))
+      name = options.get('out', '')
+      if (target != self.dir and not target.startswith(self.dir + os.path.sep)) or \
+         name != os.path.basename(name) or name in ('', '.', '..'):
+         yield { 'status': 1, 'message': 'Daemon only downloads into ' + self.dir }
+         return
+      options['dir'] = target
+      try:
+         gid = self.attach(os.path.join(target, name), uris, options)
+      except (Aria2RpcError, httplib.HTTPException, socket.error), e:
+         yield { 'status': 1, 'message': 'addUri failed: ' + str(e) }
+         return
+      lastCompleted = None
+      samples = {}
+      while True:
+         try:
+            state = self.rpc.call('aria2.tellStatus', gid, ['status', 'errorCode', 'completedLength', 'totalLength'])
+         except (Aria2RpcError, httplib.HTTPException, socket.error), e:
+            self.detach(gid)
+            yield { 'status': 1, 'message': 'tellStatus failed: ' + str(e) }
+            return
+         if state['status'] in ('complete', 'error', 'removed'):
+            status = 0
+            if state['status'] != 'complete':
+               status = int(state.get('errorCode') or 1) or 1
+            if self.detach(gid):
+               try:
+                  self.rpc.call('aria2.removeDownloadResult', gid)
+               except (Aria2RpcError, httplib.HTTPException, socket.error):
+                  pass
+            servers = {}
+            for key, speeds in samples.items():
+               servers[key] = { 'speed': sum(speeds) / len(speeds), 'ok': True }
+            yield { 'status': status, 'message': state['status'], 'servers': servers }
+            return
+         try:
+            for file in self.rpc.call('aria2.getServers', gid):
+               for server in file.get('servers', []):
+                  speed = int(server.get('downloadSpeed', 0))
+                  if speed > 0:
+                     samples.setdefault(mirrorKey(server['currentUri']), []).append(speed)
+         except (Aria2RpcError, httplib.HTTPException, socket.error):
+            pass # Not active yet or already finished
+         if state['completedLength'] != lastCompleted:
+            lastCompleted = state['completedLength']
+            yield { 'completed': int(state['completedLength']), 'total': int(state['totalLength']) }
+         # The client never sends anything after its request so readable means it has gone (eg. emerge
+         # was interrupted) in which case the download is abandoned.
+         if len(select.select([client], [], [], 0.5)[0]) > 0:
+            if self.detach(gid): # Stopped but its control file is kept so a later request resumes it
+               try:
+                  self.rpc.call('aria2.forceRemove', gid)
+               except (Aria2RpcError, httplib.HTTPException, socket.error):
+                  pass
+            return
+
+def daemonAlive(path):
+   client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+   try:
+      try:
+         client.connect(path)
+         return True
+      except socket.error:
+         return False
+   finally:
+      client.close()
+
+def makeStateDir(dir=None):
+   # Creates dir (STATE_DIR by default) for STATE_GROUP, or closes up one of ours an earlier version left writable
+   # by everyone (01777). Raises OSError if it is not safe to keep state in (see stateDirSafe).
+   if dir is None:
+      dir = STATE_DIR
+   if not os.path.lexists(dir):
+      try:
+         os.makedirs(dir, 0700)
+         shareStateDir(dir)
+      except OSError, e:
+         if e.errno != errno.EEXIST:
+            raise
+   st = os.lstat(dir)
+   if os.path.isdir(dir) and not os.path.islink(dir) and st.st_uid == os.getuid() and st.st_mode & 02:
+      shareStateDir(dir)
+      st = os.lstat(dir)
+   if not stateDirSafe(dir, st):
+      raise OSError(errno.EPERM, 'Not using %s as it could have been written by anyone (it should only be '
+                    'writable by root, you or group %s)' % (dir, STATE_GROUP))
+   return dir
+
+def shareStateDir(dir):
+   # Makes dir writable by its owner and STATE_GROUP (if there is one), with the files created in it in the group
+   try:
+      os.chown(dir, -1, grp.getgrnam(STATE_GROUP).gr_gid)
+   except (KeyError, OSError):
+      pass # Only usable by this user
+   os.chmod(dir, 02770)
+
+def stateDirSafe(dir, st=None):
+   # True if dir is a directory (not a symlink to one) that nobody but its owner and group can write to, owned by
+   # root, this user or a member of STATE_GROUP (who can write to it anyway)
+   try:
+      if st is None:
+         st = os.lstat(dir)
+   except OSError:
+      return False
+   if not os.path.isdir(dir) or os.path.islink(dir) or st.st_mode & 02:
+      return False
+   if st.st_uid in (0, os.getuid()):
+      return True
+   try:
+      group = grp.getgrnam(STATE_GROUP)
+      owner = pwd.getpwuid(st.st_uid)
+   except KeyError:
+      return False
+   return owner.pw_gid == group.gr_gid or owner.pw_name in group.gr_mem
+
+def runDaemon(aria, socketPath, port, dir, fake=False):
+   if daemonAlive(socketPath):
+      printErr('ERROR: A gentooget daemon is already listening on ' + socketPath)
+      return 1
+   try:
+      stateDir = makeStateDir(os.path.dirname(socketPath))
+   except OSError, e:
+      printErr('ERROR: ' + str(e))
+      return 1
+   if os.path.exists(socketPath): # Left behind by a daemon that died
+      os.remove(socketPath)
+   process = None
+   fakeServer = None
+   secret = None
+   confPath = None
+   statPath = None
+   try:
+      if fake:
+         fakeServer = FakeAria2Rpc(port)
+         t = threading.Thread(target=fakeServer.serve_forever)
+         t.setDaemon(True)
+         t.start()
+      else:
+         # Pass the RPC secret in a private config file rather than on the (world readable) command line
+         secret = '%032x' % random.getrandbits(128)
+         fd, confPath = tempfile.mkstemp(prefix='gentooget.', suffix='.aria2.conf', dir=stateDir)
+         try:
+            os.write(fd, 'rpc-secret=%s\n' % secret)
+         finally:
+            os.close(fd)
+         fd, statPath = tempfile.mkstemp(prefix='gentooget.', suffix='.serverstat', dir=stateDir)
+         writeServerStat(fd)
+         options = [aria, '--conf-path=' + confPath, '--enable-rpc', '--rpc-listen-all=false',
+                    '--rpc-listen-port=%d' % port, '--check-certificate=false', '--max-concurrent-downloads=16',
+                    '--quiet=true', '--uri-selector=feedback', '--server-stat-if=' + statPath, '--disk-cache=64M']
+         if DEBUG:
+            print(green() + concatOpts(options))
+         process = subprocess.Popen(options)
+      rpc = Aria2Rpc(port, secret)
+      deadline = time.time() + 15
+      while True:
+         try:
+            version = rpc.call('aria2.getVersion')
+            break
+         except (httplib.HTTPException, socket.error):
+            if time.time() > deadline or (not process is None and not process.poll() is None):
+               printErr('ERROR: aria2 RPC server did not start on port %d' % port)
+               return 1
+            time.sleep(0.2)
+      server = FetchDaemon(socketPath, rpc, dir)
+      def stop(signum, frame):
+         raise SystemExit(0)
+      signal.signal(signal.SIGTERM, stop)
+      if VERBOSE:
+         print(green() + 'gentooget daemon (aria2 %s) listening on %s' % (version.get('version'), socketPath))
+      try:
+         server.serve_forever()
+      except (KeyboardInterrupt, SystemExit):
+         pass
+      server.server_close()
+      if os.path.exists(socketPath):
+         os.remove(socketPath)
+      return 0
+   finally:
+      if not process is None:
+         try:
+            Aria2Rpc(port, secret).call('aria2.shutdown')
+            process.wait()
+         except:
+            process.terminate()
+            process.wait()
+      if not fakeServer is None:
+         fakeServer.shutdown()
+      for path in (confPath, statPath):
+         if not path is None and os.path.exists(path):
+            os.remove(path)
+
+def daemonDownload(options, servers=None, transfer=None):
+   # Hands the download to a running daemon. Returns None if there is no daemon to hand it to, otherwise
+   # the aria2 status with the measured per mirror speeds in servers.
+   if DAEMON_SOCKET is None or not os.path.exists(DAEMON_SOCKET):
+      return None
+   uris, rpcOptions = ariaRpcOptions(options)
+   rpcOptions['dir'] = os.path.abspath(rpcOptions.get('dir', '.'))
+   client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+   try:
+      try:
+         client.connect(DAEMON_SOCKET)
+      except socket.error:
+         return None # Stale socket
+      if DEBUG:
+         print(green() + 'Submitting to daemon on ' + DAEMON_SOCKET)
+      client.sendall(json.dumps({ 'uris': uris, 'options': rpcOptions }) + '\n')
+      completed = [ None ]
+      if not transfer is None:
+         def stop():
+            try:
+               client.shutdown(socket.SHUT_RDWR) # The daemon stops the download when the client goes
+            except socket.error:
+               pass
+         transfer.attach(stop, lambda: completed[0])
+      for line in client.makefile('r'):
+         reply = json.loads(line)
+         if 'status' in reply:
+            if VERBOSE:
+               sys.stdout.write('\n')
+               if reply['status'] != 0:
+                  print(yellow() + 'Daemon download failed: ' + reply.get('message', ''))
+            if not servers is None:
+               servers.update(reply.get('servers', {}))
+            return reply['status']
+         completed[0] = reply['completed']
+         if VERBOSE:
+            sys.stdout.write('\r%s %d/%d bytes' % (rpcOptions.get('out', ''), reply['completed'], reply['total']))
+            sys.stdout.flush()
+      return 1 # Daemon went away
+   finally:
+      client.close()
+
+def statePath(name):
+   return os.path.join(STATE_DIR, name)
+
+def loadState(name, default=None):
+   # The contents of state file name, or default if it is missing, unreadable or in a directory that is not safe
+   fd = None
+   try:
+      try:
+         if not stateDirSafe(STATE_DIR) or not stateDirSafe(os.path.dirname(statePath(name))):
+            return default
+         fd = open(statePath(name), 'r')
+         return json.load(fd)
+      except (IOError, ValueError):
+         return default
+   finally:
+      if not fd is None:
+         fd.close()
+
+def saveState(name, data, mode=0660):
+   # Replaces state file name with data, leaving nothing behind if that fails. The file gets mode whatever the
+   # umask so that (by default) root and portage can both update it.
+   path = statePath(name)
+   makeStateDirs(name)
+   fd, tmp = tempfile.mkstemp(prefix=os.path.basename(path) + '.', dir=os.path.dirname(path))
+   try:
+      out = os.fdopen(fd, 'w')
+      try:
+         os.fchmod(fd, mode)
+         json.dump(data, out)
+      finally:
+         out.close()
+      os.rename(tmp, path)
+   except:
+      os.remove(tmp)
+      raise
+
+def makeStateDirs(name):
+   # makeStateDir for STATE_DIR and the subdirectory (eg. digests/) state file name is in, if any
+   makeStateDir()
+   if os.path.dirname(name) != '':
+      makeStateDir(os.path.dirname(statePath(name)))
+
+def lockState(name):
+   # Locks state file name against other processes until the returned file is closed. The lock file is only
+   # read so one created by another user does whatever its mode.
+   makeStateDirs(name)
+   lock = os.fdopen(os.open(statePath(name) + '.lock', os.O_RDONLY | os.O_CREAT | os.O_NOFOLLOW, 0660), 'r')
+   try:
+      fcntl.flock(lock, fcntl.LOCK_EX)
+   except:
+      lock.close()
+      raise
+   return lock
+
+def stateError(name, e):
+   # State is only a cache so failing to update it is reported (with -V or -D) but otherwise ignored
+   if VERBOSE or DEBUG:
+      printErr('Could not update %s: %s' % (statePath(name), str(e)))
+
+def updateState(name, update, mode=0660):
+   # Read-modify-write of a (dictionary) state file serialised between processes by locking a lock file
+   lock = None
+   try:
+      try:
+         lock = lockState(name)
+         data = loadState(name, {})
+         result = update(data)
+         saveState(name, data, mode)
+         return result
+      except (IOError, OSError), e:
+         stateError(name, e)
+         return None
+   finally:
+      if not lock is None:
+         lock.close()
+
+def mirrorKey(url):
+   # Mirror statistics are kept per protocol and host as that is what aria2 reports on
+   uo = urlparse(url)
+   return '%s://%s' % (uo.scheme, uo.hostname)
+
+def readServerStat(path, since=0):
+   # Parses an aria2 --server-stat-of file eg.
+   # host=ftp.heanet.ie, protocol=http, dl_speed=105043, last_updated=1288201456, status=OK
+   servers = {}
+   if not os.path.isfile(path):
+      return servers
+   fd = open(path, 'r')
+   try:
+      for line in fd:
+         entry = {}
+         for field in line.strip().split(','):
+            p = field.find('=')
+            if p > 0:
+               entry[field[:p].strip()] = field[p+1:].strip()
+         try:
+            if int(entry.get('last_updated', 0)) < since: # Only loaded from --server-stat-if
+               continue
+            servers['%s://%s' % (entry['protocol'], entry['host'])] = \
+               { 'speed': int(entry.get('dl_speed', 0)), 'ok': entry.get('status') == 'OK' }
+         except (KeyError, ValueError):
+            continue
+   finally:
+      fd.close()
+   return servers
+
+def writeServerStat(fd):
+   # Seeds aria2's feedback uri selector (--server-stat-if) with the speeds measured by previous downloads, writing
+   # them to (and closing) the file descriptor fd
+   stats = mirrorStats()
+   fd = os.fdopen(fd, 'w')
+   try:
+      for key, stat in stats.items():
+         uo = urlparse(key)
+         status = 'OK'
+         if stat.get('consecutive', 0) > 0:
+            status = 'ERROR'
+         fd.write('host=%s, protocol=%s, dl_speed=%d, last_updated=%d, status=%s\n' %
+                  (uo.hostname, uo.scheme, int(stat.get('speed', 0)), int(stat.get('updated', 0)), status))
+   finally:
+      fd.close()
+
+def decay(stat, now):
+   # Weight given to what has been learned about a mirror so far, halving every MIRROR_STATS_HALF_LIFE
+   return 0.5 ** (max(0, now - stat.get('updated', now)) / float(MIRROR_STATS_HALF_LIFE))
+
+def recordMirrorStats(uris, servers, status):
+   # Folds the per-host outcome of a download into the persistent mirror statistics. Hosts that aria2 did not
+   # report on are counted as failures only if the download failed as a whole.
+   now = time.time()
+   outcomes = {}
+   for uri in uris:
+      key = mirrorKey(uri)
+      if key in servers:
+         outcomes[key] = servers[key]
+      elif status != 0:
+         outcomes[key] = { 'speed': 0, 'ok': False }
+   if len(outcomes) == 0:
+      return
+   def update(stats):
+      for key, outcome in outcomes.items():
+         stat = stats.setdefault(key, {})
+         w = decay(stat, now)
+         stat['failures'] = stat.get('failures', 0) * w
+         if outcome['ok']:
+            if outcome['speed'] > 0:
+               if 'speed' in stat:
+                  stat['speed'] = (stat['speed'] * w + outcome['speed']) / (w + 1)
+               else:
+                  stat['speed'] = outcome['speed']
+            stat['consecutive'] = 0
+         else:
+            stat['failures'] += 1
+            stat['consecutive'] = stat.get('consecutive', 0) + 1
+            stat['lastFailure'] = now
+         stat['updated'] = now
+   updateState('mirrorstats.json', update)
+
+def mirrorStats():
+   # The mirror statistics, parsed once however many stages rank and tune from them and parsed again only when
+   # a download (by this or another process) has changed them. They are shared so must not be modified.
+   global MIRROR_STATS
+   stamps = sourceStamps([ statePath('mirrorstats.json') ])
+   if MIRROR_STATS is None or MIRROR_STATS[0] != stamps:
+      MIRROR_STATS = [ stamps, loadState('mirrorstats.json', {}) ]
+   return MIRROR_STATS[1]
+
+def mirrorScore(stat, now, default):
+   # Old measurements fade back towards the default so that a mirror that was slow once gets another chance
+   w = decay(stat, now)
+   return (stat.get('speed', default) * w + default * (1 - w)) / (1 + stat.get('failures', 0) * w)
+
+def rankMirrors(mirrors):
+   # Orders mirrors fastest first by decayed throughput and failure history, leaving out mirrors that have
+   # failed EVICT_FAILURES times in a row within the last EVICT_TIME seconds (unless that would leave none).
+   if mirrors is None or len(mirrors) < 2:
+      return mirrors
+   stats = mirrorStats()
+   now = time.time()
+   speeds = [ stat['speed'] for stat in stats.values() if 'speed' in stat ]
+   default = 1.0 # Unmeasured mirrors are given the best known speed so that they do get tried
+   if len(speeds) > 0:
+      default = max(speeds)
+   scored = []
+   evicted = []
+   for i, mirror in enumerate(mirrors):
+      stat = stats.get(mirrorKey(mirror), {})
+      if stat.get('consecutive', 0) >= EVICT_FAILURES and now - stat.get('lastFailure', 0) < EVICT_TIME:
+         evicted.append(mirror)
+         continue
+      scored.append((-mirrorScore(stat, now, default), i, mirror))
+   if len(scored) == 0:
+      return mirrors
+   scored.sort()
+   if DEBUG and len(evicted) > 0:
+      print(yellow() + 'Skipping failing mirrors: ' + concatOpts(evicted))
+   return [ mirror for score, i, mirror in scored ]
+
+def printMirrorStats():
+   stats = mirrorStats()
+   now = time.time()
+   speeds = [ stat['speed'] for stat in stats.values() if 'speed' in stat ]
+   default = 1.0
+   if len(speeds) > 0:
+      default = max(speeds)
+   rows = [ (-mirrorScore(stat, now, default), key, stat) for key, stat in stats.items() ]
+   rows.sort()
+   print('%-40s %12s %9s %11s %12s' % ('Mirror', 'Speed (B/s)', 'Failures', 'In a row', 'Updated'))
+   for score, key, stat in rows:
+      print('%-40s %12d %9.2f %11d %12s' % (key, stat.get('speed', 0), stat.get('failures', 0),
+            stat.get('consecutive', 0), time.strftime('%Y-%m-%d', time.localtime(stat.get('updated', 0)))))
+
+def startTelemetry(mode, files, engine):
+   global TELEMETRY
+   TELEMETRY = { 'time': time.time(), 'mode': mode, 'files': files, 'engine': engine, 'stages': [],
+                 'switches': [], 'cache': {} }
+
+def beginStage(tier, files):
+   # Starts timing a fallback stage. Downloads made until the next stage starts are counted against it.
+   if TELEMETRY is None:
+      return None
+   stage = { 'tier': tier, 'start': time.time(), 'files': files, 'served': 0, 'bytes': 0, 'mirrors': {},
+             'exits': {} }
+   TELEMETRY_LOCK.acquire()
+   try:
+      TELEMETRY['stages'].append(stage)
+   finally:
+      TELEMETRY_LOCK.release()
+   return stage
+
+def endStage(stage, served):
+   if not stage is None:
+      stage['duration'] = time.time() - stage['start']
+      stage['served'] = served
+
+def countTransfer(uris, servers, bytes, status, elapsed, stage=None):
+   # Adds a download (taking elapsed seconds) to stage, by default the current one (the last begun). aria2
+   # reports speeds rather than bytes per mirror so the bytes are shared between the mirrors it reported in
+   # proportion to their speed.
+   if TELEMETRY is None or len(TELEMETRY['stages']) == 0:
+      return
+   keys = []
+   for uri in uris:
+      if not mirrorKey(uri) in keys:
+         keys.append(mirrorKey(uri))
+   used = [ key for key in keys if key in servers and servers[key]['ok'] and servers[key]['speed'] > 0 ]
+   total = sum([ servers[key]['speed'] for key in used ])
+   if len(used) == 0 and len(keys) == 1 and status == 0:
+      used = keys
+   TELEMETRY_LOCK.acquire()
+   try:
+      if stage is None:
+         stage = TELEMETRY['stages'][-1]
+      stage['bytes'] += bytes
+      stage['exits'][str(status)] = stage['exits'].get(str(status), 0) + 1
+      for key in keys:
+         mirror = stage['mirrors'].setdefault(key, { 'bytes': 0, 'seconds': 0.0, 'failures': 0 })
+         if key in used:
+            share = bytes
+            if total > 0:
+               share = bytes * servers[key]['speed'] / total
+               mirror['seconds'] += float(share) / servers[key]['speed']
+            else:
+               mirror['seconds'] += elapsed
+            mirror['bytes'] += share
+         elif (key in servers and not servers[key]['ok']) or (not key in servers and status != 0):
+            mirror['failures'] += 1
+   finally:
+      TELEMETRY_LOCK.release()
+
+def countSwitch(target, wait, seconds, ok):
+   # seconds is None if the connection was already in the target mode (shared with other processes)
+   if not TELEMETRY is None:
+      TELEMETRY['switches'].append({ 'target': target, 'wait': wait, 'seconds': seconds, 'ok': ok })
+
+def countCache(what, n=1):
+   # Work avoided: 'complete' (file already verified), 'digests' (cached digests used), 'skipped' (a stage
+   # left out because of known misses) and 'reused' (bytes copied from a previous version by --delta)
+   if not TELEMETRY is None:
+      TELEMETRY_LOCK.acquire()
+      try:
+         TELEMETRY['cache'][what] = TELEMETRY['cache'].get(what, 0) + n
+      finally:
+         TELEMETRY_LOCK.release()
+
+def finishTelemetry(status, failed=None):
+   # Appends the record of this invocation (if it downloaded anything) to telemetry.jsonl
+   global TELEMETRY
+   record = TELEMETRY
+   TELEMETRY = None
+   if record is None:
+      return
+   if failed is None:
+      failed = 0
+      if status != 0:
+         failed = record['files']
+   record['duration'] = time.time() - record['time']
+   record['status'] = status
+   record['failed'] = failed
+   lock = None
+   try:
+      try:
+         path = statePath('telemetry.jsonl')
+         lock = lockState('telemetry.jsonl')
+         if os.path.exists(path) and os.path.getsize(path) >= TELEMETRY_MAX_SIZE:
+            os.rename(path, path + '.1')
+         fd = os.fdopen(os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT | os.O_NOFOLLOW, 0660), 'a')
+         try:
+            if os.fstat(fd.fileno()).st_uid == os.getuid():
+               os.fchmod(fd.fileno(), 0660) # Whatever the umask, so that root and portage can both append
+            fd.write(json.dumps(record) + '\n')
+         finally:
+            fd.close()
+      except (IOError, OSError), e:
+         stateError('telemetry.jsonl', e)
+   finally:
+      if not lock is None:
+         lock.close()
+
+def readTelemetry():
+   records = []
+   for path in (statePath('telemetry.jsonl.1'), statePath('telemetry.jsonl')):
+      if not os.path.isfile(path):
+         continue
+      fd = open(path, 'r')
+      try:
+         for line in fd:
+            try:
+               records.append(json.loads(line))
+            except ValueError:
+               continue # Partly written line
+      finally:
+         fd.close()
+   return records
+
+def printReport():
+   # Throughput and cost (bytes per connection) tables aggregated from telemetry.jsonl
+   records = readTelemetry()
+   if len(records) == 0:
+      print('No downloads recorded in ' + statePath('telemetry.jsonl'))
+      return
+   tiers = {}
+   mirrors = {}
+   days = {}
+   for record in records:
+      day = days.setdefault(time.strftime('%Y-%m-%d', time.localtime(record['time'])),
+         { 'runs': 0, 'files': 0, 'failed': 0, 'bytes': {}, 'switches': 0, 'switchTime': 0.0, 'cached': 0,
+           'reused': 0 })
+      day['runs'] += 1
+      day['files'] += record.get('files', 0)
+      day['failed'] += record.get('failed', 0)
+      day['cached'] += sum([ n for what, n in record.get('cache', {}).items() if what != 'reused' ])
+      day['reused'] += record.get('cache', {}).get('reused', 0)
+      for switch in record.get('switches', []):
+         if not switch['seconds'] is None:
+            day['switches'] += 1
+            day['switchTime'] += switch['seconds']
+      for stage in record.get('stages', []):
+         tier = tiers.setdefault(stage['tier'], { 'stages': 0, 'files': 0, 'served': 0, 'bytes': 0, 'time': 0.0 })
+         tier['stages'] += 1
+         tier['files'] += stage['files']
+         tier['served'] += stage['served']
+         tier['bytes'] += stage['bytes']
+         tier['time'] += stage.get('duration', 0)
+         day['bytes'][stage['tier']] = day['bytes'].get(stage['tier'], 0) + stage['bytes']
+         for key, used in stage['mirrors'].items():
+            mirror = mirrors.setdefault(key, { 'tiers': [], 'bytes': 0, 'seconds': 0.0, 'failures': 0, 'last': 0 })
+            if not stage['tier'] in mirror['tiers']:
+               mirror['tiers'].append(stage['tier'])
+            mirror['bytes'] += used['bytes']
+            mirror['seconds'] += used['seconds']
+            mirror['failures'] += used['failures']
+            mirror['last'] = max(mirror['last'], record['time'])
+   total = float(max(1, sum([ tier['bytes'] for tier in tiers.values() ])))
+   print('%-15s %7s %7s %7s %12s %10s %12s %7s' % ('Tier', 'Stages', 'Files', 'Served', 'MB', 'Time (s)',
+                                                  'Speed (KB/s)', 'Bytes'))
+   for name, tier in sorted(tiers.items()):
+      print('%-15s %7d %7d %7d %12.1f %10.1f %12.1f %6.1f%%' % (name, tier['stages'], tier['files'], tier['served'],
+            tier['bytes'] / 1048576.0, tier['time'], tier['bytes'] / 1024.0 / max(tier['time'], 0.001),
+            100 * tier['bytes'] / total))
+   print('')
+   print('%-40s %-22s %12s %12s %9s %12s' % ('Mirror', 'Tiers', 'MB', 'Speed (KB/s)', 'Failures', 'Last used'))
+   for bytes, key, mirror in sorted([ (-mirror['bytes'], key, mirror) for key, mirror in mirrors.items() ]):
+      speed = 0
+      if mirror['seconds'] > 0:
+         speed = mirror['bytes'] / 1024.0 / mirror['seconds']
+      print('%-40s %-22s %12.1f %12.1f %9d %12s' % (key, ','.join(sorted(mirror['tiers'])),
+            mirror['bytes'] / 1048576.0, speed, mirror['failures'],
+            time.strftime('%Y-%m-%d', time.localtime(mirror['last']))))
+   print('')
+   print('%-10s %6s %7s %7s %10s %10s %10s %10s %9s %10s %7s %10s' % ('Day', 'Runs', 'Files', 'Failed',
+         'Internal MB', 'Local MB', 'Intl MB', 'Other MB', 'Switches', 'Switch (s)', 'Cached', 'Reused MB'))
+   for name, day in sorted(days.items()):
+      other = sum([ bytes for tier, bytes in day['bytes'].items()
+                    if not tier in ('internal', 'local', 'international') ])
+      print('%-10s %6d %7d %7d %11.1f %10.1f %10.1f %10.1f %9d %10.1f %7d %10.1f' % (name, day['runs'],
+            day['files'], day['failed'], day['bytes'].get('internal', 0) / 1048576.0,
+            day['bytes'].get('local', 0) / 1048576.0, day['bytes'].get('international', 0) / 1048576.0,
+            other / 1048576.0, day['switches'], day['switchTime'], day['cached'], day['reused'] / 1048576.0))
+
+def readBatch(filename):
+   # Reads the files to download, one per line, either as "URI [URI...] filename" or as the "URI [URI...]"
+   # lines printed by emerge -pf (the filename is then taken from the first URI). Lines without a URI are
+   # ignored and files listed more than once are merged. Returns a list of [name, uris].
+   if filename == '-':
+      fd = sys.stdin
+   else:
+      fd = open(filename, 'r')
+   jobs = []
+   byName = {}
+   try:
+      for line in fd:
+         if line.lstrip().startswith('#'):
+            continue
+         fields = line.split()
+         uris = [ field for field in fields if field.find('://') > 0 ]
+         if len(uris) == 0:
+            continue
+         name = fields[-1]
+         if name.find('://') > 0:
+            name = os.path.basename(urlparse(uris[0]).path)
+         p = name.rfind('?file=')
+         if p >= 0:
+            name = name[p+6:]
+         if name == '':
+            continue
+         if name in byName:
+            for uri in uris:
+               if not uri in byName[name]:
+                  byName[name].append(uri)
+         else:
+            byName[name] = uris
+            jobs.append([name, uris])
+   finally:
+      if not fd is sys.stdin:
+         fd.close()
+   return jobs
+
+def downloadBatch(options, jobs, dir, concurrency, expected={}):
+   # Downloads all of jobs ([name, uris]) with one aria2c using an input file, or through the daemon if one is
+   # running (or concurrency native engine downloads). Returns the names of the files that failed (including those
+   # not matching their expected digests which are deleted).
+   if len(jobs) == 0:
+      return []
+   for name, uris in jobs:
+      fullPath = os.path.join(dir, name)
+      if os.path.exists(fullPath + '.aria2') and controlProgress(fullPath, expected.get(name, {}).get('size')) is None:
+         os.remove(fullPath + '.aria2') # See fetch()
+   if engineName(options) == 'native' or (not DAEMON_SOCKET is None and daemonAlive(DAEMON_SOCKET)):
+      pending = list(jobs)
+      lock = threading.Lock()
+      def worker():
+         while True:
+            lock.acquire()
+            try:
+               if len(pending) == 0:
+                  return
+               name, uris = pending.pop(0)
+            finally:
+               lock.release()
+            download(options + ['-o', name] + uris, os.path.join(dir, name), expected.get(name))
+      workers = [ threading.Thread(target=worker) for i in range(min(concurrency, len(jobs))) ]
+      for t in workers:
+         t.start()
+      for t in workers:
+         t.join()
+   else:
+      fd, inputPath = tempfile.mkstemp(prefix='gentooget.', suffix='.batch')
+      diskCache = []
+      fd = os.fdopen(fd, 'w')
+      try:
+         for name, uris in jobs:
+            fd.write('\t'.join(uris) + '\n  out=' + name + '\n')
+            for opt in tuneOptions(expected.get(name, {}).get('size'), uris, dir):
+               if opt.startswith('--disk-cache='): # Global so the largest wins
+                  diskCache.append((int(opt[13:-1]), opt))
+               else:
+                  fd.write('  ' + opt[2:] + '\n')
+      finally:
+         fd.close()
+      try:
+         allUris = []
+         for name, uris in jobs:
+            allUris.extend(uris)
+         sizes = {}
+         for name, uris in jobs:
+            if '-c' in options or os.path.exists(os.path.join(dir, name) + '.aria2'):
+               sizes[name] = fileProgress(os.path.join(dir, name))
+         start = time.time()
+         status, servers = runAria(options + ['-i', inputPath, '-j', str(concurrency)] +
+                                   [ opt for size, opt in sorted(diskCache)[-1:] ])
+         recordMirrorStats(allUris, servers, 0) # Per file failures are only known from the files themselves
+         bytes = 0
+         for name, uris in jobs:
+            bytes += max(0, fileProgress(os.path.join(dir, name)) - sizes.get(name, 0))
+         countTransfer(allUris, servers, bytes, status, time.time() - start)
+      finally:
+         os.remove(inputPath)
+   failed = []
+   for name, uris in jobs:
+      fullPath = os.path.join(dir, name)
+      if not os.path.exists(fullPath) or os.path.getsize(fullPath) == 0 or os.path.exists(fullPath + '.aria2'):
+         failed.append(name)
+      elif not verifyFile(fullPath, expected.get(name)):
+         os.remove(fullPath)
+         failed.append(name)
+   return failed
+
+def fetchBatch(options, jobs, dir, concurrency, mirrors, mustSwitch, local, international, interface,
+               useDownman, expected={}):
+   # Batch version of the fetch in main(). Each stage (internal, local, international, downman) is a single
+   # aria2c run over all files still missing, so the connection is switched at most once each way.
+   urls = {}
+   for name, uris in jobs:
+      urls[name] = uris
+   remaining = []
+   served = {}
+   for name, uris in jobs:
+      fullPath = os.path.join(dir, name)
+      if len(expected.get(name, {})) > 0 and os.path.exists(fullPath) and \
+         not os.path.exists(fullPath + '.aria2') and verifyFile(fullPath, expected[name]): # See main()
+         served[name] = 'already complete'
+         countCache('complete')
+      else:
+         remaining.append(name)
+   if DELTA:
+      for name in remaining:
+         deltaSeed(name, dir, expected.get(name), INTERNAL_MIRRORS + mirrors)
+   def stage(tier, names, uriList):
+      if len(names) == 0:
+         return []
+      if VERBOSE:
+         print(green() + 'Downloading %d file(s) from %s' % (len(names), tier))
+      record = beginStage(tier, len(names))
+      failed = downloadBatch(options, [ [name, uriList(name)] for name in names ], dir, concurrency, expected)
+      endStage(record, len(names) - len(failed))
+      if tier == 'international' and not record is None:
+         chargeBudget(record['bytes'])
+      for name in names:
+         if not name in failed:
+            served[name] = tier
+      return failed
+
+   misses = {}
+   for name in remaining:
+      misses[name] = knownMisses(name)
+
+   def stageUris(names, uriList):
+      # Splits names into those with something to try in a stage and those that skip it
+      tried = []
+      skipped = []
+      for name in names:
+         if len(uriList(name)) > 0:
+            tried.append(name)
+         else:
+            skipped.append(name)
+      return tried, skipped
+
+   def probed(names, uriList, tier=None):
+      # The uri lists of a stage after probing them all at once (if --probe)
+      lists = probeTiers(dict([ (name, uriList(name)) for name in names ]), tier)
+      return lambda name: lists.get(name, [])
+
+   if not INTERNAL_MIRRORS is None and len(INTERNAL_MIRRORS) > 0:
+      internalUris = probed(remaining, lambda name: mirrorUris(INTERNAL_MIRRORS, name, misses[name]))
+      names, skipped = stageUris(remaining, internalUris)
+      countCache('skipped', len(skipped))
+      remaining = stage('internal', names, internalUris) + skipped
+
+   def tierUris(name, tierMirrors, mirrorsOnly=False, fetchLayouts=True):
+      uris = []
+      for url in urls[name]:
+         candidates = []
+         if appendMirrors(url, urlparse(url).netloc, name, candidates, tierMirrors, misses[name], fetchLayouts) or \
+            not mirrorsOnly:
+            for uri in candidates:
+               if not uri in uris:
+                  uris.append(uri)
+      return uris
+
+   if len(remaining) > 0:
+      deferred = []
+      if mustSwitch:
+         # Files that are not on a Gentoo mirror are probably not local so go straight to international, as do
+         # files known not to be on the local mirrors
+         deferred = [ name for name in remaining if len(tierUris(name, mirrors, True, False)) == 0 or
+                      '@local' in misses[name] ]
+         countCache('skipped', len([ name for name in deferred if '@local' in misses[name] ]))
+         remaining = [ name for name in remaining if not name in deferred ]
+      tier = None
+      if mustSwitch:
+         tier = 'local'
+      # With switching the uris are built and probed once switched to local, where the local mirrors' layout.conf
+      # can be fetched and the local mirrors reached
+      names, skipped = stageUris(remaining, lambda name: tierUris(name, mirrors, mustSwitch, not mustSwitch))
+      if mustSwitch and len(names) > 0:
+         ip = acquireLink('local', local, interface)
+         if ip is None:
+            printErr('Error: Could not switch to local connection using %s (checking interface %s)' %
+            (local, interface))
+            return len(remaining) + len(deferred)
+         if VERBOSE:
+            print("Switched to local connection using IP " + ip)
+      try:
+         localUris = probed(names, lambda name: tierUris(name, mirrors, mustSwitch), tier)
+         tried, missing = stageUris(names, localUris)
+         countCache('skipped', len(missing))
+         remaining = stage('local', tried, localUris) + missing + skipped + deferred
+      finally:
+         if mustSwitch and len(names) > 0:
+            releaseLink('local', local, interface)
+
+   # Built once switched to international, where the international mirrors' layout.conf can be fetched
+   internationalUris = lambda name: tierUris(name, INTERNATIONAL_MIRRORS)
+   names, skipped = stageUris(remaining, lambda name: tierUris(name, INTERNATIONAL_MIRRORS, False, False))
+   if len(names) > 0 and mustSwitch:
+      sizes = {}
+      for name in names:
+         sizes[name] = expected.get(name, {}).get('size')
+         progress = controlProgress(os.path.join(dir, name), sizes[name])
+         if not sizes[name] is None and not progress is None:
+            sizes[name] -= progress # Only the rest goes over international
+      names, deferred, refused = scheduleInternational(sizes)
+      for name in deferred:
+         deferFetch(name, urls[name], dir, expected.get(name))
+         served[name] = None
+      skipped.extend(deferred + refused)
+      remaining = names + skipped
+   if len(names) > 0 and mustSwitch:
+      ip = acquireLink('international', international, interface)
+      if not ip is None:
+         try:
+            if VERBOSE:
+               print(green() + "Switched to international (%s) " % (ip,))
+            remaining = stage('international', names, internationalUris) + skipped
+         finally:
+            ip = releaseLink('international', local, interface)
+            if ip is None:
+               print(red() + "Failed to switch back to local")
+            elif VERBOSE and ip != '':
+               print(green() + "Switched to local (%s) " % (ip,))
+
+   if len(remaining) > 0 and useDownman:
+      names = [ name for name in remaining if not name in served ] # Not deferred
+      remaining = stage('downman', names,
+                        lambda name: ['http://www.voidspace.org.uk/cgi-bin/voidspace/downman.py?file=' + name]) + \
+                  [ name for name in remaining if not name in names ]
+
+   for name, uris in jobs:
+      if name in served and served[name] is None:
+         print(yellow() + '%-50s DEFERRED' % (name,))
+      elif name in served:
+         print(green() + '%-50s OK (%s)' % (name, served[name]))
+      else:
+         print(red() + '%-50s FAILED' % (name,))
+   return len(remaining)
+
+def pidAlive(pid):
+   try:
+      os.kill(pid, 0)
+      return True
+   except OSError, e:
+      return e.errno == errno.EPERM # Alive but owned by another user (eg. root vs portage)
+
+def acquireLink(target, script, interface):
+   # Coordinates connection switching between concurrent gentooget processes (parallel fetch, several
+   # emerges) using $GENTOOGET_DIR/link.json guarded by an flock. target is 'local' or 'international'.
+   # The link is only switched if it is not already in the target mode and is never switched away from
+   # a mode while other processes are downloading on it (for up to LINK_WAIT seconds), so the first
+   # process needing international opens an international window which later failures share. While a
+   # process is waiting for international no new local downloads start so that the window is not
+   # starved. Processes waiting on the lock queue behind a switch in progress. Without link.json (eg. a state
+   # directory this user cannot use) the link is switched as if no other process were using it.
+   # Returns the interface ip once the link is in the target mode or None if switching failed.
+   other = 'international'
+   if target == 'international':
+      other = 'local'
+   pid = os.getpid()
+   start = time.time()
+   waiting = False
+   while True:
+      lock = None
+      try:
+         try:
+            lock = lockState('link.json')
+         except (IOError, OSError), e:
+            stateError('link.json', e)
+            switched = time.time()
+            ip = switchConnection(script, interface)
+            countSwitch(target, switched - start, time.time() - switched, not ip is None)
+            return ip
+         state = loadState('link.json', {})
+         for key in ('local', 'international', 'pending'):
+            state[key] = [ p for p in state.get(key, []) if p != pid and pidAlive(p) ]
+         blocked = len(state[other]) > 0 or (target == 'local' and len(state['pending']) > 0)
+         if blocked and time.time() - start < LINK_WAIT:
+            if target == 'international':
+               state['pending'].append(pid)
+            saveLink(state)
+            if not waiting and VERBOSE:
+               print(yellow() + 'Waiting for %d %s download(s) to finish before using the %s connection' %
+                     (len(state[other]), other, target))
+            waiting = True
+         else:
+            ip = None
+            if state.get('mode') == target:
+               ip = interfaceIp(interface)
+            if ip is None:
+               switched = time.time()
+               ip = switchConnection(script, interface)
+               countSwitch(target, switched - start, time.time() - switched, not ip is None)
+               if ip is None:
+                  state['mode'] = None
+                  saveLink(state)
+                  return None
+            else:
+               countSwitch(target, time.time() - start, None, True)
+               if DEBUG:
+                  print(green() + 'Connection already %s (%s)' % (target, ip))
+            state['mode'] = target
+            state[target].append(pid)
+            saveLink(state)
+            return ip
+      finally:
+         if not lock is None:
+            lock.close()
+      time.sleep(1)
+
+def releaseLink(target, local, interface):
+   # Counterpart of acquireLink. When the last international download finishes (and nobody is waiting to
+   # start one) the link is switched back to local, as it always is without link.json. Returns the local ip if
+   # the link was switched back, '' if it was left as is and None if switching back failed.
+   pid = os.getpid()
+   lock = None
+   try:
+      try:
+         lock = lockState('link.json')
+      except (IOError, OSError), e:
+         stateError('link.json', e)
+         if target != 'international':
+            return ''
+         switched = time.time()
+         ip = switchConnection(local, interface)
+         countSwitch('local', 0, time.time() - switched, not ip is None)
+         return ip
+      state = loadState('link.json', {})
+      for key in ('local', 'international', 'pending'):
+         state[key] = [ p for p in state.get(key, []) if p != pid and pidAlive(p) ]
+      ip = ''
+      if target == 'international' and len(state['international']) == 0 and len(state['pending']) == 0:
+         switched = time.time()
+         ip = switchConnection(local, interface)
+         countSwitch('local', 0, time.time() - switched, not ip is None)
+         if ip is None:
+            state['mode'] = None
+         else:
+            state['mode'] = 'local'
+      elif target == 'international' and VERBOSE:
+         print(yellow() + 'Leaving the international connection up for %d other download(s)' %
+               (len(state['international']) + len(state['pending']),))
+      saveLink(state)
+      return ip
+   finally:
+      if not lock is None:
+         lock.close()
+
+def saveLink(state):
+   # A switch made without telling other processes is still made
+   try:
+      saveState('link.json', state)
+   except (IOError, OSError), e:
+      stateError('link.json', e)
+
+def parseSize(text):
+   # Bytes from eg. 500000, 200K, 1.5G
+   text = text.strip().upper()
+   scale = 1
+   for suffix, multiplier in (('K', 1024), ('M', 1024**2), ('G', 1024**3), ('T', 1024**4)):
+      if text.endswith(suffix) or text.endswith(suffix + 'B'):
+         text = text[:text.rfind(suffix)]
+         scale = multiplier
+         break
+   size = int(float(text) * scale)
+   if size < 0:
+      raise ValueError(text)
+   return size
+
+def parseWindow(text):
+   # (start, end) minutes of the day from HH:MM-HH:MM. The window may wrap around midnight.
+   window = []
+   for part in text.split('-'):
+      hours, minutes = part.strip().split(':')
+      if not (0 <= int(hours) < 24 and 0 <= int(minutes) < 60):
+         raise ValueError(text)
+      window.append(int(hours) * 60 + int(minutes))
+   if len(window) != 2:
+      raise ValueError(text)
+   return tuple(window)
+
+def offPeak(now=None):
+   if OFF_PEAK is None:
+      return True
+   t = time.localtime(now)
+   minute = t.tm_hour * 60 + t.tm_min
+   start, end = OFF_PEAK
+   if start <= end:
+      return start <= minute < end
+   return minute >= start or minute < end
+
+def billingPeriod(now=None):
+   # The date the current billing period started (BILLING_DAY of this or last month, or the last day of shorter
+   # months)
+   t = time.localtime(now)
+   year, month = t.tm_year, t.tm_mon
+   def start(year, month):
+      days = [ 31, 29, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31 ][month - 1]
+      if month == 2 and (year % 4 != 0 or (year % 100 == 0 and year % 400 != 0)):
+         days = 28
+      return '%04d-%02d-%02d' % (year, month, min(BILLING_DAY, days))
+   period = start(year, month)
+   if period > time.strftime('%Y-%m-%d', t):
+      if month == 1:
+         period = start(year - 1, 12)
+      else:
+         period = start(year, month - 1)
+   return period
+
+def budgetUsed():
+   usage = loadState('budget.json', {})
+   if usage.get('period') != billingPeriod():
+      return 0
+   return usage.get('bytes', 0)
+
+def chargeBudget(bytes):
+   # Adds bytes downloaded over the international connection to the current billing period
+   if bytes <= 0:
+      return
+   period = billingPeriod()
+   def update(usage):
+      if usage.get('period') != period:
+         usage.clear()
+         usage['period'] = period
+      usage['bytes'] = usage.get('bytes', 0) + bytes
+   updateState('budget.json', update)
+
+def scheduleInternational(sizes):
+   # Applies the international policy to the files in sizes (name -> size in bytes or None if unknown). Returns
+   # the names to fetch now (smallest first so that a budget covers as many files as possible), those to defer
+   # to the off-peak window and those refused as over budget. Unknown sizes count as 0 until downloaded (but
+   # are over budget once it is used up).
+   fetchNow = []
+   deferred = []
+   refused = []
+   order = sorted([ (size or 0, name) for name, size in sizes.items() ])
+   peak = not offPeak()
+   left = None
+   if BUDGET > 0:
+      left = BUDGET - budgetUsed()
+   for size, name in order:
+      if peak and size >= DEFER_SIZE:
+         deferred.append(name)
+      elif not left is None and (size > left or left <= 0):
+         described = '%s (%s bytes)' % (name, sizes[name] or 'unknown')
+         if OVER_BUDGET == 'refuse':
+            printErr('%s would exceed the international budget (%d of %d bytes left)' %
+                     (described, max(left, 0), BUDGET))
+            refused.append(name)
+         else:
+            print(yellow() + 'WARNING: %s exceeds the international budget (%d of %d bytes left)' %
+                  (described, max(left, 0), BUDGET))
+            fetchNow.append(name)
+            left -= size
+      else:
+         fetchNow.append(name)
+         if not left is None:
+            left -= size
+   return fetchNow, deferred, refused
+
+def deferFetch(name, urls, dir, expected):
+   # Queues name in $GENTOOGET_DIR/deferred.json for --fetch-deferred, which only its owner can write
+   def update(queue):
+      queue[name] = { 'urls': urls, 'dir': os.path.abspath(dir), 'expected': expected or {}, 'queued': time.time() }
+   updateState('deferred.json', update, 0640)
+   print(yellow() + '%s deferred to the off-peak international window (run gentooget --fetch-deferred then)' %
+         (name,))
+
+def deferredJobs(dir):
+   # The downloads queued for dir by deferFetch as (name, entry) sorted by name. --fetch-deferred may run as root
+   # so entries that no fetch into dir could have queued (another directory, a name that is a path or hidden,
+   # uris other than http, https or ftp) are left out, to only ever write distfiles into dir.
+   jobs = []
+   for name, entry in sorted(loadState('deferred.json', {}).items()):
+      try:
+         if os.path.realpath(entry['dir']) != os.path.realpath(dir):
+            if DEBUG:
+               print(yellow() + '%s is deferred for %s' % (name, entry['dir']))
+            continue
+         name = name.encode('utf-8') # json gives unicode, the values end up as aria2c arguments
+         urls = [ url.encode('utf-8') for url in entry['urls'] ]
+         expected = entry.get('expected') or {}
+         valid = name != '' and not '/' in name and not name.startswith('.') and len(urls) > 0 and \
+                 len([ url for url in urls if not urlparse(url).scheme in ('http', 'https', 'ftp') ]) == 0 and \
+                 isinstance(expected, dict)
+      except (KeyError, TypeError, AttributeError):
+         valid = False
+      if not valid:
+         printErr('Ignoring the deferred download of %r' % (name,))
+         continue
+      jobs.append((name, { 'urls': urls, 'expected': expected }))
+   return jobs
+
+def newHash(algorithm):
+   # hashlib object for a Manifest algorithm name or None if this Python cannot compute it
+   name = HASH_NAMES.get(algorithm)
+   if name is None:
+      return None
+   try:
+      return hashlib.new(name)
+   except ValueError:
+      if name == 'blake2b' and not pyblake2 is None:
+         return pyblake2.blake2b()
+      return None
+
+def hashFile(path, algorithms):
+   # Computes all the digests in a single pass over the file using large reads
+   hashes = {}
+   for algorithm in algorithms:
+      hashes[algorithm] = newHash(algorithm)
+   fd = open(path, 'rb')
+   try:
+      while True:
+         data = fd.read(HASH_BUFFER_SIZE)
+         if not data:
+            break
+         for h in hashes.values():
+            h.update(data)
+   finally:
+      fd.close()
+   digests = {}
+   for algorithm, h in hashes.items():
+      digests[algorithm] = h.hexdigest()
+   return digests
+
+def readManifest(path, name):
+   # Size and digests of name from the DIST line of a Manifest eg.
+   # DIST foo-1.0.tar.gz 12345 BLAKE2B 1f2e... SHA512 9a8b...
+   fd = None
+   try:
+      try:
+         fd = open(path, 'r')
+         for line in fd:
+            fields = line.split()
+            if len(fields) >= 3 and fields[0] == 'DIST' and fields[1] == name:
+               digests = { 'size': int(fields[2]) }
+               for i in range(3, len(fields) - 1, 2):
+                  digests[fields[i]] = fields[i+1].lower()
+               return digests
+      except (IOError, ValueError):
+         pass
+      return None
+   finally:
+      if not fd is None:
+         fd.close()
+
+def manifestCandidates(manifests):
+   # The Manifests given with --manifest, otherwise the one belonging to the ebuild Portage is fetching for
+   candidates = list(manifests)
+   if len(candidates) == 0:
+      if os.environ.get('EBUILD'):
+         candidates.append(os.path.join(os.path.dirname(os.environ['EBUILD']), 'Manifest'))
+      if os.environ.get('O'):
+         candidates.append(os.path.join(os.environ['O'], 'Manifest'))
+      if os.environ.get('CATEGORY') and os.environ.get('PN'):
+         for tree in (os.environ.get('PORTDIR'), '/var/db/repos/gentoo', '/usr/portage'):
+            if tree:
+               candidates.append(os.path.join(tree, os.environ['CATEGORY'], os.environ['PN'], 'Manifest'))
+   return candidates
+
+def expectedDigests(name, manifests, digests):
+   # Combines digests given on the command line with those in the first Manifest that lists name
+   expected = {}
+   for path in manifestCandidates(manifests):
+      if os.path.isfile(path):
+         found = readManifest(path, name)
+         if not found is None:
+            if DEBUG:
+               print(green() + 'Digests for %s from %s' % (name, path))
+            expected.update(found)
+            break
+   expected.update(digests)
+   return expected
+
+def fileKey(st):
+   return '%d:%d:%d:%r' % (st.st_dev, st.st_ino, st.st_size, st.st_mtime)
+
+def digestShard(st):
+   return 'digests/%02x.json' % (st.st_ino % DIGEST_SHARDS,)
+
+def verifyFile(path, expected):
+   # Checks path against the expected size and digests. Digests are cached by (device, inode, size, mtime) in
+   # $GENTOOGET_DIR/digests/ so an unchanged file is never hashed twice. Algorithms this Python cannot
+   # compute (eg. BLAKE2B without pyblake2) are skipped; if none are left only the size is checked.
+   if expected is None or len(expected) == 0:
+      return True
+   try:
+      st = os.stat(path)
+   except OSError:
+      return False
+   if 'size' in expected and st.st_size != expected['size']:
+      if VERBOSE:
+         printErr('%s is %d bytes, expected %d' % (path, st.st_size, expected['size']))
+      return False
+   algorithms = [ algorithm for algorithm in expected if not newHash(algorithm) is None ]
+   if len(algorithms) == 0:
+      if DEBUG:
+         print(yellow() + 'No usable digest for %s (have %s)' % (path, ', '.join(expected.keys())))
+      return True
+   key = fileKey(st)
+   shard = digestShard(st)
+   cached = loadState(shard, {}).get(key, {})
+   missing = [ algorithm for algorithm in algorithms if not algorithm in cached ]
+   if len(missing) > 0:
+      if DEBUG:
+         print(green() + 'Hashing %s (%s)' % (path, ', '.join(missing)))
+      cached.update(hashFile(path, missing))
+      def update(cache):
+         if len(cache) >= max(2, DIGEST_CACHE_SIZE // DIGEST_SHARDS): # Forget the least recently hashed half
+            entries = sorted(cache.items(), key=lambda entry: entry[1].get('time', 0))
+            for oldKey, entry in entries[:len(entries) // 2]:
+               del cache[oldKey]
+         cached['path'] = path
+         cached['time'] = time.time()
+         cache[key] = cached
+      updateState(shard, update)
+   else:
+      countCache('digests')
+      if DEBUG:
+         print(green() + 'Using cached digests for ' + path)
+   for algorithm in algorithms:
+      if cached[algorithm] != expected[algorithm].lower():
+         printErr('%s %s digest mismatch' % (path, algorithm))
+         return False
+   return True
+
+def libcSendfile():
+   # Python 2 has no os.sendfile so call the libc one through ctypes. Returns None if that is not possible
+   # in which case files are copied through user space.
+   global SENDFILE
+   if SENDFILE is None:
+      SENDFILE = False
+      try:
+         import ctypes
+         import ctypes.util
+         libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+         sendfile = libc.sendfile64
+         sendfile.argtypes = [ ctypes.c_int, ctypes.c_int, ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t ]
+         sendfile.restype = ctypes.c_ssize_t
+         def call(out, fd, offset, count):
+            off = ctypes.c_int64(offset)
+            sent = sendfile(out, fd, ctypes.byref(off), count)
+            if sent < 0:
+               e = ctypes.get_errno()
+               raise OSError(e, os.strerror(e))
+            return sent
+         SENDFILE = call
+      except (ImportError, OSError, AttributeError):
+         pass
+   if SENDFILE is False:
+      return None
+   return SENDFILE
+
+def sendFile(sock, fd, offset, count):
+   # Zero copy transfer of count bytes from offset in fd to sock
+   sendfile = libcSendfile()
+   if sendfile is None:
+      os.lseek(fd.fileno(), offset, os.SEEK_SET)
+      while count > 0:
+         data = fd.read(min(count, 262144))
+         if not data:
+            break
+         sock.sendall(data)
+         count -= len(data)
+      return
+   while count > 0:
+      try:
+         sent = sendfile(sock.fileno(), fd.fileno(), offset, count)
+      except OSError, e:
+         if e.errno in (errno.EAGAIN, errno.EINTR): # Socket has a timeout so is non-blocking
+            select.select([], [sock], [], 60)
+            continue
+         raise
+      if sent == 0:
+         break
+      offset += sent
+      count -= sent
+
+class DistfilesHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+   # Serves <dir>/<name> as /distfiles/<name> (the layout INTERNAL_MIRRORS expects) or /<name>, and under the
+   # hashed paths of the layouts in layout.conf (eg. /distfiles/ab/<name>) wherever it is in the directory
+   protocol_version = 'HTTP/1.1'
+   timeout = 120 # Idle keep-alive connections are closed after this
+
+   def do_GET(self):
+      self.sendDistfile(True)
+
+   def do_HEAD(self):
+      self.sendDistfile(False)
+
+   def sendDistfile(self, withBody):
+      path = urlparse(self.path).path
+      if path.startswith('/distfiles/'):
+         path = path[len('/distfiles/'):]
+      parts = path.strip('/').split('/')
+      name = parts[-1]
+      if name in ('', '.', '..') or \
+         len([ part for part in parts[:-1] if len(part) == 0 or part.strip('0123456789abcdef') != '' ]) > 0:
+         self.send_error(404)
+         return
+      if name == 'layout.conf':
+         if len(parts) > 1 or not os.path.isfile(os.path.join(self.server.dir, name)):
+            self.send_error(404) # Flat, and never fetched from the mirrors (which have a different layout)
+            return
+         fullPath = os.path.join(self.server.dir, name)
+      elif name.endswith(DELTA_SUFFIX) and self.server.find(name, False) is None:
+         # Block index for --delta of a file that is here (misses are not fetched for an index)
+         fullPath = self.server.find(name[:-len(DELTA_SUFFIX)], False)
+         if fullPath is None:
+            self.send_error(404)
+            return
+         body = json.dumps(self.server.index(fullPath))
+         self.send_response(200)
+         self.send_header('Content-Type', 'application/json')
+         self.send_header('Content-Length', str(len(body)))
+         self.end_headers()
+         if withBody:
+            self.wfile.write(body)
+         return
+      else:
+         fullPath = self.server.find(name, withBody)
+      if fullPath is None and not withBody and not self.server.fetchArgs is None:
+         # A GET would fetch it so tell a --probe that it is here (but not how big it is)
+         self.send_response(200)
+         self.send_header('Content-Type', 'application/octet-stream')
+         self.send_header('Accept-Ranges', 'bytes')
+         self.end_headers()
+         return
+      if fullPath is None:
+         self.send_error(404)
+         return
+      fd = open(fullPath, 'rb')
+      try:
+         st = os.fstat(fd.fileno())
+         size = st.st_size
+         start, end = 0, size - 1
+         ranged = self.parseRange(size)
+         if ranged is False:
+            self.send_response(416)
+            self.send_header('Content-Range', 'bytes */%d' % size)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+         if ranged is None:
+            self.send_response(200)
+         else:
+            start, end = ranged
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end, size))
+         self.send_header('Content-Type', 'application/octet-stream')
+         self.send_header('Content-Length', str(end - start + 1))
+         self.send_header('Accept-Ranges', 'bytes')
+         self.send_header('Last-Modified', self.date_time_string(st.st_mtime))
+         self.end_headers()
+         if withBody and end >= start:
+            self.wfile.flush()
+            sendFile(self.connection, fd, start, end - start + 1)
+      finally:
+         fd.close()
+
+   def parseRange(self, size):
+      # (start, end) for a single "Range: bytes=" range, None to send the whole file, False if unsatisfiable
+      header = self.headers.getheader('Range')
+      if header is None or not header.startswith('bytes=') or header.find(',') >= 0:
+         return None
+      first, sep, last = header[6:].strip().partition('-')
+      try:
+         if first == '':
+            start, end = max(0, size - int(last)), size - 1
+         elif last == '':
+            start, end = int(first), size - 1
+         else:
+            start, end = int(first), min(int(last), size - 1)
+      except ValueError:
+         return None
+      if start >= size or start > end:
+         return False
+      return (start, end)
+
+   def log_message(self, format, *args):
+      if VERBOSE:
+         BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+class DistfilesServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+   # HTTP server for a distfiles directory for use as an INTERNAL_MIRRORS entry. Files that are missing are
+   # fetched once through the normal mirror chain (by running gentooget with fetchArgs for the file under
+   # fetchUrl) while any other requests for the same file wait, and are served from the directory from then
+   # on. HEAD requests do not fetch anything. If the directory has a layout.conf fetched files are stored in
+   # its preferred layout (eg. filename-hash BLAKE2B 8 for subdirectories 00 to ff) and it is served to
+   # clients so that they ask for that layout.
+   daemon_threads = True
+   allow_reuse_address = True
+   request_queue_size = 64
+
+   def __init__(self, address, dir, connections, fetchArgs, fetchUrl):
+      BaseHTTPServer.HTTPServer.__init__(self, address, DistfilesHandler)
+      self.dir = dir
+      self.fetchArgs = fetchArgs
+      self.fetchUrl = fetchUrl
+      self.layouts = [ [ 'flat' ] ]
+      if os.path.isfile(os.path.join(dir, 'layout.conf')):
+         fd = open(os.path.join(dir, 'layout.conf'), 'r')
+         try:
+            self.layouts = parseLayoutConf(fd.read())
+         finally:
+            fd.close()
+      self.slots = threading.BoundedSemaphore(connections)
+      self.lock = threading.Lock()
+      self.fetching = {}
+      self.indexes = {}
+
+   def process_request(self, request, client_address):
+      self.slots.acquire() # Limits the number of connections being served
+      try:
+         SocketServer.ThreadingMixIn.process_request(self, request, client_address)
+      except:
+         self.slots.release()
+         raise
+
+   def process_request_thread(self, request, client_address):
+      try:
+         SocketServer.ThreadingMixIn.process_request_thread(self, request, client_address)
+      finally:
+         self.slots.release()
+
+   def complete(self, fullPath):
+      return os.path.isfile(fullPath) and os.path.getsize(fullPath) > 0 and not os.path.exists(fullPath + '.aria2')
+
+   def locations(self, name):
+      # Where name may be in the directory, the preferred one (where fetched files go) first
+      paths = []
+      for layout in self.layouts + [ [ 'flat' ] ]:
+         path = layoutPath(layout, name)
+         if not path is None and not path in paths:
+            paths.append(path)
+      return [ os.path.join(self.dir, path) for path in paths ]
+
+   def index(self, fullPath):
+      # Block index of fullPath (see makeIndex), made once per version of the file
+      st = os.stat(fullPath)
+      key = (fullPath, st.st_size, st.st_mtime)
+      self.lock.acquire()
+      try:
+         index = self.indexes.get(key)
+      finally:
+         self.lock.release()
+      if index is None:
+         index = makeIndex(fullPath)
+         self.lock.acquire()
+         try:
+            if len(self.indexes) >= 64:
+               self.indexes.clear()
+            self.indexes[key] = index
+         finally:
+            self.lock.release()
+      return index
+
+   def find(self, name, pull=True):
+      locations = self.locations(name)
+      for fullPath in locations:
+         if self.complete(fullPath):
+            return fullPath
+      fullPath = locations[0]
+      if self.fetchArgs is None or not pull:
+         return None
+      self.lock.acquire()
+      try:
+         done = self.fetching.get(name)
+         owner = done is None
+         if owner:
+            done = self.fetching[name] = threading.Event()
+      finally:
+         self.lock.release()
+      if owner:
+         try:
+            try:
+               os.makedirs(os.path.dirname(fullPath))
+            except OSError, e:
+               if e.errno != errno.EEXIST:
+                  raise
+            args = self.fetchArgs + ['-d', os.path.dirname(fullPath), '-f', name, '-u', self.fetchUrl + name]
+            if VERBOSE:
+               print(green() + 'Fetching ' + name + ' for the cache')
+            if DEBUG:
+               print(green() + concatOpts(args))
+            subprocess.call(args)
+         finally:
+            self.lock.acquire()
+            try:
+               del self.fetching[name]
+            finally:
+               self.lock.release()
+            done.set()
+      else:
+         done.wait()
+      if self.complete(fullPath):
+         return fullPath
+      return None
+
+def serveDistfiles(dir, port, connections, fetchArgs, fetchUrl):
+   if not os.path.isdir(dir):
+      printErr('ERROR: ' + dir + ' is not a directory')
+      return 1
+   try:
+      server = DistfilesServer(('', port), os.path.realpath(dir), connections, fetchArgs, fetchUrl)
+   except socket.error, e:
+      printErr('ERROR: Could not listen on port %d (%s)' % (port, str(e)))
+      return 1
+   def stop(signum, frame):
+      raise SystemExit(0)
+   signal.signal(signal.SIGTERM, stop)
+   if VERBOSE:
+      print(green() + 'Serving %s on port %d' % (dir, port))
+   try:
+      server.serve_forever()
+   except (KeyboardInterrupt, SystemExit):
+      pass
+   server.server_close()
+   return 0
+
+def knownMisses(name):
+   # The uris of name that recently returned not found (and '@local' if no local mirror had it) mapped to when
+   # that expires
+   if MISS_TTL <= 0:
+      return {}
+   now = time.time()
+   misses = loadState('misses.json', {}).get(name, {})
+   return dict([ (key, expires) for key, expires in misses.items() if expires > now ])
+
+def recordMisses(name, uris, status, tier=None):
+   # Remembers uris as not having name for MISS_TTL seconds if the download failed with not found, and that
+   # tier as exhausted if given. The misses are kept after name is found elsewhere so that fetching it again
+   # (eg. a re-emerge) goes straight to where it was found.
+   if MISS_TTL <= 0 or status != NOT_FOUND:
+      return
+   now = time.time()
+   def update(misses):
+      for key in misses.keys(): # Drop anything expired while we have the lock
+         for uri, expires in misses[key].items():
+            if expires <= now:
+               del misses[key][uri]
+         if len(misses[key]) == 0:
+            del misses[key]
+      entry = misses.setdefault(name, {})
+      for uri in uris:
+         entry[uri] = now + MISS_TTL
+      if not tier is None:
+         entry['@' + tier] = now + MISS_TTL
+   updateState('misses.json', update)
+
+class Prober:
+   # Finds out which uris exist using HEAD (http/https) or SIZE (ftp) requests made concurrently by a pool of
+   # threads within an overall deadline. Idle connections are kept per host and reused by later requests.
+   def __init__(self, timeout, threads=PROBE_THREADS):
+      self.timeout = timeout
+      self.threads = threads
+      self.idle = {}
+      self.lock = threading.Lock()
+
+   def probe(self, uris):
+      # Returns uri -> size for uris that exist (-1 if the size is not known) or None for uris that do not.
+      # Uris that could not be checked in time (or at all, eg. file://) are left out.
+      results = {}
+      pending = list(uris)
+      deadline = time.time() + self.timeout
+      def worker():
+         while time.time() < deadline:
+            self.lock.acquire()
+            try:
+               if len(pending) == 0:
+                  return
+               uri = pending.pop(0)
+            finally:
+               self.lock.release()
+            try:
+               found = self.check(uri, deadline, 3)
+               if found != False:
+                  results[uri] = found
+            except (socket.error, httplib.HTTPException, ftplib.all_errors, ValueError):
+               pass
+      workers = []
+      for i in range(min(self.threads, len(pending))):
+         t = threading.Thread(target=worker)
+         t.setDaemon(True) # Stragglers past the deadline are abandoned
+         t.start()
+         workers.append(t)
+      for t in workers:
+         t.join(max(0, deadline - time.time()))
+      return dict(results)
+
+   def check(self, uri, deadline, redirects):
+      # Size, -1, None as for probe or False if the answer is not conclusive
+      uo = urlparse(uri)
+      timeout = max(0.1, deadline - time.time())
+      key = (uo.scheme, uo.netloc)
+      connection = self.take(key)
+      if uo.scheme == 'ftp':
+         if connection is None:
+            connection = ftplib.FTP(timeout=timeout)
+            connection.connect(uo.hostname, uo.port or 21)
+            connection.login(uo.username or 'anonymous', uo.password or 'anonymous@')
+            connection.voidcmd('TYPE I')
+         try:
+            size = connection.size(uo.path)
+         except ftplib.error_perm, e:
+            self.give(key, connection)
+            if str(e)[:3] == '550':
+               return None # No such file
+            return False # eg. 500 or 502 when the server has no SIZE
+         self.give(key, connection)
+         if size is None:
+            return False # Answered but not with 213
+         return size
+      if not uo.scheme in ('http', 'https'):
+         return False
+      if connection is None:
+         connection = httpConnection(uo, timeout)
+      path = uo.path
+      if uo.query:
+         path += '?' + uo.query
+      connection.request('HEAD', path, headers={ 'User-Agent': 'gentooget/' + VERSION })
+      response = connection.getresponse()
+      response.read()
+      if response.will_close:
+         connection.close()
+      else:
+         self.give(key, connection)
+      if response.status in (301, 302, 303, 307, 308) and redirects > 0 and response.getheader('Location'):
+         return self.check(urljoin(uri, response.getheader('Location')), deadline, redirects - 1)
+      if response.status in (404, 410):
+         return None
+      if response.status != 200:
+         return False
+      try:
+         return int(response.getheader('Content-Length', -1))
+      except ValueError:
+         return -1
+
+   def take(self, key):
+      self.lock.acquire()
+      try:
+         connections = self.idle.get(key, [])
+         if len(connections) > 0:
+            return connections.pop()
+         return None
+      finally:
+         self.lock.release()
+
+   def give(self, key, connection):
+      self.lock.acquire()
+      try:
+         self.idle.setdefault(key, []).append(connection)
+      finally:
+         self.lock.release()
+
+   def close(self):
+      for connections in self.idle.values():
+         for connection in connections:
+            try:
+               connection.close()
+            except:
+               pass
+      self.idle = {}
+
+def httpConnection(uo, timeout):
+   # Keep-alive connection for a parsed http or https uri
+   if uo.scheme == 'https':
+      if hasattr(ssl, '_create_unverified_context'): # aria2 is run with --check-certificate=false too
+         return httplib.HTTPSConnection(uo.hostname, uo.port, timeout=timeout, context=ssl._create_unverified_context())
+      return httplib.HTTPSConnection(uo.hostname, uo.port, timeout=timeout)
+   return httplib.HTTPConnection(uo.hostname, uo.port, timeout=timeout)
+
+def probeTiers(lists, tier=None):
+   # With --probe checks all the uris in lists (name -> uris) at once and keeps only the uris that have each
+   # file, or if none of them could be confirmed those that could not be checked. Uris that definitely do not
+   # have a file are recorded as misses (along with the tier if none of them have it).
+   if not PROBE:
+      return lists
+   uris = []
+   for name in lists:
+      uris.extend([ uri for uri in lists[name] if not uri in uris ])
+   if len(uris) == 0:
+      return lists
+   start = time.time()
+   prober = Prober(PROBE_TIMEOUT)
+   try:
+      results = prober.probe(uris)
+   finally:
+      prober.close()
+   if DEBUG:
+      print(green() + 'Probed %d uri(s) in %.2fs: %d found, %d missing' % (len(uris), time.time() - start,
+            len([ r for r in results.values() if not r is None ]), len([ r for r in results.values() if r is None ])))
+   kept = {}
+   for name, candidates in lists.items():
+      present = [ uri for uri in candidates if uri in results and not results[uri] is None ]
+      missing = [ uri for uri in candidates if uri in results and results[uri] is None ]
+      unknown = [ uri for uri in candidates if not uri in results ]
+      if len(present) > 0:
+         kept[name] = present
+      else:
+         kept[name] = unknown
+      if len(missing) > 0:
+         exhausted = None
+         if len(missing) == len(candidates):
+            exhausted = tier
+         recordMisses(name, missing, NOT_FOUND, exhausted)
+   return kept
+
 def concatOpts(opts):
    ret = ''
    for opt in opts:
@@ -0,0 +1,866 @@
+#!/usr/bin/env python
+
+#gentoogetbench - Offline benchmark of the gentooget download fallback chain
+#    Copyright (C) 2010  Donald Munro
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/gpl-3.0.html>.
+#
+# Runs emerge like download workloads through gentooget (one process per file as Portage's FETCHCOMMAND does,
+# several at once as parallel-fetch does, or a single --batch) against HTTP and FTP mirror stand-ins on the
+# loopback addresses with configurable latency, bandwidth, missing files and transfers cut off part way, and
+# fake --local/--international scripts which bring the link back up after a delay. Everything generated
+# (distfiles, Manifest, make.conf, scripts) is derived from the workload's seed so runs are reproducible.
+
+import os
+import os.path
+import sys
+import errno
+import time
+import json
+import getopt
+import random
+import math
+import hashlib
+import shutil
+import socket
+import tempfile
+import threading
+import subprocess
+import posixpath
+import BaseHTTPServer
+import SocketServer
+from urlparse import urlparse
+
+VERSION = "0.2"
+GENTOOGET = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'gentooget.py')
+GENTOOGET_FAST = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'gentoogetfast.py')
+# The fake switch scripts take the address of DUMMY_INTERFACE down and bring it back up after the workload's
+# switchDelay seconds. Without the dummy module (or root) lo is used and the scripts just take switchDelay.
+DUMMY_INTERFACE = 'ggbench0'
+DUMMY_ADDRESS = '10.254.254.1/32'
+CHUNK = 64*1024
+# A workload: the distfiles (count files with sizes spread evenly on a log scale from min to max), the mirror
+# stand-ins and the runs made over them. Mirror settings: tier (internal, local or international), protocol
+# (http or ftp), latency (seconds per request or FTP command), rate (bytes per second shared by all connections,
+# 0 for unlimited), missing (fraction of the files answered with not found), cutFiles (fraction of the files
+# whose first cutTimes transfers are cut off after cut of the file). Run settings: mode (single or batch),
+# jobs (concurrent gentooget processes for single, --jobs for batch) and extra gentooget options.
+DEFAULT_WORKLOAD = {
+   'seed': 1,
+   'files': { 'count': 16, 'min': '16K', 'max': '8M' },
+   'switchDelay': 1.0,
+   'mirrors': [
+      { 'name': 'internal', 'tier': 'internal', 'protocol': 'http', 'latency': 0.001, 'rate': '40M',
+        'missing': 0.5 },
+      { 'name': 'local-http', 'tier': 'local', 'protocol': 'http', 'latency': 0.01, 'rate': '8M', 'missing': 0.25,
+        'cutFiles': 0.2, 'cut': 0.6, 'cutTimes': 1 },
+      { 'name': 'local-ftp', 'tier': 'local', 'protocol': 'ftp', 'latency': 0.02, 'rate': '4M', 'missing': 0.25 },
+      { 'name': 'international', 'tier': 'international', 'protocol': 'http', 'latency': 0.15, 'rate': '2M' } ],
+   'runs': [
+      { 'name': 'emerge', 'mode': 'single', 'jobs': 1 },
+      { 'name': 'parallel-fetch', 'mode': 'single', 'jobs': 3 },
+      { 'name': 'batch', 'mode': 'batch', 'jobs': 4 } ] }
+
+def usage():
+   print("gentoogetbench %s" % (VERSION,))
+   print("""
+gentoogetbench [-h --help] [-w --workload=] [-e --engines=] [-r --runs=] [-n --repeat=] [-a --aria=]
+               [-k --keep=] [-j --json=] [-s --startup=] [-- gentooget options]
+     -h --help           : Display help.
+     -w --workload=      : JSON file describing the workload (defaults to the built in one, see
+                           DEFAULT_WORKLOAD in this script for the settings).
+     -e --engines=       : Comma separated gentooget engines to run each workload run with (default native,
+                           and aria2 if aria2c is installed).
+     -r --runs=          : Comma separated names of the workload runs to make (default all).
+     -n --repeat=        : Times to make each run (default 1).
+     -a --aria=          : The aria2c to use (default aria2c in the PATH).
+     -k --keep=          : Directory to generate everything in and keep afterwards (default a temporary
+                           directory which is removed).
+     -j --json=          : Also write the results to this file.
+     -s --startup=       : Instead of the workload time how long gentooget takes from being started to starting
+                           aria2c (a stand-in which downloads nothing) for a single file, --repeat times
+                           (default 20) run as gentooget.py and by the gentoogetfast.py launcher. Fails if the
+                           median for the launcher is over the given budget in milliseconds.
+Options after -- are passed to every gentooget invocation.
+
+Every run starts with an empty DISTDIR and $GENTOOGET_DIR and reports the wall time, the files fetched
+intact, the MB downloaded per tier (from gentooget's telemetry), the processes started (gentooget, aria2c
+and switch scripts) and the connection switches made and the time spent waiting for them.
+""")
+
+def printErr(s):
+   sys.stderr.write(s + '\n')
+
+def parseSize(text):
+   # Bytes from eg. 500000, 200K, 1.5G
+   text = str(text).strip().upper()
+   scale = 1
+   for suffix, multiplier in (('K', 1024), ('M', 1024**2), ('G', 1024**3)):
+      if text.endswith(suffix) or text.endswith(suffix + 'B'):
+         text = text[:text.rfind(suffix)]
+         scale = multiplier
+         break
+   return int(float(text) * scale)
+
+def which(program):
+   for directory in os.environ.get('PATH', '').split(os.pathsep):
+      path = os.path.join(directory, program)
+      if os.access(path, os.X_OK):
+         return path
+   return None
+
+class Mirror:
+   # A mirror stand-in's behaviour and counters, shared by its HTTP or FTP server threads
+   def __init__(self, config, address, names, store, rng):
+      self.name = config['name']
+      self.tier = config.get('tier', 'local')
+      self.protocol = config.get('protocol', 'http')
+      self.address = address
+      self.port = None
+      self.latency = float(config.get('latency', 0))
+      self.rate = parseSize(config.get('rate', 0))
+      self.store = store
+      self.missing = set(rng.sample(names, int(round(len(names) * float(config.get('missing', 0))))))
+      present = [ name for name in names if not name in self.missing ]
+      self.cutFiles = set(rng.sample(present, int(round(len(present) * float(config.get('cutFiles', 0))))))
+      self.cut = float(config.get('cut', 0.5))
+      self.cutTimes = int(config.get('cutTimes', 1))
+      self.transfers = {}
+      self.lock = threading.Lock()
+      self.free = 0.0
+      self.requests = 0
+      self.sent = 0
+
+   def url(self):
+      return '%s://%s:%d' % (self.protocol, self.address, self.port)
+
+   def path(self, name):
+      # Store path of distfiles/name, or None if the mirror does not have it
+      if name == 'layout.conf':
+         return os.path.join(self.store, 'layout.conf')
+      if name in self.missing or '/' in name or not os.path.isfile(os.path.join(self.store, name)):
+         return None
+      return os.path.join(self.store, name)
+
+   def request(self):
+      self.lock.acquire()
+      try:
+         self.requests += 1
+      finally:
+         self.lock.release()
+      if self.latency > 0:
+         time.sleep(self.latency)
+
+   def limit(self, name, size):
+      # Offset this transfer of name is cut off at (size if it is not)
+      self.lock.acquire()
+      try:
+         if name in self.cutFiles and self.transfers.get(name, 0) < self.cutTimes:
+            self.transfers[name] = self.transfers.get(name, 0) + 1
+            return int(size * self.cut)
+         return size
+      finally:
+         self.lock.release()
+
+   def send(self, out, path, start, end):
+      # Writes bytes start to end (exclusive) of path to out at no more than rate bytes per second over all of
+      # the mirror's connections
+      fd = open(path, 'rb')
+      try:
+         fd.seek(start)
+         while start < end:
+            data = fd.read(min(CHUNK, end - start))
+            if not data:
+               break
+            if self.rate > 0:
+               self.lock.acquire()
+               try:
+                  now = time.time()
+                  self.free = max(self.free, now) + len(data) / float(self.rate)
+                  delay = self.free - now
+               finally:
+                  self.lock.release()
+               time.sleep(delay)
+            out.write(data)
+            start += len(data)
+            self.lock.acquire()
+            try:
+               self.sent += len(data)
+            finally:
+               self.lock.release()
+      finally:
+         fd.close()
+
+class MirrorHTTPHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+   protocol_version = 'HTTP/1.1'
+   mirror = None
+
+   def do_HEAD(self):
+      self.reply(False)
+
+   def do_GET(self):
+      self.reply(True)
+
+   def reply(self, body):
+      mirror = self.mirror
+      mirror.request()
+      path = urlparse(self.path).path
+      storePath = None
+      if path.startswith('/distfiles/'):
+         storePath = mirror.path(path[len('/distfiles/'):])
+      if storePath is None:
+         self.send_response(404)
+         self.send_header('Content-Length', '0')
+         self.end_headers()
+         return
+      size = os.path.getsize(storePath)
+      start, end = 0, size
+      ranged = False
+      if self.headers.getheader('range', '').startswith('bytes='):
+         try:
+            first, last = self.headers.getheader('range')[6:].split('-', 1)
+            start = int(first)
+            if last.strip():
+               end = min(size, int(last) + 1)
+            ranged = start < end
+         except ValueError:
+            start, end = 0, size
+      if ranged:
+         self.send_response(206)
+         self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end - 1, size))
+      else:
+         start, end = 0, size
+         self.send_response(200)
+      self.send_header('Content-Length', str(end - start))
+      self.send_header('Accept-Ranges', 'bytes')
+      self.end_headers()
+      if body:
+         limit = mirror.limit(os.path.basename(storePath), size)
+         try:
+            mirror.send(self.wfile, storePath, start, min(end, max(start, limit)))
+         except socket.error:
+            pass
+         if limit < end:
+            self.close_connection = 1 # Cut off
+
+   def log_message(self, format, *args):
+      pass
+
+class MirrorFTPHandler(SocketServer.StreamRequestHandler):
+   # Just enough of FTP (passive mode, REST and SIZE) for aria2, urllib2 and gentooget --probe
+   mirror = None
+
+   def handle(self):
+      mirror = self.mirror
+      self.reply('220 gentoogetbench')
+      cwd = '/'
+      rest = 0
+      passive = None
+      try:
+         while True:
+            line = self.rfile.readline()
+            if not line:
+               break
+            command, space, arg = line.strip().partition(' ')
+            command = command.upper()
+            mirror.request()
+            if command == 'USER':
+               self.reply('331 Any password')
+            elif command == 'PASS':
+               self.reply('230 Logged in')
+            elif command == 'SYST':
+               self.reply('215 UNIX Type: L8')
+            elif command == 'PWD':
+               self.reply('257 "%s"' % (cwd,))
+            elif command in ('CWD', 'CDUP'):
+               if command == 'CDUP':
+                  arg = '..'
+               directory = posixpath.normpath(posixpath.join(cwd, arg))
+               if directory in ('/', '/distfiles'):
+                  cwd = directory
+                  self.reply('250 OK')
+               else:
+                  self.reply('550 No such directory')
+            elif command in ('TYPE', 'MODE', 'STRU', 'NOOP'):
+               self.reply('200 OK')
+            elif command == 'REST':
+               try:
+                  rest = int(arg)
+                  self.reply('350 Restarting at %d' % (rest,))
+               except ValueError:
+                  self.reply('501 Bad offset')
+            elif command in ('SIZE', 'RETR'):
+               storePath = self.storePath(cwd, arg)
+               if storePath is None:
+                  self.reply('550 No such file')
+               elif command == 'SIZE':
+                  self.reply('213 %d' % (os.path.getsize(storePath),))
+               elif passive is None:
+                  self.reply('425 Use PASV first')
+               else:
+                  size = os.path.getsize(storePath)
+                  limit = mirror.limit(os.path.basename(storePath), size)
+                  self.reply('150 Opening BINARY mode data connection')
+                  data = self.accept(passive)
+                  passive = None
+                  if data is None:
+                     self.reply('425 No data connection')
+                  else:
+                     try:
+                        out = data.makefile('wb')
+                        mirror.send(out, storePath, min(rest, size), max(min(rest, size), limit))
+                        out.close()
+                     except socket.error:
+                        pass
+                     data.close()
+                     if limit < size:
+                        self.reply('426 Connection closed; transfer aborted')
+                     else:
+                        self.reply('226 Transfer complete')
+                  rest = 0
+            elif command in ('LIST', 'NLST'):
+               if passive is None:
+                  self.reply('425 Use PASV first')
+               else:
+                  self.reply('150 Here comes the listing')
+                  data = self.accept(passive)
+                  passive = None
+                  if not data is None:
+                     data.close()
+                  self.reply('226 Done')
+            elif command in ('PASV', 'EPSV'):
+               if not passive is None:
+                  passive.close()
+               passive = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+               passive.bind((mirror.address, 0))
+               passive.listen(1)
+               port = passive.getsockname()[1]
+               if command == 'EPSV':
+                  self.reply('229 Entering Extended Passive Mode (|||%d|)' % (port,))
+               else:
+                  self.reply('227 Entering Passive Mode (%s,%d,%d)' %
+                             (mirror.address.replace('.', ','), port >> 8, port & 0xff))
+            elif command == 'QUIT':
+               self.reply('221 Bye')
+               break
+            else:
+               self.reply('502 Not implemented')
+      finally:
+         if not passive is None:
+            passive.close()
+
+   def storePath(self, cwd, arg):
+      path = posixpath.normpath(posixpath.join(cwd, arg))
+      if not path.startswith('/distfiles/'):
+         return None
+      return self.mirror.path(path[len('/distfiles/'):])
+
+   def accept(self, passive):
+      passive.settimeout(10)
+      try:
+         try:
+            return passive.accept()[0]
+         except socket.error:
+            return None
+      finally:
+         passive.close()
+
+   def reply(self, text):
+      self.wfile.write(text + '\r\n')
+      self.wfile.flush()
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+   daemon_threads = True
+   allow_reuse_address = True
+
+   def handle_error(self, request, client_address):
+      pass # Clients dropping connections (eg. aria2 closing slower segments) is normal
+
+class ThreadingFTPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+   daemon_threads = True
+   allow_reuse_address = True
+
+   def handle_error(self, request, client_address):
+      pass
+
+def startMirror(mirror):
+   # Serves mirror from a background thread on its own loopback address (so gentooget's per host mirror
+   # statistics see each stand-in as a separate mirror)
+   if mirror.protocol == 'ftp':
+      class Handler(MirrorFTPHandler):
+         pass
+      Handler.mirror = mirror
+      server = ThreadingFTPServer((mirror.address, 0), Handler)
+   else:
+      class Handler(MirrorHTTPHandler):
+         pass
+      Handler.mirror = mirror
+      server = ThreadingHTTPServer((mirror.address, 0), Handler)
+   mirror.port = server.server_address[1]
+   t = threading.Thread(target=server.serve_forever)
+   t.setDaemon(True)
+   t.start()
+   return server
+
+def makeDistfiles(workload, store, rng):
+   # Random distfiles of log uniformly distributed sizes and the Manifest listing them. Returns the names.
+   files = workload.get('files', {})
+   count = int(files.get('count', 16))
+   low = math.log(max(1, parseSize(files.get('min', '16K'))))
+   high = math.log(max(1, parseSize(files.get('max', '8M'))))
+   names = []
+   manifest = open(os.path.join(store, 'Manifest'), 'w')
+   try:
+      for i in range(count):
+         name = 'bench%02d-1.%d.tar.gz' % (i, i)
+         size = int(math.exp(low + (high - low) * rng.random()))
+         digest = hashlib.sha512()
+         fd = open(os.path.join(store, name), 'wb')
+         try:
+            left = size
+            while left > 0:
+               n = min(left, 1024*1024)
+               data = ('%0*x' % (2 * n, rng.getrandbits(8 * n))).decode('hex')
+               fd.write(data)
+               digest.update(data)
+               left -= n
+         finally:
+            fd.close()
+         manifest.write('DIST %s %d SHA512 %s\n' % (name, size, digest.hexdigest()))
+         names.append(name)
+   finally:
+      manifest.close()
+   fd = open(os.path.join(store, 'layout.conf'), 'w')
+   try:
+      fd.write('[structure]\n0=flat\n')
+   finally:
+      fd.close()
+   return names
+
+def makeInterface():
+   # Creates DUMMY_INTERFACE (up with DUMMY_ADDRESS) if possible. Returns the interface the scripts switch.
+   if os.getuid() != 0 or which('ip') is None:
+      return 'lo'
+   devnull = open(os.devnull, 'w')
+   try:
+      if subprocess.call(['ip', 'link', 'add', DUMMY_INTERFACE, 'type', 'dummy'], stdout=devnull,
+                         stderr=devnull) != 0:
+         return 'lo'
+      subprocess.call(['ip', 'link', 'set', DUMMY_INTERFACE, 'up'], stdout=devnull, stderr=devnull)
+      subprocess.call(['ip', 'addr', 'add', DUMMY_ADDRESS, 'dev', DUMMY_INTERFACE], stdout=devnull, stderr=devnull)
+      return DUMMY_INTERFACE
+   finally:
+      devnull.close()
+
+def removeInterface(interface):
+   if interface == DUMMY_INTERFACE:
+      devnull = open(os.devnull, 'w')
+      try:
+         subprocess.call(['ip', 'link', 'del', DUMMY_INTERFACE], stdout=devnull, stderr=devnull)
+      finally:
+         devnull.close()
+
+def writeScript(path, lines):
+   fd = open(path, 'w')
+   try:
+      fd.write('#!/bin/sh\n' + '\n'.join(lines) + '\n')
+   finally:
+      fd.close()
+   os.chmod(path, 0755)
+
+def makeScripts(dir, interface, delay, aria):
+   # The fake switch scripts and an aria2c wrapper, each logging a line per run to count process starts
+   scripts = {}
+   for target in ('local', 'international'):
+      path = os.path.join(dir, target + '.sh')
+      lines = [ 'echo %s >> "%s"' % (target, os.path.join(dir, 'switches.log')) ]
+      if interface == DUMMY_INTERFACE:
+         lines.append('ip addr flush dev %s' % (interface,))
+         lines.append('(sleep %s; ip addr add %s dev %s) > /dev/null 2>&1 &' %
+                      (delay, DUMMY_ADDRESS, interface))
+      else:
+         lines.append('sleep %s' % (delay,))
+      writeScript(path, lines)
+      scripts[target] = path
+   scripts['aria2c'] = os.path.join(dir, 'aria2c')
+   if aria is None:
+      writeScript(scripts['aria2c'], [ 'echo aria2c is not installed >&2', 'exit 1' ])
+   else:
+      writeScript(scripts['aria2c'], [ 'echo aria2c >> "%s"' % (os.path.join(dir, 'aria2c.log'),),
+                                       'exec "%s" "$@"' % (aria,) ])
+   return scripts
+
+def countLines(path):
+   if not os.path.exists(path):
+      return 0
+   fd = open(path)
+   try:
+      return len(fd.readlines())
+   finally:
+      fd.close()
+
+def fileDigest(path):
+   digest = hashlib.sha512()
+   fd = open(path, 'rb')
+   try:
+      while True:
+         data = fd.read(1024*1024)
+         if not data:
+            break
+         digest.update(data)
+   finally:
+      fd.close()
+   return digest.hexdigest()
+
+def makeRun(bench, run, engine, repeat, extra):
+   # Makes one workload run in a fresh DISTDIR and $GENTOOGET_DIR and returns its measurements
+   runDir = os.path.join(bench['dir'], 'runs', '%s.%s.%d' % (run['name'], engine, repeat))
+   if os.path.exists(runDir):
+      shutil.rmtree(runDir)
+   distdir = os.path.join(runDir, 'distfiles')
+   stateDir = os.path.join(runDir, 'state')
+   os.makedirs(distdir)
+   os.makedirs(stateDir)
+   scripts = makeScripts(runDir, bench['interface'], bench['switchDelay'], bench['aria'])
+   env = dict(os.environ)
+   for variable in ('GENTOO_MIRRORS', 'LOCAL_MIRRORS', 'INTERNATIONAL_MIRRORS', 'INTERNAL_MIRRORS'):
+      if variable in env:
+         del env[variable]
+   env['GENTOOGET_DIR'] = stateDir
+   env['HOME'] = runDir # Keep ~/GENTOO_MIRRORS out of it
+   command = [ sys.executable, GENTOOGET, '-a', scripts['aria2c'], '-l', scripts['local'],
+               '-i', scripts['international'], '-I', bench['interface'], '--engine=' + engine,
+               '--make-conf=' + bench['makeConf'], '--manifest=' + bench['manifest'], '-d', distdir ] + extra
+   log = open(os.path.join(runDir, 'gentooget.log'), 'w')
+   spawns = [ 0 ]
+   lock = threading.Lock()
+   def invoke(arguments):
+      lock.acquire()
+      try:
+         spawns[0] += 1
+      finally:
+         lock.release()
+      subprocess.call(command + arguments, env=env, stdout=log, stderr=subprocess.STDOUT)
+   start = time.time()
+   try:
+      if run.get('mode', 'single') == 'batch':
+         batchPath = os.path.join(runDir, 'batch')
+         fd = open(batchPath, 'w')
+         try:
+            for name in bench['names']:
+               fd.write('%s/distfiles/%s %s\n' % (bench['primary'], name, name))
+         finally:
+            fd.close()
+         invoke([ '--batch=' + batchPath, '--jobs=%d' % (int(run.get('jobs', 4)),) ] + run.get('options', []))
+      else:
+         # One process per file like Portage's FETCHCOMMAND, jobs at a time like parallel-fetch
+         pending = list(bench['names'])
+         def worker():
+            while True:
+               lock.acquire()
+               try:
+                  if len(pending) == 0:
+                     return
+                  name = pending.pop(0)
+               finally:
+                  lock.release()
+               invoke([ '-f', name, '-u', '%s/distfiles/%s' % (bench['primary'], name) ] + run.get('options', []))
+         workers = [ threading.Thread(target=worker) for i in range(max(1, int(run.get('jobs', 1)))) ]
+         for t in workers:
+            t.start()
+         for t in workers:
+            t.join()
+   finally:
+      log.close()
+   wall = time.time() - start
+   result = { 'run': run['name'], 'engine': engine, 'repeat': repeat, 'wall': wall, 'files': len(bench['names']),
+              'intact': 0, 'bytes': {}, 'gentooget': spawns[0], 'aria2c': countLines(os.path.join(runDir, 'aria2c.log')),
+              'scripts': countLines(os.path.join(runDir, 'switches.log')), 'switches': 0, 'switchSeconds': 0.0,
+              'reused': 0 }
+   for name in bench['names']:
+      path = os.path.join(distdir, name)
+      if os.path.exists(path) and fileDigest(path) == bench['digests'][name]:
+         result['intact'] += 1
+   telemetryPath = os.path.join(stateDir, 'telemetry.jsonl')
+   if os.path.exists(telemetryPath):
+      fd = open(telemetryPath)
+      try:
+         for line in fd:
+            try:
+               record = json.loads(line)
+            except ValueError:
+               continue
+            for stage in record.get('stages', []):
+               tier = stage.get('tier')
+               if not tier in ('internal', 'local', 'international'):
+                  tier = 'other'
+               result['bytes'][tier] = result['bytes'].get(tier, 0) + stage.get('bytes', 0)
+            result['reused'] += record.get('cache', {}).get('reused', 0) # --delta
+            for switch in record.get('switches', []):
+               if not switch.get('seconds') is None: # The script was run
+                  result['switches'] += 1
+                  result['switchSeconds'] += switch['seconds']
+      finally:
+         fd.close()
+   return result
+
+def measureStartup(dir, script, repeat, extra):
+   # Seconds from starting script until it starts aria2c and until it exits, for each of repeat single file runs
+   # after one which fills $GENTOOGET_DIR (config snapshot, mirror layouts, compiled gentooget) as in normal use
+   runDir = os.path.join(dir, 'startup', os.path.basename(script))
+   if os.path.exists(runDir):
+      shutil.rmtree(runDir)
+   distdir = os.path.join(runDir, 'distfiles')
+   stateDir = os.path.join(runDir, 'state')
+   os.makedirs(distdir)
+   os.makedirs(stateDir)
+   stampPath = os.path.join(runDir, 'spawned')
+   aria = os.path.join(runDir, 'aria2c')
+   writeScript(aria, [ 'date +%%s.%%N > "%s"' % (stampPath,),
+                       'while [ $# -gt 1 ]; do [ "$1" = -o ] && out="$2"; shift; done',
+                       'echo startup > "%s/$out"' % (distdir,) ])
+   makeConf = os.path.join(runDir, 'make.conf')
+   mirrors = [ 'http://127.0.0.1:9/gentoo', 'http://127.0.0.1:9/mirror', 'ftp://127.0.0.1:9/gentoo' ]
+   fd = open(makeConf, 'w')
+   try:
+      fd.write('GENTOO_MIRRORS="%s"\n' % (' '.join(mirrors),))
+   finally:
+      fd.close()
+   env = dict(os.environ)
+   for variable in ('GENTOO_MIRRORS', 'LOCAL_MIRRORS', 'INTERNATIONAL_MIRRORS', 'INTERNAL_MIRRORS'):
+      if variable in env:
+         del env[variable]
+   env['GENTOOGET_DIR'] = stateDir
+   env['HOME'] = runDir
+   command = [ sys.executable, script, '-a', aria, '--engine=aria2', '--make-conf=' + makeConf, '-d', distdir,
+               '-f', 'startup-1.0.tar.gz', '-u', mirrors[0] + '/distfiles/startup-1.0.tar.gz' ] + extra
+   log = open(os.path.join(runDir, 'gentooget.log'), 'w')
+   times = []
+   try:
+      for i in range(repeat + 1):
+         for path in (stampPath, os.path.join(distdir, 'startup-1.0.tar.gz')):
+            if os.path.exists(path):
+               os.remove(path)
+         start = time.time()
+         subprocess.call(command, env=env, stdout=log, stderr=subprocess.STDOUT)
+         end = time.time()
+         try:
+            fd = open(stampPath)
+            try:
+               spawned = float(fd.read().strip())
+            finally:
+               fd.close()
+         except (IOError, ValueError):
+            raise RuntimeError('%s did not start aria2c (see %s)' % (script, log.name))
+         if i > 0:
+            times.append((spawned - start, end - start))
+   finally:
+      log.close()
+   return times
+
+def median(values):
+   values = sorted(values)
+   return values[len(values) // 2]
+
+def printStartup(results):
+   print('%-18s %5s %10s %10s %10s %10s' % ('Script', 'Runs', 'Min (ms)', 'Median', 'Max', 'Exit (ms)'))
+   for result in results:
+      print('%-18s %5d %10.1f %10.1f %10.1f %10.1f' %
+            (result['script'], len(result['spawn']), min(result['spawn']) * 1000, median(result['spawn']) * 1000,
+             max(result['spawn']) * 1000, median(result['exit']) * 1000))
+
+def printResults(results):
+   print('%-16s %-7s %3s %9s %7s %8s %8s %8s %8s %9s %6s %7s %8s %10s' %
+         ('Run', 'Engine', '#', 'Wall (s)', 'Intact', 'Int MB', 'Local MB', 'Intl MB', 'Other MB', 'gentooget',
+          'aria2c', 'Scripts', 'Switches', 'Switch (s)'))
+   for result in results:
+      mb = [ result['bytes'].get(tier, 0) / 1048576.0 for tier in ('internal', 'local', 'international', 'other') ]
+      print('%-16s %-7s %3d %9.2f %7s %8.1f %8.1f %8.1f %8.1f %9d %6d %7d %8d %10.1f' %
+            (result['run'][:16], result['engine'], result['repeat'], result['wall'],
+             '%d/%d' % (result['intact'], result['files']), mb[0], mb[1], mb[2], mb[3], result['gentooget'],
+             result['aria2c'], result['scripts'], result['switches'], result['switchSeconds']))
+
+def makeDir(keep):
+   if keep is None:
+      return tempfile.mkdtemp(prefix='gentoogetbench.')
+   if not os.path.isdir(keep):
+      os.makedirs(keep)
+   return keep
+
+def startup(budget, repeat, keep, jsonPath, extra):
+   dir = makeDir(keep)
+   try:
+      results = []
+      for script in (GENTOOGET, GENTOOGET_FAST):
+         try:
+            times = measureStartup(dir, script, repeat, extra)
+         except RuntimeError, e:
+            printErr('ERROR: ' + str(e))
+            return 1
+         results.append({ 'script': os.path.basename(script), 'spawn': [ t[0] for t in times ],
+                          'exit': [ t[1] for t in times ] })
+      printStartup(results)
+      if not jsonPath is None:
+         fd = open(jsonPath, 'w')
+         try:
+            json.dump(results, fd, indent=1)
+         finally:
+            fd.close()
+      fast = median(results[-1]['spawn']) * 1000
+      if fast > budget:
+         printErr('FAILED: %s took %.1fms to start aria2c, over the %.1fms budget' %
+                  (results[-1]['script'], fast, budget))
+         return 1
+      return 0
+   finally:
+      if keep is None:
+         shutil.rmtree(dir, True)
+
+def main(argv=None):
+   if argv is None:
+      argv = sys.argv
+   extra = []
+   if '--' in argv:
+      extra = argv[argv.index('--') + 1:]
+      argv = argv[:argv.index('--')]
+   try:
+      opts, args = getopt.getopt(argv[1:], "hw:e:r:n:a:k:j:s:", [ "help", "workload=", "engines=",
+                                 "runs=", "repeat=", "aria=", "keep=", "json=", "startup=" ])
+   except getopt.GetoptError, err:
+      printErr(str(err))
+      usage()
+      return 1
+   workload = DEFAULT_WORKLOAD
+   engines = None
+   runNames = None
+   repeat = None
+   aria = which('aria2c')
+   keep = None
+   jsonPath = None
+   budget = None
+   for opt, arg in opts:
+      if opt in ("-h", "--help"):
+         usage()
+         return 0
+      elif opt in ("-w", "--workload"):
+         try:
+            fd = open(arg)
+            try:
+               workload = json.load(fd)
+            finally:
+               fd.close()
+         except (IOError, ValueError), e:
+            printErr('ERROR: Could not read workload %s (%s)' % (arg, str(e)))
+            return 1
+      elif opt in ("-e", "--engines"):
+         engines = [ engine.strip() for engine in arg.split(',') if engine.strip() ]
+      elif opt in ("-r", "--runs"):
+         runNames = [ name.strip() for name in arg.split(',') if name.strip() ]
+      elif opt in ("-n", "--repeat"):
+         try:
+            repeat = int(arg)
+         except ValueError:
+            printErr('ERROR: Invalid repeat ' + arg)
+            return 1
+      elif opt in ("-a", "--aria"):
+         aria = os.path.abspath(arg)
+      elif opt in ("-k", "--keep"):
+         keep = os.path.abspath(arg)
+      elif opt in ("-j", "--json"):
+         jsonPath = arg
+      elif opt in ("-s", "--startup"):
+         try:
+            budget = float(arg)
+         except ValueError:
+            printErr('ERROR: Invalid startup budget ' + arg)
+            return 1
+   if not budget is None:
+      return startup(budget, repeat or 20, keep, jsonPath, extra)
+   if repeat is None:
+      repeat = 1
+   if engines is None:
+      engines = [ 'native' ]
+      if not aria is None:
+         engines.append('aria2')
+   if 'aria2' in engines and aria is None:
+      printErr('ERROR: aria2c not found (use --aria=)')
+      return 1
+   runs = [ run for run in workload.get('runs', []) if runNames is None or run['name'] in runNames ]
+   if len(runs) == 0:
+      printErr('ERROR: No runs to make')
+      return 1
+
+   dir = makeDir(keep)
+   interface = None
+   servers = []
+   try:
+      rng = random.Random(workload.get('seed', 1))
+      store = os.path.join(dir, 'store')
+      if os.path.exists(store):
+         shutil.rmtree(store)
+      os.makedirs(store)
+      names = makeDistfiles(workload, store, rng)
+      mirrors = []
+      for i, config in enumerate(workload.get('mirrors', [])):
+         mirror = Mirror(config, '127.0.1.%d' % (i + 1,), names, store, rng)
+         servers.append(startMirror(mirror))
+         mirrors.append(mirror)
+      tiers = {}
+      for mirror in mirrors:
+         tiers.setdefault(mirror.tier, []).append(mirror.url())
+      # Portage hands gentooget a uri on the first GENTOO_MIRRORS mirror
+      gentooMirrors = tiers.get('local', []) + tiers.get('international', [])
+      makeConf = os.path.join(dir, 'make.conf')
+      fd = open(makeConf, 'w')
+      try:
+         fd.write('GENTOO_MIRRORS="%s"\n' % (' '.join(gentooMirrors),))
+         for tier in ('internal', 'local', 'international'):
+            fd.write('%s_MIRRORS="%s"\n' % (tier.upper(), ' '.join(tiers.get(tier, []))))
+      finally:
+         fd.close()
+      interface = makeInterface()
+      if interface == 'lo':
+         print('Switch scripts sleep %ss (no dummy interface, needs root and the dummy module)' %
+               (workload.get('switchDelay', 1.0),))
+      bench = { 'dir': dir, 'names': names, 'makeConf': makeConf, 'manifest': os.path.join(store, 'Manifest'),
+                'primary': (gentooMirrors + [ mirror.url() for mirror in mirrors ])[0], 'interface': interface,
+                'switchDelay': workload.get('switchDelay', 1.0), 'aria': aria, 'digests': {} }
+      for name in names:
+         bench['digests'][name] = fileDigest(os.path.join(store, name))
+      results = []
+      for run in runs:
+         for engine in engines:
+            for i in range(repeat):
+               results.append(makeRun(bench, run, engine, i + 1, extra))
+      printResults(results)
+      if not jsonPath is None:
+         fd = open(jsonPath, 'w')
+         try:
+            json.dump(results, fd, indent=1)
+         finally:
+            fd.close()
+      if len([ result for result in results if result['intact'] < result['files'] ]) > 0:
+         return 1
+      return 0
+   finally:
+      for server in servers:
+         server.shutdown()
+         server.server_close()
+      if not interface is None:
+         removeInterface(interface)
+      if keep is None:
+         shutil.rmtree(dir, True)
+
+if __name__ == "__main__":
+   sys.exit(main())
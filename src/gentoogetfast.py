@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+
+#gentoogetfast - Quick starting launcher for gentooget
+#    Copyright (C) 2010  Donald Munro
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/gpl-3.0.html>.
+#
+# Python compiles the script it runs every time it is run, which for gentooget.py takes longer than everything
+# gentooget does before starting aria2c, and Portage runs it once per distfile. This launcher takes the same
+# options but runs gentooget.py (from the same directory as the launcher) compiled once into $GENTOOGET_DIR, and
+# compiled again only when gentooget.py changes.
+
+import os
+import os.path
+import sys
+import grp
+import imp
+import struct
+import marshal
+
+STATE_DIR = os.environ.get('GENTOOGET_DIR', '/var/tmp/gentooget')
+SOURCE = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'gentooget.py')
+
+def loadCompiled(path, mtime):
+   # The code in path if it was compiled from SOURCE as of mtime by this user, otherwise None. $GENTOOGET_DIR is
+   # shared with other users so anything another user could have written is not run.
+   try:
+      fd = open(path, 'rb')
+   except IOError:
+      return None
+   try:
+      st = os.fstat(fd.fileno())
+      if st.st_uid != os.getuid() or st.st_mode & 022 != 0:
+         return None
+      data = fd.read()
+   finally:
+      fd.close()
+   if data[:4] != imp.get_magic() or data[4:8] != struct.pack('<I', mtime):
+      return None
+   try:
+      return marshal.loads(data[8:])
+   except (EOFError, ValueError, TypeError):
+      return None
+
+def saveCompiled(path, code, mtime):
+   if not os.path.isdir(STATE_DIR):
+      # Shared by root and portage as in gentooget's makeStateDir
+      os.makedirs(STATE_DIR, 0700)
+      try:
+         os.chown(STATE_DIR, -1, grp.getgrnam('portage').gr_gid)
+      except (KeyError, OSError):
+         pass
+      os.chmod(STATE_DIR, 02770)
+   tmp = '%s.%d' % (path, os.getpid())
+   fd = os.fdopen(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0644), 'wb')
+   try:
+      try:
+         fd.write(imp.get_magic() + struct.pack('<I', mtime) + marshal.dumps(code))
+      finally:
+         fd.close()
+      os.rename(tmp, path)
+   except (IOError, OSError):
+      os.remove(tmp)
+      raise
+
+def main():
+   mtime = int(os.stat(SOURCE).st_mtime) & 0xffffffff
+   # One per user (as ~ differs between root and portage) and per installed copy of gentooget.py
+   path = os.path.join(STATE_DIR, 'gentooget.%d.%08x.pyc' % (os.getuid(), hash(SOURCE) & 0xffffffff))
+   code = loadCompiled(path, mtime)
+   if code is None:
+      fd = open(SOURCE, 'rU')
+      try:
+         code = compile(fd.read() + '\n', SOURCE, 'exec')
+      finally:
+         fd.close()
+      try:
+         saveCompiled(path, code, mtime)
+      except (IOError, OSError):
+         pass # Compiled again next time
+   gentooget = imp.new_module('gentooget')
+   gentooget.__file__ = SOURCE
+   sys.modules['gentooget'] = gentooget
+   exec code in gentooget.__dict__
+   return gentooget.main()
+
+if __name__ == "__main__":
+   sys.exit(main())
@@ -0,0 +1,918 @@
+#!/usr/bin/env python
+# Unit tests for the parts of gentooget that work without a network, aria2c or a connection switch.
+# Run with: python -m unittest discover -s test
+
+import grp
+import hashlib
+import httplib
+import os
+import os.path
+import sys
+import random
+import shutil
+import struct
+import subprocess
+import StringIO
+import tempfile
+import threading
+import unittest
+import BaseHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+import gentooget
+import gentoogetbench
+
+class TempDirTest(unittest.TestCase):
+   # A temporary directory, which also holds $GENTOOGET_DIR
+   def setUp(self):
+      self.dir = tempfile.mkdtemp(prefix='gentooget-test.')
+      self.saved = gentooget.STATE_DIR
+      gentooget.STATE_DIR = os.path.join(self.dir, 'state')
+
+   def tearDown(self):
+      gentooget.STATE_DIR = self.saved
+      shutil.rmtree(self.dir)
+
+   def write(self, name, text):
+      path = os.path.join(self.dir, name)
+      fd = open(path, 'wb')
+      try:
+         fd.write(text)
+      finally:
+         fd.close()
+      return path
+
+class ShellParserTest(TempDirTest):
+   def parse(self, text, variables=None):
+      if variables is None:
+         variables = {}
+      gentooget.parseShellVars(self.write('make.conf', text), variables, [])
+      return variables
+
+   def testQuotes(self):
+      variables = self.parse('A="x y" B=\'$A\' C=plain\nD="multi\nline"\n')
+      self.assertEqual(variables, { 'A': 'x y', 'B': '$A', 'C': 'plain', 'D': 'multi\nline' })
+
+   def testExpansion(self):
+      variables = self.parse('A=one\nB="${A} $A ${UNSET_IN_TEST:-default}"\nC=${A}s\n')
+      self.assertEqual(variables['B'], 'one one default')
+      self.assertEqual(variables['C'], 'ones')
+
+   def testContinuationAndComments(self):
+      variables = self.parse('# GENTOO_MIRRORS="commented"\nGENTOO_MIRRORS="http://a/ \\\nhttp://b/" # trailing\n')
+      self.assertEqual(variables, { 'GENTOO_MIRRORS': 'http://a/ http://b/' })
+
+   def testExport(self):
+      self.assertEqual(self.parse('export A=1; export B=2\n'), { 'A': '1', 'B': '2' })
+
+   def testCommandIsNotAnAssignment(self):
+      # FOO=bar only goes into echo's environment
+      self.assertEqual(self.parse('FOO=bar echo hi\nA=1 B=2 cmd\n'), {})
+
+   def testSource(self):
+      self.write('extra.conf', 'B=sourced\n')
+      variables = self.parse('A=1\nsource extra.conf\n. extra.conf\n')
+      self.assertEqual(variables, { 'A': '1', 'B': 'sourced' })
+
+class StateTest(TempDirTest):
+   def testSaveAndLoad(self):
+      gentooget.saveState('a.json', { 'x': 1 })
+      self.assertEqual(gentooget.loadState('a.json'), { 'x': 1 })
+      self.assertEqual(os.stat(gentooget.STATE_DIR).st_mode & 07777, 02770)
+      self.assertEqual(os.stat(gentooget.statePath('a.json')).st_mode & 0777, 0660)
+      self.assertEqual(gentooget.loadState('missing.json', 'default'), 'default')
+
+   def testFailedSaveLeavesNothing(self):
+      self.assertRaises(TypeError, gentooget.saveState, 'a.json', { 'x': object() })
+      self.assertEqual(os.listdir(gentooget.STATE_DIR), [])
+
+   def testUpdate(self):
+      def update(data):
+         data['n'] = data.get('n', 0) + 1
+         return data['n']
+      self.assertEqual(gentooget.updateState('n.json', update), 1)
+      self.assertEqual(gentooget.updateState('n.json', update), 2)
+      self.assertEqual(sorted(os.listdir(gentooget.STATE_DIR)), [ 'n.json', 'n.json.lock' ])
+
+   def testWorldWritableClosedUp(self):
+      # As left by earlier versions
+      os.mkdir(gentooget.STATE_DIR)
+      os.chmod(gentooget.STATE_DIR, 01777)
+      gentooget.saveState('a.json', {})
+      self.assertEqual(os.stat(gentooget.STATE_DIR).st_mode & 07777, 02770)
+
+   def testUnsafe(self):
+      other = os.path.join(self.dir, 'other')
+      os.mkdir(other)
+      os.symlink(other, gentooget.STATE_DIR)
+      self.assertRaises(OSError, gentooget.saveState, 'a.json', {})
+      self.assertEqual(gentooget.updateState('a.json', lambda data: 1), None)
+      self.write('other/a.json', '{ "x": 1 }')
+      self.assertEqual(gentooget.loadState('a.json', {}), {})
+      if os.getuid() == 0: # Someone else's directory
+         os.remove(gentooget.STATE_DIR)
+         os.chown(other, 12345, -1)
+         gentooget.STATE_DIR = other
+         self.assertEqual(gentooget.loadState('a.json', {}), {})
+         self.assertRaises(OSError, gentooget.makeStateDir)
+
+class LinkTest(TempDirTest):
+   # Connection switching shared between processes through link.json, on lo so the link is always up
+   def setUp(self):
+      TempDirTest.setUp(self)
+      self.switches = []
+      self.switchConnection = gentooget.switchConnection
+      gentooget.switchConnection = lambda script, interface: self.switches.append(script) or '127.0.0.1'
+
+   def tearDown(self):
+      gentooget.switchConnection = self.switchConnection
+      TempDirTest.tearDown(self)
+
+   def testShared(self):
+      self.assertEqual(gentooget.acquireLink('international', 'intl', 'lo'), '127.0.0.1')
+      self.assertEqual(gentooget.acquireLink('international', 'intl', 'lo'), '127.0.0.1') # Already international
+      self.assertEqual(self.switches, [ 'intl' ])
+      self.assertEqual(gentooget.releaseLink('international', 'local', 'lo'), '127.0.0.1')
+      self.assertEqual(self.switches, [ 'intl', 'local' ])
+      self.assertEqual(gentooget.loadState('link.json')['mode'], 'local')
+
+   def testLeftUpForOthers(self):
+      gentooget.saveState('link.json', { 'mode': 'international', 'international': [ os.getppid() ] })
+      self.assertEqual(gentooget.acquireLink('international', 'intl', 'lo'), '127.0.0.1')
+      self.assertEqual(gentooget.releaseLink('international', 'local', 'lo'), '')
+      self.assertEqual(self.switches, [])
+      self.assertEqual(gentooget.loadState('link.json')['international'], [ os.getppid() ])
+
+   def testNoState(self):
+      # A state directory this user cannot use: switch as if alone
+      gentooget.STATE_DIR = os.path.join(self.write('file', ''), 'state')
+      self.assertEqual(gentooget.acquireLink('international', 'intl', 'lo'), '127.0.0.1')
+      self.assertEqual(gentooget.releaseLink('international', 'local', 'lo'), '127.0.0.1')
+      self.assertEqual(gentooget.releaseLink('local', 'local', 'lo'), '')
+      self.assertEqual(self.switches, [ 'intl', 'local' ])
+
+class InterfaceTest(TempDirTest):
+   # Waiting for the link after a switch script, on lo (always up) and an interface that does not exist
+   def setUp(self):
+      TempDirTest.setUp(self)
+      self.output = sys.stdout, sys.stderr
+      sys.stdout = sys.stderr = StringIO.StringIO()
+      self.linkTimeout = gentooget.LINK_TIMEOUT
+      gentooget.LINK_TIMEOUT = 0.3
+
+   def tearDown(self):
+      sys.stdout, sys.stderr = self.output
+      gentooget.LINK_TIMEOUT = self.linkTimeout
+      TempDirTest.tearDown(self)
+
+   def testInterfaceIp(self):
+      self.assertEqual(gentooget.interfaceIp('lo'), '127.0.0.1')
+      self.assertEqual(gentooget.interfaceIp('gentooget0'), None)
+
+   def testWait(self):
+      start = gentooget.time.time()
+      self.assertEqual(gentooget.waitForInterface('lo', 5), '127.0.0.1')
+      self.assertTrue(gentooget.time.time() - start < 1)
+      start = gentooget.time.time()
+      self.assertEqual(gentooget.waitForInterface('gentooget0', 0.3), None)
+      self.assertTrue(0.3 <= gentooget.time.time() - start < 2)
+
+   def testSwitch(self):
+      ran = os.path.join(self.dir, 'ran')
+      script = self.write('switch', 'touch %s\n' % (ran,)) # No #! so it is run with bash
+      os.chmod(script, 0755)
+      self.assertEqual(gentooget.switchConnection(script, 'lo'), '127.0.0.1')
+      self.assertTrue(os.path.exists(ran))
+      self.assertEqual(gentooget.switchConnection(script, 'gentooget0'), None) # Did not come up
+      self.assertEqual(gentooget.switchConnection(os.path.join(self.dir, 'missing'), 'lo'), None)
+
+class MissTest(TempDirTest):
+   # Urls that recently answered not found, in misses.json
+   A = 'http://a.example/gentoo/distfiles/a-1.tar.gz'
+   B = 'http://b.example/gentoo/distfiles/a-1.tar.gz'
+
+   def setUp(self):
+      TempDirTest.setUp(self)
+      self.missTtl = gentooget.MISS_TTL
+
+   def tearDown(self):
+      gentooget.MISS_TTL = self.missTtl
+      TempDirTest.tearDown(self)
+
+   def testRecorded(self):
+      gentooget.recordMisses('a-1.tar.gz', [ self.A ], 1) # Failed some other way
+      self.assertEqual(gentooget.knownMisses('a-1.tar.gz'), {})
+      gentooget.recordMisses('a-1.tar.gz', [ self.A, self.B ], gentooget.NOT_FOUND, 'local')
+      misses = gentooget.knownMisses('a-1.tar.gz')
+      self.assertEqual(sorted(misses.keys()), [ '@local', self.A, self.B ])
+      self.assertTrue(abs(misses[self.A] - gentooget.time.time() - gentooget.MISS_TTL) < 60)
+      self.assertEqual(gentooget.knownMisses('b-1.tar.gz'), {})
+      # Left out of the mirror uris
+      gentooget.saveState('layouts.json', { 'http://a.example/gentoo': { 'layouts': [ [ 'flat' ] ],
+                                                                         'expires': gentooget.time.time() + 3600 } })
+      self.assertEqual(gentooget.mirrorUris([ 'http://a.example/gentoo' ], 'a-1.tar.gz', misses, False), [])
+      self.assertEqual(gentooget.mirrorUris([ 'http://a.example/gentoo' ], 'b-1.tar.gz', misses, False),
+                       [ 'http://a.example/gentoo/distfiles/b-1.tar.gz' ])
+
+   def testExpired(self):
+      now = gentooget.time.time()
+      gentooget.saveState('misses.json', { 'a-1.tar.gz': { self.A: now - 1, self.B: now + 60 },
+                                           'b-1.tar.gz': { self.A: now - 1 } })
+      self.assertEqual(gentooget.knownMisses('a-1.tar.gz').keys(), [ self.B ])
+      gentooget.recordMisses('c-1.tar.gz', [ self.A ], gentooget.NOT_FOUND)
+      self.assertEqual(sorted(gentooget.loadState('misses.json').keys()), [ 'a-1.tar.gz', 'c-1.tar.gz' ])
+      self.assertEqual(gentooget.loadState('misses.json')['a-1.tar.gz'].keys(), [ self.B ])
+
+   def testDisabled(self):
+      gentooget.recordMisses('a-1.tar.gz', [ self.A ], gentooget.NOT_FOUND)
+      gentooget.MISS_TTL = 0
+      self.assertEqual(gentooget.knownMisses('a-1.tar.gz'), {})
+      gentooget.recordMisses('b-1.tar.gz', [ self.A ], gentooget.NOT_FOUND)
+      self.assertEqual(gentooget.loadState('misses.json').keys(), [ 'a-1.tar.gz' ])
+
+class TelemetryTest(TempDirTest):
+   A = 'http://a.example/distfiles/a-1.tar.gz'
+   B = 'http://b.example/distfiles/a-1.tar.gz'
+
+   def setUp(self):
+      TempDirTest.setUp(self)
+      self.maxSize = gentooget.TELEMETRY_MAX_SIZE
+      self.stdout = sys.stdout
+      sys.stdout = StringIO.StringIO() # --report
+
+   def tearDown(self):
+      sys.stdout = self.stdout
+      gentooget.TELEMETRY_MAX_SIZE = self.maxSize
+      gentooget.TELEMETRY = None
+      TempDirTest.tearDown(self)
+
+   def invocation(self, tier='local', status=0):
+      gentooget.startTelemetry('single', 1, 'native')
+      stage = gentooget.beginStage(tier, 1)
+      servers = { 'http://a.example': { 'speed': 300, 'ok': True }, 'http://b.example': { 'speed': 100, 'ok': True } }
+      gentooget.countTransfer([ self.A, self.B ], servers, 4000, status, 2.0)
+      gentooget.endStage(stage, int(status == 0))
+      gentooget.countSwitch(tier, 0, 1.5, True)
+      gentooget.countCache('digests')
+      gentooget.finishTelemetry(status)
+
+   def testRecord(self):
+      gentooget.finishTelemetry(0) # Nothing started, nothing recorded
+      self.assertEqual(gentooget.readTelemetry(), [])
+      self.invocation()
+      self.assertEqual(os.stat(gentooget.statePath('telemetry.jsonl')).st_mode & 0777, 0660)
+      records = gentooget.readTelemetry()
+      self.assertEqual(len(records), 1)
+      record = records[0]
+      self.assertEqual((record['mode'], record['files'], record['status'], record['failed']), ('single', 1, 0, 0))
+      self.assertEqual(record['cache'], { 'digests': 1 })
+      self.assertEqual(record['switches'], [ { 'target': 'local', 'wait': 0, 'seconds': 1.5, 'ok': True } ])
+      stage = record['stages'][0]
+      self.assertEqual((stage['tier'], stage['served'], stage['bytes'], stage['exits']), ('local', 1, 4000, { '0': 1 }))
+      # Shared in proportion to the speeds aria2 reported
+      self.assertEqual(stage['mirrors']['http://a.example']['bytes'], 3000)
+      self.assertEqual(stage['mirrors']['http://b.example']['bytes'], 1000)
+      self.assertEqual(gentooget.TELEMETRY, None)
+
+   def testRotated(self):
+      self.invocation()
+      gentooget.TELEMETRY_MAX_SIZE = 1
+      self.invocation('international', gentooget.NOT_FOUND)
+      self.assertTrue(os.path.exists(gentooget.statePath('telemetry.jsonl.1')))
+      fd = open(gentooget.statePath('telemetry.jsonl'), 'a')
+      try:
+         fd.write('{ "partly') # Being written by another process
+      finally:
+         fd.close()
+      records = gentooget.readTelemetry()
+      self.assertEqual([ record['stages'][0]['tier'] for record in records ], [ 'local', 'international' ])
+      self.assertEqual(records[1]['failed'], 1)
+
+   def testReport(self):
+      gentooget.printReport()
+      self.assertTrue(sys.stdout.getvalue().startswith('No downloads recorded'))
+      self.invocation()
+      self.invocation('international')
+      sys.stdout = StringIO.StringIO()
+      gentooget.printReport()
+      lines = sys.stdout.getvalue().splitlines()
+      self.assertEqual(len([ line for line in lines if line.split()[:4] == [ 'local', '1', '1', '1' ] ]), 1)
+      self.assertEqual(len([ line for line in lines if line.split()[:4] == [ 'international', '1', '1', '1' ] ]), 1)
+      mirror = [ line.split() for line in lines if line.startswith('http://a.example') ][0]
+      self.assertEqual(mirror[1:3], [ 'international,local', '0.0' ])
+
+class DeferTest(TempDirTest):
+   # The queue --fetch-deferred downloads, which may run as root
+   def setUp(self):
+      TempDirTest.setUp(self)
+      self.errors = []
+      self.printErr = gentooget.printErr
+      gentooget.printErr = self.errors.append
+      self.stdout = sys.stdout
+      sys.stdout = StringIO.StringIO() # deferFetch says what it queued
+      self.distdir = os.path.join(self.dir, 'distfiles')
+      os.mkdir(self.distdir)
+
+   def tearDown(self):
+      gentooget.printErr = self.printErr
+      sys.stdout = self.stdout
+      TempDirTest.tearDown(self)
+
+   def testQueue(self):
+      gentooget.deferFetch('a-1.tar.gz', [ 'http://mirror/a-1.tar.gz' ], self.distdir, { 'size': 5 })
+      gentooget.deferFetch('b-1.tar.gz', [ 'ftp://mirror/b-1.tar.gz' ], self.distdir + '/', None)
+      self.assertEqual(os.stat(gentooget.statePath('deferred.json')).st_mode & 0777, 0640)
+      self.assertEqual(gentooget.deferredJobs(self.distdir),
+                       [ ('a-1.tar.gz', { 'urls': [ 'http://mirror/a-1.tar.gz' ], 'expected': { 'size': 5 } }),
+                         ('b-1.tar.gz', { 'urls': [ 'ftp://mirror/b-1.tar.gz' ], 'expected': {} }) ])
+      self.assertEqual(self.errors, [])
+
+   def testRejected(self):
+      url = [ 'http://mirror/a' ]
+      def update(queue):
+         queue['other-1.tar.gz'] = { 'dir': self.dir, 'urls': url }
+         queue['../../etc/cron.d/x'] = { 'dir': self.distdir, 'urls': url }
+         queue['.bashrc'] = { 'dir': self.distdir, 'urls': url }
+         queue['file-1.tar.gz'] = { 'dir': self.distdir, 'urls': [ 'file:///etc/shadow' ] }
+         queue['none-1.tar.gz'] = { 'dir': self.distdir, 'urls': [] }
+         queue['broken-1.tar.gz'] = { 'dir': self.distdir }
+      gentooget.updateState('deferred.json', update)
+      self.assertEqual(gentooget.deferredJobs(self.distdir), [])
+      self.assertEqual(len(self.errors), 5)
+      self.assertEqual(len(gentooget.deferredJobs(self.dir)), 1)
+
+class DigestTest(TempDirTest):
+   def setUp(self):
+      TempDirTest.setUp(self)
+      self.errors = []
+      self.printErr = gentooget.printErr
+      gentooget.printErr = self.errors.append
+      self.hashed = []
+      self.hashFile = gentooget.hashFile
+      def hashFile(path, algorithms):
+         self.hashed.append(path)
+         return self.hashFile(path, algorithms)
+      gentooget.hashFile = hashFile
+
+   def tearDown(self):
+      gentooget.printErr = self.printErr
+      gentooget.hashFile = self.hashFile
+      TempDirTest.tearDown(self)
+
+   def testCached(self):
+      path = self.write('a-1.tar.gz', 'a' * 1000)
+      expected = { 'size': 1000, 'SHA512': hashlib.sha512('a' * 1000).hexdigest().upper() }
+      self.assertTrue(gentooget.verifyFile(path, expected))
+      self.assertTrue(gentooget.verifyFile(path, expected))
+      self.assertEqual(self.hashed, [ path ]) # The second time from the cache
+      shard = gentooget.digestShard(os.stat(path))
+      self.assertEqual(gentooget.loadState(shard).keys(), [ gentooget.fileKey(os.stat(path)) ])
+      self.assertEqual(os.stat(os.path.dirname(gentooget.statePath(shard))).st_mode & 07777, 02770)
+      self.assertFalse(gentooget.verifyFile(path, { 'SHA512': hashlib.sha512('b').hexdigest() }))
+      self.assertFalse(gentooget.verifyFile(path, { 'size': 999 }))
+      self.assertEqual(self.hashed, [ path ])
+      self.assertEqual(len(self.errors), 1)
+
+   def testChanged(self):
+      path = self.write('a-1.tar.gz', 'a' * 1000)
+      self.assertTrue(gentooget.verifyFile(path, { 'SHA512': hashlib.sha512('a' * 1000).hexdigest() }))
+      os.utime(path, (1, 1))
+      self.assertTrue(gentooget.verifyFile(path, { 'SHA512': hashlib.sha512('a' * 1000).hexdigest() }))
+      self.assertEqual(self.hashed, [ path, path ])
+
+   def testEviction(self):
+      saved = gentooget.DIGEST_CACHE_SIZE, gentooget.DIGEST_SHARDS
+      gentooget.DIGEST_CACHE_SIZE, gentooget.DIGEST_SHARDS = 4, 1
+      try:
+         for i in range(6):
+            path = self.write('f%d' % (i,), str(i))
+            gentooget.verifyFile(path, { 'SHA512': hashlib.sha512(str(i)).hexdigest() })
+         cache = gentooget.loadState('digests/00.json')
+      finally:
+         gentooget.DIGEST_CACHE_SIZE, gentooget.DIGEST_SHARDS = saved
+      # The oldest half went when the fifth was added
+      self.assertEqual(sorted([ os.path.basename(entry['path']) for entry in cache.values() ]),
+                       [ 'f2', 'f3', 'f4', 'f5' ])
+
+   def testManifest(self):
+      manifest = self.write('Manifest', 'DIST a-1.tar.gz 1000 BLAKE2B AB SHA512 CD\nDIST b-1.tar.gz 5 SHA512 ef\n')
+      self.assertEqual(gentooget.readManifest(manifest, 'a-1.tar.gz'),
+                       { 'size': 1000, 'BLAKE2B': 'ab', 'SHA512': 'cd' })
+      self.assertEqual(gentooget.readManifest(manifest, 'c-1.tar.gz'), None)
+      self.assertEqual(gentooget.expectedDigests('b-1.tar.gz', [ manifest ], { 'size': 6 }),
+                       { 'size': 6, 'SHA512': 'ef' })
+
+class BatchTest(TempDirTest):
+   # --batch: the file list and the stages fetchBatch runs (with downloadBatch and the link switching faked)
+   LOCAL = 'http://local.example/gentoo'
+   INTERNATIONAL = 'http://international.example/gentoo'
+
+   def setUp(self):
+      TempDirTest.setUp(self)
+      self.calls = []
+      self.failing = {}
+      self.globals = {}
+      for name in ('downloadBatch', 'acquireLink', 'releaseLink', 'GENTOO_MIRRORS', 'LOCAL_MIRRORS',
+                   'INTERNATIONAL_MIRRORS', 'INTERNAL_MIRRORS'):
+         self.globals[name] = getattr(gentooget, name)
+      def downloadBatch(options, jobs, dir, concurrency, expected={}):
+         tier = 'international'
+         if jobs[0][1][0].startswith(self.LOCAL):
+            tier = 'local'
+         self.calls.append((tier, sorted([ name for name, uris in jobs ])))
+         return [ name for name, uris in jobs if name in self.failing.get(tier, []) ]
+      gentooget.downloadBatch = downloadBatch
+      gentooget.acquireLink = lambda target, script, interface: self.calls.append(('switch', target)) or '127.0.0.1'
+      gentooget.releaseLink = lambda target, script, interface: self.calls.append(('release', target)) or ''
+      gentooget.GENTOO_MIRRORS = gentooget.LOCAL_MIRRORS = [ self.LOCAL ]
+      gentooget.INTERNATIONAL_MIRRORS = [ self.INTERNATIONAL ]
+      gentooget.INTERNAL_MIRRORS = []
+      layouts = {}
+      for mirror in (self.LOCAL, self.INTERNATIONAL):
+         layouts[mirror] = { 'layouts': [ [ 'flat' ] ], 'expires': gentooget.time.time() + 3600 }
+      gentooget.saveState('layouts.json', layouts)
+      self.stdout = sys.stdout
+      sys.stdout = StringIO.StringIO() # The OK/FAILED list
+
+   def tearDown(self):
+      sys.stdout = self.stdout
+      for name, value in self.globals.items():
+         setattr(gentooget, name, value)
+      TempDirTest.tearDown(self)
+
+   def fetch(self, jobs):
+      return gentooget.fetchBatch([ 'aria2c' ], jobs, self.dir, 4, [ self.LOCAL ], True, 'local', 'intl', 'lo', False)
+
+   def testReadBatch(self):
+      path = self.write('batch', '# emerge -pf output\n'
+                        'http://a.example/distfiles/a-1.tar.gz http://b.example/distfiles/a-1.tar.gz\n'
+                        'http://c.example/distfiles/a-1.tar.gz http://a.example/distfiles/a-1.tar.gz\n'
+                        'http://upstream.example/download b-1.tar.gz\n'
+                        'not a uri\n'
+                        '\n')
+      self.assertEqual(gentooget.readBatch(path),
+                       [ [ 'a-1.tar.gz', [ 'http://a.example/distfiles/a-1.tar.gz',
+                                           'http://b.example/distfiles/a-1.tar.gz',
+                                           'http://c.example/distfiles/a-1.tar.gz' ] ],
+                         [ 'b-1.tar.gz', [ 'http://upstream.example/download' ] ] ])
+
+   def testLocalFailuresShareOneInternationalPass(self):
+      self.failing['local'] = [ 'a-1.tar.gz', 'b-1.tar.gz' ]
+      jobs = [ [ 'a-1.tar.gz', [ 'http://local.example/gentoo/distfiles/a-1.tar.gz' ] ],
+               [ 'b-1.tar.gz', [ 'http://local.example/gentoo/distfiles/b-1.tar.gz' ] ],
+               [ 'c-1.tar.gz', [ 'http://local.example/gentoo/distfiles/c-1.tar.gz' ] ],
+               [ 'd-1.tar.gz', [ 'http://upstream.example/d-1.tar.gz' ] ] ] # Not on a mirror so not local
+      self.assertEqual(self.fetch(jobs), 0)
+      self.assertEqual(self.calls, [ ('switch', 'local'), ('local', [ 'a-1.tar.gz', 'b-1.tar.gz', 'c-1.tar.gz' ]),
+                                     ('release', 'local'), ('switch', 'international'),
+                                     ('international', [ 'a-1.tar.gz', 'b-1.tar.gz', 'd-1.tar.gz' ]),
+                                     ('release', 'international') ])
+
+   def testFailures(self):
+      self.failing['local'] = [ 'a-1.tar.gz' ]
+      self.failing['international'] = [ 'a-1.tar.gz' ]
+      jobs = [ [ 'a-1.tar.gz', [ 'http://local.example/gentoo/distfiles/a-1.tar.gz' ] ],
+               [ 'b-1.tar.gz', [ 'http://local.example/gentoo/distfiles/b-1.tar.gz' ] ] ]
+      self.assertEqual(self.fetch(jobs), 1)
+      self.assertEqual([ call for call in self.calls if call[0] in ('local', 'international') ],
+                       [ ('local', [ 'a-1.tar.gz', 'b-1.tar.gz' ]), ('international', [ 'a-1.tar.gz' ]) ])
+
+class TuneTest(TempDirTest):
+   # aria2c options per file from its size, the mirrors' measured speeds and the filesystem
+   URIS = [ 'http://a.example/distfiles/a-1.tar.gz', 'http://b.example/distfiles/a-1.tar.gz' ]
+
+   def setUp(self):
+      TempDirTest.setUp(self)
+      self.tune = gentooget.TUNE
+      gentooget.MIRROR_STATS = None
+      gentooget.FILESYSTEMS[os.path.realpath(self.dir)] = 'ext4'
+
+   def tearDown(self):
+      gentooget.TUNE = self.tune
+      del gentooget.FILESYSTEMS[os.path.realpath(self.dir)]
+      TempDirTest.tearDown(self)
+
+   def testSmall(self):
+      self.assertEqual(gentooget.tuneOptions(100 * 1024, self.URIS, self.dir),
+                       [ '--split=1', '--max-connection-per-server=1', '--file-allocation=none' ])
+      gentooget.TUNE = False
+      self.assertEqual(gentooget.tuneOptions(100 * 1024, self.URIS, self.dir), [])
+
+   def testUnknownSize(self):
+      self.assertEqual(gentooget.tuneOptions(None, self.URIS + [ 'http://a.example/other/a-1.tar.gz' ], self.dir),
+                       [ '--split=2', '--max-connection-per-server=1', '--file-allocation=falloc' ])
+
+   def testLarge(self):
+      self.assertEqual(gentooget.tuneOptions(64 * 1048576, self.URIS, self.dir),
+                       [ '--min-split-size=2M', '--disk-cache=16M', '--split=8', '--max-connection-per-server=4',
+                         '--file-allocation=falloc' ])
+      gentooget.FILESYSTEMS[os.path.realpath(self.dir)] = 'btrfs'
+      self.assertEqual(gentooget.tuneOptions(64 * 1048576, self.URIS, self.dir)[-1], '--file-allocation=none')
+
+   def testSlowMirrorLeftOut(self):
+      now = gentooget.time.time()
+      gentooget.saveState('mirrorstats.json', { 'http://a.example': { 'speed': 1000000, 'updated': now },
+                                                'http://b.example': { 'speed': 1000, 'updated': now } })
+      # Only a is worth splitting over so it gets all the connections
+      self.assertEqual(gentooget.tuneOptions(64 * 1048576, self.URIS, self.dir)[:4],
+                       [ '--min-split-size=4M', '--disk-cache=16M', '--split=4', '--max-connection-per-server=4' ])
+
+class ControlFileTest(TempDirTest):
+   def testRoundTrip(self):
+      path = os.path.join(self.dir, 'f.aria2')
+      gentooget.writeControlFile(path, 5 * 1048576 + 10, 1048576, chr(0xa8))
+      self.assertEqual(gentooget.readControlFile(path), (5 * 1048576 + 10, 1048576, chr(0xa8)))
+
+   def testVersion0(self):
+      # Version 0 (written by older aria2) is in host byte order
+      header = struct.pack('=HII', 0, 0, 0) + struct.pack('=IQQI', 16384, 40000, 0, 1) + chr(0x80) + \
+               struct.pack('=I', 0)
+      path = self.write('f.aria2', header)
+      self.assertEqual(gentooget.readControlFile(path), (40000, 16384, chr(0x80)))
+
+   def testRejected(self):
+      self.assertEqual(gentooget.readControlFile(os.path.join(self.dir, 'missing.aria2')), None)
+      self.assertEqual(gentooget.readControlFile(self.write('short.aria2', 'ab')), None)
+      torrent = struct.pack('>HII', 1, 0, 20) + 'x' * 20
+      self.assertEqual(gentooget.readControlFile(self.write('torrent.aria2', torrent)), None)
+      wrongBitfield = struct.pack('>HII', 1, 0, 0) + struct.pack('>IQQI', 1048576, 5 * 1048576, 0, 2) + 'ab'
+      self.assertEqual(gentooget.readControlFile(self.write('bitfield.aria2', wrongBitfield)), None)
+
+   def testProgress(self):
+      path = self.write('f', '\0' * (3 * 1048576))
+      gentooget.writeControlFile(path + '.aria2', 3 * 1048576, 1048576, chr(0xa0)) # Pieces 0 and 2
+      self.assertEqual(gentooget.controlProgress(path), 2 * 1048576)
+      self.assertEqual(gentooget.controlProgress(path, 3 * 1048576), 2 * 1048576)
+      self.assertEqual(gentooget.controlProgress(path, 1000), None) # Not of the expected size
+      self.assertEqual(gentooget.fileProgress(path), 2 * 1048576) # Not the allocated size
+      os.remove(path + '.aria2')
+      self.assertEqual(gentooget.fileProgress(path), 3 * 1048576)
+
+class LayoutTest(unittest.TestCase):
+   def testParse(self):
+      text = '[structure]\n# comment\n1=flat\n0=filename-hash sha512 8:8\n\n[other]\n0=ignored\n'
+      self.assertEqual(gentooget.parseLayoutConf(text), [ [ 'filename-hash', 'SHA512', [ 8, 8 ] ], [ 'flat' ] ])
+
+   def testParseNothing(self):
+      self.assertEqual(gentooget.parseLayoutConf(''), [ [ 'flat' ] ])
+      self.assertEqual(gentooget.parseLayoutConf('[structure]\n0=filename-hash SHA512 x\n'), [ [ 'flat' ] ])
+
+   def testPath(self):
+      name = 'portage-3.0.tar.bz2'
+      self.assertEqual(gentooget.layoutPath([ 'flat' ], name), name)
+      self.assertEqual(gentooget.layoutPath([ 'filename-hash', 'SHA512', [ 8 ] ], name), '5c/' + name)
+      self.assertEqual(gentooget.layoutPath([ 'filename-hash', 'SHA512', [ 8, 8 ] ], name), '5c/69/' + name)
+      self.assertEqual(gentooget.layoutPath([ 'filename-hash', 'SHA512', [ 6 ] ], name), None)
+      self.assertEqual(gentooget.layoutPath([ 'filename-hash', 'NOSUCH', [ 8 ] ], name), None)
+      self.assertEqual(gentooget.layoutPath([ 'content-hash' ], name), None)
+
+   def testPaths(self):
+      name = 'portage-3.0.tar.bz2'
+      layouts = [ [ 'filename-hash', 'SHA512', [ 8 ] ], [ 'flat' ] ]
+      self.assertEqual(gentooget.layoutPaths(layouts, name), [ '5c/' + name ])
+      # Unsupported layouts are skipped
+      self.assertEqual(gentooget.layoutPaths([ [ 'content-hash' ] ] + layouts, name), [ '5c/' + name ])
+      # Not known yet: each of DEFAULT_LAYOUTS that is supported
+      paths = gentooget.layoutPaths(None, name)
+      self.assertTrue(name in paths)
+      self.assertEqual(len(paths), len(set(paths)))
+
+class FakeFtp:
+   # An open ftp connection whose SIZE gives answer (a size or an exception to raise)
+   def __init__(self, answer):
+      self.answer = answer
+
+   def size(self, path):
+      if isinstance(self.answer, Exception):
+         raise self.answer
+      return self.answer
+
+class ProberTest(unittest.TestCase):
+   def check(self, answer):
+      prober = gentooget.Prober(1)
+      prober.give(('ftp', 'mirror'), FakeFtp(answer))
+      found = prober.check('ftp://mirror/distfiles/a-1.tar.gz', gentooget.time.time() + 1, 3)
+      self.assertEqual(len(prober.idle[('ftp', 'mirror')]), 1) # Kept for the next request
+      return found
+
+   def testFtp(self):
+      self.assertEqual(self.check(1234), 1234)
+      self.assertEqual(self.check(gentooget.ftplib.error_perm('550 No such file or directory')), None)
+      # Not an answer about the file: the server has no SIZE or refuses it
+      self.assertEqual(self.check(gentooget.ftplib.error_perm('502 Command not implemented')), False)
+      self.assertEqual(self.check(gentooget.ftplib.error_perm('500 Unknown command')), False)
+      self.assertEqual(self.check(None), False)
+
+class DeltaTest(TempDirTest):
+   def randomData(self, size, seed):
+      rng = random.Random(seed)
+      return ''.join([ chr(rng.randrange(256)) for i in range(size) ])
+
+   def index(self, data):
+      return gentooget.makeIndex(self.write('new', data))
+
+   def testIndex(self):
+      index = self.index(self.randomData(3 * 4096 + 100, 1))
+      self.assertEqual((index['size'], index['blocksize']), (3 * 4096 + 100, 4096))
+      self.assertEqual((len(index['weak']), len(index['strong'])), (4, 4))
+
+   def testShifted(self):
+      new = self.randomData(8 * 4096, 1)
+      old = 'abc' + new[:4 * 4096] + self.randomData(100, 2) + new[4 * 4096:]
+      matches = gentooget.matchBlocks(self.index(new), old)
+      self.assertEqual(sorted(matches.keys()), range(8))
+      for i, position in matches.items():
+         self.assertEqual(old[position:position + 4096], new[i * 4096:(i + 1) * 4096])
+
+   def testNothingShared(self):
+      self.assertEqual(gentooget.matchBlocks(self.index(self.randomData(4 * 4096, 1)), self.randomData(8 * 4096, 2)),
+                       {})
+      self.assertEqual(gentooget.matchBlocks(self.index(self.randomData(4 * 4096, 1)), 'short'), {})
+
+   def testScanLimit(self):
+      # The first block matches so the scan goes on through the rest, which has to be given up on
+      new = self.randomData(4 * 4096, 1)
+      old = new[:4096] + self.randomData(64 * 1024, 2)
+      self.assertEqual(gentooget.matchBlocks(self.index(new), old, 16 * 1024), None)
+      self.assertEqual(gentooget.matchBlocks(self.index(new), old, 16 * 1024 * 1024, 0), None)
+      self.assertEqual(gentooget.matchBlocks(self.index(new), old).keys(), [ 0 ])
+
+class DistfilesServerTest(TempDirTest):
+   # --serve: the directory as an internal mirror, fetching missing files with a stand-in for gentooget that logs
+   # each run and writes the file
+   def setUp(self):
+      TempDirTest.setUp(self)
+      self.distdir = os.path.join(self.dir, 'distfiles')
+      os.mkdir(self.distdir)
+      self.data = os.urandom(1000)
+      self.write('distfiles/a-1.tar.gz', self.data)
+      self.log = os.path.join(self.dir, 'fetched')
+      self.fetcher = self.write('fetch', 'while [ $# -gt 1 ]; do\n'
+                                         '   case "$1" in -d) d="$2";; -f) f="$2";; esac; shift\n'
+                                         'done\n'
+                                         'echo "$f" >> %s; sleep 0.2; echo fetched > "$d/$f"\n' % (self.log,))
+      self.server = None
+
+   def tearDown(self):
+      if not self.server is None:
+         self.server.shutdown()
+         self.server.server_close()
+      TempDirTest.tearDown(self)
+
+   def start(self, fetch=False):
+      fetchArgs = None
+      if fetch:
+         fetchArgs = [ '/bin/sh', self.fetcher ]
+      self.server = gentooget.DistfilesServer(('127.0.0.1', 0), self.distdir, 8, fetchArgs, 'http://upstream.example/')
+      thread = threading.Thread(target=self.server.serve_forever)
+      thread.setDaemon(True)
+      thread.start()
+
+   def request(self, path, method='GET', headers={}):
+      connection = httplib.HTTPConnection('127.0.0.1', self.server.server_address[1], timeout=10)
+      try:
+         connection.request(method, path, headers=headers)
+         response = connection.getresponse()
+         return response.status, response.getheader('Content-Range'), response.read()
+      finally:
+         connection.close()
+
+   def testServe(self):
+      self.start()
+      self.assertEqual(self.request('/distfiles/a-1.tar.gz'), (200, None, self.data))
+      self.assertEqual(self.request('/a-1.tar.gz'), (200, None, self.data))
+      self.assertEqual(self.request('/distfiles/a-1.tar.gz', 'HEAD'), (200, None, ''))
+      self.assertEqual(self.request('/distfiles/a-1.tar.gz', headers={ 'Range': 'bytes=10-19' }),
+                       (206, 'bytes 10-19/1000', self.data[10:20]))
+      self.assertEqual(self.request('/distfiles/a-1.tar.gz', headers={ 'Range': 'bytes=-5' }),
+                       (206, 'bytes 995-999/1000', self.data[-5:]))
+      self.assertEqual(self.request('/distfiles/a-1.tar.gz', headers={ 'Range': 'bytes=1000-' })[:2],
+                       (416, 'bytes */1000'))
+      for path in ('/distfiles/b-1.tar.gz', '/distfiles/../a-1.tar.gz', '/distfiles/xyz/a-1.tar.gz',
+                   '/distfiles/layout.conf'):
+         self.assertEqual(self.request(path)[0], 404, path)
+      self.assertFalse(os.path.exists(self.log))
+
+   def testHashedLayout(self):
+      self.write('distfiles/layout.conf', '[structure]\n0=filename-hash SHA512 8\n1=flat\n')
+      self.start(True)
+      hashed = hashlib.sha512('a-1.tar.gz').hexdigest()[:2] + '/a-1.tar.gz'
+      self.assertEqual(self.request('/distfiles/' + hashed), (200, None, self.data)) # Wherever it is
+      self.assertEqual(self.request('/distfiles/layout.conf')[0], 200)
+      self.assertEqual(self.request('/distfiles/b-1.tar.gz'), (200, None, 'fetched\n'))
+      self.assertTrue(os.path.isfile(os.path.join(self.distdir, hashlib.sha512('b-1.tar.gz').hexdigest()[:2],
+                                                  'b-1.tar.gz'))) # Stored in the preferred layout
+
+   def testFetchedOnce(self):
+      self.start(True)
+      self.assertEqual(self.request('/distfiles/b-1.tar.gz', 'HEAD')[0], 200) # Without fetching it
+      self.assertFalse(os.path.exists(self.log))
+      replies = []
+      threads = [ threading.Thread(target=lambda: replies.append(self.request('/distfiles/b-1.tar.gz')))
+                  for i in range(4) ]
+      for thread in threads:
+         thread.start()
+      for thread in threads:
+         thread.join()
+      self.assertEqual(replies, [ (200, None, 'fetched\n') ] * 4)
+      fd = open(self.log)
+      try:
+         self.assertEqual(fd.read(), 'b-1.tar.gz\n')
+      finally:
+         fd.close()
+
+class CuttingHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+   # Serves DATA (with ranges), cutting off the first transfer a third of the way through
+   protocol_version = 'HTTP/1.1'
+   DATA = os.urandom(3 * 1048576)
+   cut = [ True ]
+
+   def do_GET(self):
+      start = 0
+      if self.headers.getheader('Range'):
+         start = int(self.headers.getheader('Range').split('=')[1].split('-')[0])
+         self.send_response(206)
+         self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, len(self.DATA) - 1, len(self.DATA)))
+      else:
+         self.send_response(200)
+      self.send_header('Content-Length', str(len(self.DATA) - start))
+      self.end_headers()
+      if self.cut[0]:
+         self.cut[0] = False
+         self.wfile.write(self.DATA[start:len(self.DATA) // 2])
+         self.close_connection = 1
+      else:
+         self.wfile.write(self.DATA[start:])
+
+   def log_message(self, format, *args):
+      pass
+
+class SequentialTest(TempDirTest):
+   def setUp(self):
+      TempDirTest.setUp(self)
+      self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), CuttingHandler)
+      thread = threading.Thread(target=self.server.serve_forever)
+      thread.setDaemon(True)
+      thread.start()
+      CuttingHandler.cut[0] = True
+
+   def tearDown(self):
+      self.server.shutdown()
+      self.server.server_close()
+      TempDirTest.tearDown(self)
+
+   def testTruncatedTransfer(self):
+      uri = 'http://127.0.0.1:%d/f' % (self.server.server_address[1],)
+      path = os.path.join(self.dir, 'f')
+      downloader = gentooget.RangeDownloader([ uri ], path, 1, 1, 1048576, False)
+      self.assertNotEqual(downloader.sequential(), 0)
+      self.assertEqual(gentooget.controlProgress(path, len(CuttingHandler.DATA)), 1048576) # The whole pieces
+      downloader = gentooget.RangeDownloader([ uri ], path, 1, 1, 1048576, False)
+      self.assertEqual(downloader.sequential(), 0)
+      self.assertEqual(downloader.mirrors[uri]['bytes'], len(CuttingHandler.DATA) - 1048576) # Only the rest
+      self.assertFalse(os.path.exists(path + '.aria2'))
+      fd = open(path, 'rb')
+      try:
+         self.assertEqual(fd.read(), CuttingHandler.DATA)
+      finally:
+         fd.close()
+
+class HedgeTest(TempDirTest):
+   # --hedge against the benchmark's mirror stand-ins: an internal mirror too slow to deliver anything within the
+   # hedge and a fast local one
+   def setUp(self):
+      TempDirTest.setUp(self)
+      self.engine = gentooget.ENGINE
+      gentooget.ENGINE = 'native'
+      store = os.path.join(self.dir, 'store')
+      os.mkdir(store)
+      self.data = os.urandom(256 * 1024)
+      self.write('store/a-1.tar.gz', self.data)
+      self.mirrors = []
+      self.servers = []
+      for config in ({ 'name': 'internal', 'rate': '32K' }, { 'name': 'local' }):
+         mirror = gentoogetbench.Mirror(config, '127.0.0.1', [ 'a-1.tar.gz' ], store, random.Random(1))
+         self.servers.append(gentoogetbench.startMirror(mirror))
+         self.mirrors.append(mirror)
+      self.distdir = os.path.join(self.dir, 'distfiles')
+      os.mkdir(self.distdir)
+
+   def tearDown(self):
+      gentooget.ENGINE = self.engine
+      for server in self.servers:
+         server.shutdown()
+         server.server_close()
+      TempDirTest.tearDown(self)
+
+   def options(self, mirror):
+      return [ 'aria2c', '-d', self.distdir, '-o', 'a-1.tar.gz', mirror.url() + '/distfiles/a-1.tar.gz' ]
+
+   def testLocalWins(self):
+      fullPath = os.path.join(self.distdir, 'a-1.tar.gz')
+      internal = gentooget.Transfer(self.options(self.mirrors[0]), fullPath, {}, None)
+      self.assertTrue(internal.stalled(1, 0))
+      local = gentooget.hedge(internal, self.options(self.mirrors[1]), fullPath, {}, None)
+      self.assertEqual(local.status, 0)
+      self.assertTrue(internal.cancelled)
+      self.assertFalse(internal.running()) # Stopped before the local download was moved into place
+      self.assertEqual(sorted(os.listdir(self.distdir)), [ 'a-1.tar.gz' ])
+      fd = open(fullPath, 'rb')
+      try:
+         self.assertEqual(fd.read(), self.data)
+      finally:
+         fd.close()
+
+   def testKilled(self):
+      # A download that ignores being stopped is killed before join returns
+      killed = threading.Event()
+      def download(options, fullPath, expected, transfer):
+         transfer.attach(lambda: None, None, killed.set)
+         killed.wait(10)
+         return 1
+      saved = gentooget.download, gentooget.HEDGE_STOP
+      gentooget.download, gentooget.HEDGE_STOP = download, 0.5
+      try:
+         transfer = gentooget.Transfer([], os.path.join(self.distdir, 'a-1.tar.gz'), {}, None)
+         transfer.cancel()
+         transfer.join()
+      finally:
+         gentooget.download, gentooget.HEDGE_STOP = saved
+      self.assertTrue(killed.isSet())
+      self.assertFalse(transfer.running())
+
+class DaemonTest(TempDirTest):
+   # A FetchDaemon driving FakeAria2Rpc, fed by daemonDownload as gentooget would, from a mirror stand-in
+   def setUp(self):
+      TempDirTest.setUp(self)
+      self.threads = threading.enumerate()
+      store = os.path.join(self.dir, 'store')
+      os.mkdir(store)
+      self.data = os.urandom(100 * 1024)
+      self.write('store/a-1.tar.gz', self.data)
+      mirror = gentoogetbench.Mirror({ 'name': 'local' }, '127.0.0.1', [ 'a-1.tar.gz' ], store, random.Random(1))
+      self.mirror = gentoogetbench.startMirror(mirror)
+      self.uri = mirror.url() + '/distfiles/a-1.tar.gz'
+      self.rpc = gentooget.FakeAria2Rpc(0)
+      self.distdir = os.path.join(self.dir, 'distfiles')
+      os.mkdir(self.distdir)
+      self.daemonSettings = gentooget.DAEMON_SOCKET, gentooget.DAEMON_GROUP
+      gentooget.DAEMON_SOCKET = os.path.join(self.dir, 'daemon.sock')
+      gentooget.DAEMON_GROUP = grp.getgrgid(os.getgid()).gr_name
+      self.daemon = gentooget.FetchDaemon(gentooget.DAEMON_SOCKET,
+                                          gentooget.Aria2Rpc(self.rpc.server_address[1]), self.distdir)
+      for server in (self.rpc, self.daemon):
+         thread = threading.Thread(target=server.serve_forever)
+         thread.setDaemon(True)
+         thread.start()
+
+   def tearDown(self):
+      gentooget.DAEMON_SOCKET, gentooget.DAEMON_GROUP = self.daemonSettings
+      for server in (self.daemon, self.rpc, self.mirror):
+         server.shutdown()
+         server.server_close()
+      self.daemon.rpc.close() # Ends the fake aria2c's handler thread, which is waiting for the next call
+      for thread in threading.enumerate():
+         if not thread in self.threads:
+            thread.join(5)
+      TempDirTest.tearDown(self)
+
+   def download(self, *options):
+      return gentooget.daemonDownload([ 'aria2c', '-d', self.distdir, '-o', 'a-1.tar.gz' ] + list(options), {})
+
+   def testDownload(self):
+      self.assertEqual(os.stat(gentooget.DAEMON_SOCKET).st_mode & 0777, 0660)
+      self.assertEqual(self.download(self.uri), 0)
+      fd = open(os.path.join(self.distdir, 'a-1.tar.gz'), 'rb')
+      try:
+         self.assertEqual(fd.read(), self.data)
+      finally:
+         fd.close()
+
+   def testRefused(self):
+      self.assertEqual(self.download('--on-download-complete=/bin/sh', self.uri), 1)
+      self.assertEqual(self.download('file://' + os.path.join(self.dir, 'store', 'a-1.tar.gz')), 1)
+      self.assertEqual(gentooget.daemonDownload([ 'aria2c', '-d', self.dir, '-o', 'a-1.tar.gz', self.uri ]), 1)
+      self.assertEqual(self.download('-o', '../a-1.tar.gz', self.uri), 1)
+      self.assertEqual(os.listdir(self.distdir), [])
+      self.assertEqual(self.rpc.jobs, {})
+
+class StartupTest(TempDirTest):
+   # Portage starts gentooget once per distfile so its startup time is a cost on every download
+   BUDGET = 80 # Milliseconds for the launcher to start aria2c (gentoogetbench.py --startup=60 on a quiet machine)
+
+   def testLazyImports(self):
+      src = os.path.dirname(os.path.abspath(gentooget.__file__))
+      loaded = subprocess.Popen([ sys.executable, '-c', 'import sys; sys.path.insert(0, %r); import gentooget; '
+                                  'print(" ".join(sorted(sys.modules)))' % (src,) ],
+                                stdout=subprocess.PIPE).communicate()[0].split()
+      self.assertTrue('gentooget' in loaded)
+      for name in ('subprocess', 'shlex', 'httplib', 'ftplib', 'ssl', 'urllib2', 'mmap', 'grp'):
+         self.assertFalse(name in loaded, name + ' is imported on startup')
+
+   def testBudget(self):
+      times = gentoogetbench.measureStartup(self.dir, gentoogetbench.GENTOOGET_FAST, 5, [])
+      spawn = gentoogetbench.median([ t[0] for t in times ]) * 1000
+      self.assertTrue(spawn <= self.BUDGET, 'Took %.1fms to start aria2c, over the %dms budget' % (spawn, self.BUDGET))
+
+if __name__ == '__main__':
+   unittest.main()